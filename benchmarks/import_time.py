@@ -0,0 +1,121 @@
+import os
+import sys
+import json
+import time
+import runpy
+import importlib
+import argparse
+import resource
+import tempfile
+import subprocess
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+# Modules that cost seconds and hundreds of MB to import
+HEAVY = ["torch", "totalsegmentator", "SimpleITK", "scipy", "pandas", "numpy"]
+
+# name -> (what the child runs, heavy modules it must not load); None = reference, not checked
+SCENARIOS = {
+    "help": (["main", "--help"], HEAVY),
+    "plan": (["main", "-a", "--plan"], HEAVY),
+    "pipeline_import": (["import", "evaluation.pipeline"], HEAVY),
+    "metric_stage": (["stages", "metric"], ["torch", "totalsegmentator"]),
+    "params_stage": (["stages", "params"], HEAVY),
+    "segmentation_stage": (["stages", "segmentation"], None),
+}
+
+
+def run_child(kind, args, data_dir):
+    start = time.perf_counter()
+    missing = []
+    if kind == "main":
+        sys.argv = ["main.py", "-d", os.path.join(data_dir, "MGH-*"), *args]
+        try:
+            runpy.run_path(os.path.join(REPO_DIR, "main.py"), run_name="__main__")
+        except SystemExit:
+            pass
+    elif kind == "import":
+        __import__(args[0])
+    else:
+        # What load_stages imports, module by module: one that isn't installed (the scorer, TotalSegmentator) is
+        # reported and the rest of the stage is still measured
+        from evaluation.pipeline import resolve_steps
+        from evaluation.stages import STAGE_IMPORTS
+        steps = resolve_steps(**{"seg" if args[0] == "segmentation" else args[0]: True})
+        for stage in (stage for stage, requested in steps.items() if requested):
+            for name in STAGE_IMPORTS.get(stage, ()):
+                try:
+                    importlib.import_module(name)
+                except ModuleNotFoundError:
+                    missing.append(name)
+    return {
+        "wall_s": time.perf_counter() - start,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "loaded": [m for m in HEAVY if m in sys.modules],
+        "missing": missing,
+    }
+
+
+def make_cohort(data_dir, count=3):
+    # Empty patient folders with a few CT "slices", enough for --plan
+    for i in range(count):
+        ct_dir = os.path.join(data_dir, f"MGH-{i + 1:03d}", "CT")
+        os.makedirs(ct_dir)
+        for z in range(10 * (i + 1)):
+            open(os.path.join(ct_dir, f"{z}.dcm"), "w").close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Startup time and RSS of the light entry points; fails when one of them loads a heavy dependency")
+    parser.add_argument("--scenarios", type=str, default=",".join(SCENARIOS), help="scenarios to run (csv)")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per scenario, the fastest is reported")
+    parser.add_argument("--json", type=str, default=None, help="write all results to this file")
+    parser.add_argument("--child", type=str, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        name, data_dir = args.child.split(":", 1)
+        (kind, *child_args), _ = SCENARIOS[name]
+        with open(os.devnull, "w") as devnull:
+            stdout, sys.stdout = sys.stdout, devnull
+            result = run_child(kind, child_args, data_dir)
+            sys.stdout = stdout
+        print(json.dumps(result))
+        sys.exit(0)
+
+    report = {}
+    violations = []
+    with tempfile.TemporaryDirectory(prefix="bench_import_") as work_dir:
+        make_cohort(work_dir)
+        print(f"{'scenario':<20}{'wall (s)':>10}{'peak RSS (MB)':>15}  heavy modules loaded")
+        for name in args.scenarios.split(","):
+            _, forbidden = SCENARIOS[name]
+            runs = []
+            for _ in range(args.repeat):
+                # Fresh interpreter per run, with the results dir inside the scratch folder
+                out = subprocess.run(
+                    [sys.executable, os.path.abspath(__file__), "--child", f"{name}:{work_dir}"],
+                    stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, cwd=work_dir
+                )
+                if out.returncode != 0:
+                    break
+                runs.append(json.loads(out.stdout.strip().splitlines()[-1]))
+            if not runs:
+                print(f"{name:<20}{'failed':>10}  (missing dependency?)")
+                continue
+            best = min(runs, key=lambda r: r["wall_s"])
+            report[name] = best
+            bad = [m for m in best["loaded"] if forbidden and m in forbidden]
+            violations += [(name, m) for m in bad]
+            note = " <- should stay light" if bad else "" if forbidden else " (reference)"
+            if best["missing"]:
+                note += f" (not installed: {', '.join(best['missing'])})"
+            print(f"{name:<20}{best['wall_s']:>10.2f}{best['peak_rss_mb']:>15.0f}  {', '.join(best['loaded']) or '-'}{note}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+    if violations:
+        print("Heavy imports on a light path: " + ", ".join(f"{name}: {m}" for name, m in violations))
+        sys.exit(1)
@@ -0,0 +1,143 @@
+import os
+import sys
+import json
+import shutil
+import argparse
+import resource
+import subprocess
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+STAGES = ["hu_mapping", "z_crop", "bbox_scan", "mask_resample", "bladder_crop"]
+
+
+def create_data(data_dir, size):
+    import numpy as np
+    import SimpleITK as sitk
+
+    x, y, z = size
+    rng = np.random.default_rng(0)
+    cbct = rng.integers(0, 1400, size=(z, y, x), dtype=np.int16)
+    _write(sitk.GetImageFromArray(cbct), os.path.join(data_dir, "cbct.nrrd"), (0.9, 0.9, 2.0))
+    del cbct
+
+    def mask(z0, z1, y0, y1, x0, x1):
+        arr = np.zeros((z, y, x), dtype=np.uint8)
+        arr[z0:z1, y0:y1, x0:x1] = 1
+        return sitk.GetImageFromArray(arr)
+
+    _write(mask(z // 4, z // 2, y // 3, y // 2, x // 3, x // 2), os.path.join(data_dir, "ct_hip.nrrd"), (0.9, 0.9, 2.0))
+    _write(mask(z // 5, z // 3, y // 3, y // 2, x // 3, x // 2), os.path.join(data_dir, "cbct_hip.nrrd"), (0.9, 0.9, 2.0))
+    _write(mask(z // 3, z // 2, y // 3, y // 2, x // 3, x // 2), os.path.join(data_dir, "ct_bladder.nrrd"), (0.9, 0.9, 2.0))
+    _write(mask(z // 3, z // 2 + 5, y // 3, y // 2, x // 3, x // 2), os.path.join(data_dir, "cbct_bladder.nrrd"), (1.0, 1.0, 2.5))
+
+
+def _write(image, path, spacing):
+    import SimpleITK as sitk
+    image.SetSpacing(spacing)
+    sitk.WriteImage(image, path)
+
+
+def _status_mb(key):
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(key):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def _reset_peak():
+    # Writing 5 to clear_refs resets VmHWM (Linux >= 4.0), falls back to ru_maxrss elsewhere
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def run_stage(stage, streaming, data_dir, memory_mb):
+    # Runs inside a fresh interpreter so ru_maxrss only reflects this stage
+    from evaluation.config import EvaluationConfig
+    from evaluation.utils import Utils
+    from evaluation import streaming as st
+    from evaluation.preprocess import read_volume, apply_pw_linear
+    from evaluation.plastimatch import PW_LINEAR_CURVE
+    import SimpleITK as sitk
+
+    configs = EvaluationConfig()
+    configs.streaming = streaming
+    configs.stream_memory_mb = memory_mb
+    utils = Utils(configs)
+    work_dir = tempfile.mkdtemp(dir=data_dir)
+    for f in os.listdir(data_dir):
+        if f.endswith(".nrrd"):
+            shutil.copy(os.path.join(data_dir, f), work_dir)
+    path = lambda name: os.path.join(work_dir, name)
+
+    has_hwm = _reset_peak()
+    baseline = _status_mb("VmRSS:") if has_hwm else resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    if stage == "hu_mapping":
+        if streaming:
+            st.stream_pw_linear(path("cbct.nrrd"), path("lt_cbct.nrrd"), PW_LINEAR_CURVE, memory_mb)
+        else:
+            image = read_volume(path("cbct.nrrd"))
+            mapped = sitk.GetImageFromArray(apply_pw_linear(sitk.GetArrayFromImage(image).astype("float32")))
+            mapped.CopyInformation(image)
+            sitk.WriteImage(mapped, path("lt_cbct.nrrd"))
+    elif stage == "z_crop":
+        utils.crop_hip_by_femurs(path("cbct_hip.nrrd"), path("ct_hip.nrrd"))
+    elif stage == "bbox_scan":
+        if streaming:
+            st.stream_z_extent(path("ct_hip.nrrd"), memory_mb)
+        else:
+            utils.get_colon_z_extent(path("ct_hip.nrrd"))
+    elif stage == "mask_resample":
+        if streaming:
+            st.stream_resample_mask(path("cbct_bladder.nrrd"), path("ct_bladder.nrrd"), path("resampled.nrrd"), memory_mb)
+        else:
+            resampled = utils.resample_to_reference(sitk.ReadImage(path("cbct_bladder.nrrd")), sitk.ReadImage(path("ct_bladder.nrrd")))
+            sitk.WriteImage(resampled, path("resampled.nrrd"))
+    elif stage == "bladder_crop":
+        utils.crop_larger_bladder_to_smaller_extent_by_zmm(path("ct_bladder.nrrd"), path("cbct_bladder.nrrd"))
+    peak = _status_mb("VmHWM:") if has_hwm else resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    shutil.rmtree(work_dir)
+    return {"baseline_mb": baseline, "peak_mb": peak, "stage_mb": peak - baseline}
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, nargs=3, default=[512, 512, 300], help="synthetic volume size (x y z)")
+    parser.add_argument("--memory-mb", type=int, default=64, help="streaming memory ceiling (MB)")
+    parser.add_argument("--stages", type=str, default=",".join(STAGES), help="stages to measure (csv)")
+    parser.add_argument("--child", type=str, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        stage, mode, data_dir = args.child.split(":", 2)
+        with open(os.devnull, "w") as devnull:
+            stdout, sys.stdout = sys.stdout, devnull
+            result = run_stage(stage, mode == "streaming", data_dir, args.memory_mb)
+            sys.stdout = stdout
+        print(json.dumps(result))
+        sys.exit(0)
+
+    data_dir = tempfile.mkdtemp(prefix="bench_memory_")
+    try:
+        create_data(data_dir, args.size)
+        print(f"Volume {args.size[0]}x{args.size[1]}x{args.size[2]}, streaming ceiling {args.memory_mb} MB")
+        print(f"Peak RSS above the pre-stage baseline:")
+        print(f"{'stage':<16}{'whole (MB)':>12}{'streaming (MB)':>16}{'reduction':>12}")
+        for stage in args.stages.split(","):
+            results = {}
+            for mode in ["whole", "streaming"]:
+                out = subprocess.run(
+                    [sys.executable, os.path.abspath(__file__), "--child", f"{stage}:{mode}:{data_dir}", "--memory-mb", str(args.memory_mb)],
+                    stdout=subprocess.PIPE, text=True, check=True
+                )
+                results[mode] = json.loads(out.stdout.strip().splitlines()[-1])["stage_mb"]
+            reduction = results["whole"] / results["streaming"] if results["streaming"] > 0 else float("inf")
+            print(f"{stage:<16}{results['whole']:>12.1f}{results['streaming']:>16.1f}{reduction:>11.1f}x")
+    finally:
+        shutil.rmtree(data_dir)
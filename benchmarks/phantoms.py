@@ -0,0 +1,172 @@
+import os
+import sys
+import argparse
+import numpy as np
+import SimpleITK as sitk
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from evaluation.plastimatch import PW_LINEAR_CURVE
+
+# Organs as ellipsoids in patient mm around the pelvis centre: name -> (centre xyz, radii xyz, HU), laid out for an
+# in-plane field of view of at least LAYOUT_HALF_EXTENT_MM and shrunk with smaller ones (see layout_scale)
+ORGANS = {
+    "urinary_bladder": ((0, 20, 10), (40, 30, 30), 10),
+    "prostate": ((0, 20, -40), (20, 16, 16), 45),
+    "rectum": ((0, 60, -20), (15, 15, 50), -50),
+    "colon": ((35, 45, 70), (30, 20, 40), -600),
+    "femur_left": ((95, 0, -90), (18, 18, 60), 700),
+    "femur_right": ((-95, 0, -90), (18, 18, 60), 700),
+    "hip_left": ((85, 10, 10), (30, 40, 50), 500),
+    "hip_right": ((-85, 10, 10), (30, 40, 50), 500),
+}
+# GT_contours/{CT,CBCT} label name -> phantom organ
+GT_ORGANS = {"Bladder": "urinary_bladder", "Prostate": "prostate", "Rectum": "rectum"}
+BODY_RADII_MM = (180, 130)
+# Half extent (x, y) the layout fits in: hips/femurs reach x = +-115 mm, the body y = +-130 mm
+LAYOUT_HALF_EXTENT_MM = (120, 130)
+# CBCT: 80% of the CT z extent, bladder filled differently so the two masks do not coincide
+CBCT_Z_FRACTION = 0.8
+CBCT_BLADDER_SCALE = 1.15
+
+
+def physical_grid(image):
+    # (z, y, x) arrays of physical x, y, z for every voxel of an axis-aligned image
+    size, spacing, origin = image.GetSize(), image.GetSpacing(), image.GetOrigin()
+    axes = [origin[i] + spacing[i] * np.arange(size[i], dtype=np.float32) for i in range(3)]
+    z, y, x = np.meshgrid(axes[2], axes[1], axes[0], indexing="ij")
+    return x, y, z
+
+
+def layout_scale(image):
+    # Centres and radii shrink uniformly when the in-plane field of view is smaller than the layout's, so every organ
+    # stays inside it. In-plane only: CT and CBCT differ in z extent but must get the same placement.
+    size, spacing = image.GetSize(), image.GetSpacing()
+    return min(1.0, *[(size[i] - 1) * spacing[i] / 2 / LAYOUT_HALF_EXTENT_MM[i] for i in range(2)])
+
+
+def organ_layout(image):
+    # ORGANS scaled to the image: name -> (centre xyz, radii xyz, HU)
+    s = layout_scale(image)
+    return {name: (tuple(s * c for c in centre), tuple(s * r for r in radii), hu) for name, (centre, radii, hu) in ORGANS.items()}
+
+
+def organ_masks(image, names=None, bladder_scale=1.0):
+    # Same organ placement for any grid, so stand-in segmentations line up with the phantom that produced the image
+    x, y, z = physical_grid(image)
+    layout = organ_layout(image)
+    masks = {}
+    for name in names or ORGANS:
+        (cx, cy, cz), (rx, ry, rz), _ = layout[name]
+        scale = bladder_scale if name == "urinary_bladder" else 1.0
+        masks[name] = (((x - cx) / (rx * scale)) ** 2 + ((y - cy) / (ry * scale)) ** 2 + ((z - cz) / (rz * scale)) ** 2) <= 1
+    return masks
+
+
+def phantom_hu(image, bladder_scale=1.0):
+    x, y, _ = physical_grid(image)
+    hu = np.full(x.shape, -1000, dtype=np.float32)
+    s = layout_scale(image)
+    hu[(x / (s * BODY_RADII_MM[0])) ** 2 + (y / (s * BODY_RADII_MM[1])) ** 2 <= 1] = 40
+    for name, mask in organ_masks(image, bladder_scale=bladder_scale).items():
+        hu[mask] = ORGANS[name][2]
+    return hu
+
+
+def empty_image(size, spacing, dtype=sitk.sitkInt16):
+    image = sitk.Image([int(s) for s in size], dtype)
+    image.SetSpacing([float(s) for s in spacing])
+    image.SetOrigin([-(s - 1) * sp / 2 for s, sp in zip(size, spacing)])
+    return image
+
+
+def to_image(array, reference, dtype=np.int16):
+    image = sitk.GetImageFromArray(array.astype(dtype))
+    image.CopyInformation(reference)
+    return image
+
+
+def write_dicom_series(image, out_dir, modality="CT", series_uid=None):
+    os.makedirs(out_dir, exist_ok=True)
+    image = sitk.Cast(image, sitk.sitkInt16)
+    series_uid = series_uid or f"1.2.826.0.1.3680043.2.1125.{np.random.randint(1, 10**9)}"
+    writer = sitk.ImageFileWriter()
+    writer.KeepOriginalImageUIDOn()
+    for i in range(image.GetDepth()):
+        slice_image = image[:, :, i]
+        origin = image.TransformIndexToPhysicalPoint((0, 0, i))
+        tags = {
+            "0008|0060": modality,
+            "0020|000d": f"{series_uid}.1",
+            "0020|000e": series_uid,
+            "0020|0013": str(i + 1),
+            "0020|0032": "\\".join(f"{v:.4f}" for v in origin),
+            "0020|0037": "1\\0\\0\\0\\1\\0",
+            "0018|0050": f"{image.GetSpacing()[2]:.4f}",
+            "0008|0018": f"{series_uid}.{i + 1}",
+        }
+        for tag, value in tags.items():
+            slice_image.SetMetaData(tag, value)
+        writer.SetFileName(os.path.join(out_dir, f"{i:04d}.dcm"))
+        writer.Execute(slice_image)
+
+
+def hu_to_cbct(hu, curve=PW_LINEAR_CURVE):
+    # Inverse of the pw-linear curve, so plastimatch adjust maps the phantom CBCT back onto CT-like HU
+    values = [float(v) for v in curve.split(",")]
+    return np.interp(hu, values[1::2], values[0::2])
+
+
+def write_fiducials(path, points):
+    with open(path, "w") as f:
+        f.write("# Markups fiducial file version = 4.11\n# CoordinateSystem = LPS\n")
+        f.write("# columns = id,x,y,z,ow,ox,oy,oz,vis,sel,lock,label,desc,associatedNodeID\n")
+        for i, (x, y, z) in enumerate(points):
+            f.write(f"vtkMRMLMarkupsFiducialNode_{i},{x},{y},{z},0,0,0,1,1,1,0,F-{i + 1},,\n")
+
+
+def make_patient(root, number, size=(128, 128, 64), spacing=(2.0, 2.0, 3.0), prefix="MGH"):
+    # MGH-NNN with CT/, CBCT/, GENERATED_CT/ DICOM series, GT_contours/{CT,CBCT}/*.mha, FDMs/ and an identity Slicer affine
+    patient_dir = os.path.join(root, f"{prefix}-{number}")
+    ct = empty_image(size, spacing)
+    cbct_size = (size[0], size[1], max(int(size[2] * CBCT_Z_FRACTION), 8))
+    cbct = empty_image(cbct_size, spacing)
+
+    ct_hu = phantom_hu(ct)
+    write_dicom_series(to_image(ct_hu, ct), os.path.join(patient_dir, "CT"), "CT")
+    cbct_hu = phantom_hu(cbct, bladder_scale=CBCT_BLADDER_SCALE)
+    write_dicom_series(to_image(hu_to_cbct(cbct_hu), cbct), os.path.join(patient_dir, "CBCT"), "CT")
+    write_dicom_series(to_image(cbct_hu, cbct), os.path.join(patient_dir, "GENERATED_CT"), "CT")
+
+    for modality, image, bladder_scale in [("CT", ct, 1.0), ("CBCT", cbct, CBCT_BLADDER_SCALE)]:
+        gt_dir = os.path.join(patient_dir, "GT_contours", modality)
+        os.makedirs(gt_dir, exist_ok=True)
+        masks = organ_masks(image, GT_ORGANS.values(), bladder_scale)
+        for gt_name, organ in GT_ORGANS.items():
+            sitk.WriteImage(to_image(masks[organ], image, np.uint8), os.path.join(gt_dir, f"{gt_name}.mha"))
+
+    fdm_dir = os.path.join(patient_dir, "FDMs")
+    os.makedirs(fdm_dir, exist_ok=True)
+    centres = [organ_layout(ct)[organ][0] for organ in GT_ORGANS.values()]
+    for modality in ["CT", "CBCT"]:
+        write_fiducials(os.path.join(fdm_dir, f"{number}-{modality}-fdm.fcsv"), centres)
+
+    identity = sitk.AffineTransform(3)
+    sitk.WriteTransform(identity, os.path.join(patient_dir, f"{number}-LinearTransform.txt"))
+    return patient_dir
+
+
+def make_dataset(root, count, size=(128, 128, 64), spacing=(2.0, 2.0, 3.0), numbers=None):
+    numbers = numbers or [f"{i + 1:03d}" for i in range(count)]
+    return [make_patient(root, number, size, spacing) for number in numbers[:count]]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write synthetic pelvis phantoms in the MGH-NNN layout")
+    parser.add_argument("-o", "--output", type=str, default="./datasets/phantoms", help="dataset root")
+    parser.add_argument("-n", "--patients", type=int, default=2, help="number of phantom patients")
+    parser.add_argument("--size", type=int, nargs=3, default=[128, 128, 64], help="CT size (x y z)")
+    parser.add_argument("--spacing", type=float, nargs=3, default=[2.0, 2.0, 3.0], help="voxel spacing (mm)")
+    args = parser.parse_args()
+    for patient_dir in make_dataset(args.output, args.patients, args.size, args.spacing):
+        print(patient_dir)
@@ -0,0 +1,136 @@
+import os
+import sys
+import json
+import shutil
+import argparse
+import importlib
+import tempfile
+from contextlib import redirect_stdout
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARKS_DIR))
+sys.path.insert(0, BENCHMARKS_DIR)
+# Stand-ins shadow the real tools, so the suite runs on a CPU-only box without network or model weights
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, "stubs"))
+os.environ["PATH"] = os.path.join(BENCHMARKS_DIR, "bin") + os.pathsep + os.environ.get("PATH", "")
+
+from phantoms import make_dataset
+from evaluation.config import EvaluationConfig
+from evaluation.pipeline import EvaluationPipeline
+from evaluation.resources import ResourceMonitor
+
+STAGES = ["pw_linear", "segmentation", "crops", "dmap", "cxt", "fcsv", "params", "register", "warp", "metric"]
+# Stages whose cost is dominated by a stand-in rather than the real tool
+STAND_IN_STAGES = {"segmentation", "register"}
+
+
+def load_evaluator():
+    # The scorer is not shipped with every checkout; without it the metric stage is skipped, not failed
+    try:
+        return importlib.import_module("evaluation.evaluator").Evaluator
+    except ImportError as e:
+        print(f"[SKIP] metric: {e}", file=sys.stderr)
+        return None
+
+
+def stage_runners(pipeline, evaluator):
+    flags = {}
+
+    def params(patient_dir):
+        flags[patient_dir] = pipeline.create_register_params(patient_dir, True)
+
+    # name -> (prepare (untimed), run)
+    return {
+        "pw_linear": (None, lambda p: pipeline.pw_linear_transformation(p, True)),
+        "segmentation": (None, lambda p: pipeline.segment_patient(p, True)),
+        # force=True restarts each timed crop from the uncropped copies
+        "crops": (None, lambda p: pipeline.crop_segments(p, True)),
+        "dmap": (None, lambda p: pipeline.dmap_calcualtion(p, True)),
+        "cxt": (None, lambda p: pipeline.cxt_conversion(p, True)),
+        "fcsv": (None, lambda p: pipeline.create_fcsvfile(p, True)),
+        "params": (None, params),
+        "register": (None, lambda p: pipeline.start_registration(p, flags[p], True)),
+        "warp": (None, lambda p: pipeline.start_warp(p, True)),
+        "metric": (None, evaluator.calculate_scores if evaluator is not None else None),
+    }
+
+
+def run_case(work_dir, size, spacing, count, stages):
+    configs = EvaluationConfig()
+    configs.use_extended_ts_organs = True
+    configs.RESULTS_DIR = os.path.join(work_dir, "results")
+    configs.COST_MODEL_PATH = os.path.join(configs.RESULTS_DIR, "cost_model.json")
+    numbers = configs.patients_with_GT + [f"{900 + i:03d}" for i in range(count)]
+    patients = make_dataset(os.path.join(work_dir, "MGH"), count, size, spacing, numbers)
+
+    pipeline = EvaluationPipeline(configs)
+    Evaluator = load_evaluator() if "metric" in stages else None
+    evaluator = Evaluator(configs, pipeline._utils, pipeline._plastimatch) if Evaluator is not None else None
+    runners = stage_runners(pipeline, evaluator)
+    stages = [stage for stage in stages if runners[stage][1] is not None]
+
+    results = {}
+    with open(os.devnull, "w") as devnull:
+        for stage in stages:
+            prepare, run = runners[stage]
+            wall_s = cpu_s = peak_rss_mb = 0.0
+            failures = 0
+            for patient_dir in patients:
+                with redirect_stdout(devnull):
+                    if prepare:
+                        prepare(patient_dir)
+                    with ResourceMonitor(stage) as monitor:
+                        try:
+                            run(patient_dir)
+                        except Exception as e:
+                            failures += 1
+                            print(f"[ERROR] {stage} failed for {patient_dir}: {e}", file=sys.stderr)
+                wall_s += monitor.usage.wall_s
+                cpu_s += monitor.usage.cpu_s
+                peak_rss_mb = max(peak_rss_mb, monitor.usage.peak_rss_mb)
+            results[stage] = {
+                "wall_s": wall_s, "cpu_s": cpu_s, "peak_rss_mb": peak_rss_mb,
+                "s_per_patient": wall_s / count, "failures": failures,
+            }
+    return results
+
+
+def parse_size(text):
+    return tuple(int(v) for v in text.lower().split("x"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time each pipeline stage on synthetic phantoms with plastimatch/TotalSegmentator stand-ins")
+    parser.add_argument("--sizes", type=str, nargs="+", default=["64x64x32", "128x128x64"], help="CT sizes (XxYxZ)")
+    parser.add_argument("--patients", type=int, nargs="+", default=[1, 4], help="patient counts")
+    parser.add_argument("--spacing", type=float, nargs=3, default=[2.0, 2.0, 3.0], help="voxel spacing (mm)")
+    parser.add_argument("--stages", type=str, default=",".join(STAGES), help="stages to time (csv, in pipeline order)")
+    parser.add_argument("--json", type=str, default=None, help="write all timings to this file")
+    parser.add_argument("--keep", action="store_true", help="keep the generated phantoms and outputs")
+    args = parser.parse_args()
+
+    stages = [s for s in STAGES if s in args.stages.split(",")]
+    report = []
+    for size_text in args.sizes:
+        for count in args.patients:
+            work_dir = tempfile.mkdtemp(prefix="bench_pipeline_")
+            try:
+                size = parse_size(size_text)
+                results = run_case(work_dir, size, args.spacing, count, stages)
+                report.append({"size": size, "patients": count, "stages": results})
+                total = sum(r["wall_s"] for r in results.values())
+                print(f"\nCT {size_text}, {count} patient(s): {total:.1f} s total, {count * 3600 / max(total, 1e-9):.0f} patients/hour")
+                print(f"{'stage':<14}{'s/patient':>11}{'cpu (s)':>10}{'peak RSS (MB)':>15}")
+                for stage, r in results.items():
+                    note = " (stand-in)" if stage in STAND_IN_STAGES else ""
+                    note += f" [{r['failures']} failed]" if r["failures"] else ""
+                    print(f"{stage:<14}{r['s_per_patient']:>11.2f}{r['cpu_s']:>10.1f}{r['peak_rss_mb']:>15.0f}{note}")
+            finally:
+                if args.keep:
+                    print(f"Outputs kept in {work_dir}")
+                else:
+                    shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,15 @@
+# TotalSegmentator stand-in for the benchmarks: paints the phantom organs on the input grid instead of running a network
+import os
+import numpy as np
+import SimpleITK as sitk
+
+from phantoms import ORGANS, organ_masks, to_image
+from evaluation.preprocess import read_volume
+
+
+def totalsegmentator(input, output, roi_subset=None, **kwargs):
+    image = read_volume(input)
+    names = [name for name in (roi_subset or ORGANS) if name in ORGANS]
+    os.makedirs(output, exist_ok=True)
+    for name, mask in organ_masks(image, names).items():
+        sitk.WriteImage(to_image(mask, image, np.uint8), os.path.join(output, f"{name}.nii.gz"))
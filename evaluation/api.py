@@ -0,0 +1,230 @@
+import os
+import logging
+import tempfile
+from glob import glob
+
+from evaluation.fcsv import FCSV_HEADER
+from evaluation.stages import lazy_import
+from evaluation.utils import Utils
+
+# In-memory stage chaining: masks and volumes are sitk.Image, point sets (N, 3) arrays in physical (LPS) mm, so
+# segmentation -> cropping -> surface points / distance maps -> warps -> metrics runs without intermediate files.
+# Every function takes an optional Sink; an artifact is written only when the sink asks for it.
+np = lazy_import("numpy")
+sitk = lazy_import("SimpleITK")
+ts_api = lazy_import("totalsegmentator.python_api")
+vf_store = lazy_import("evaluation.vf_store")
+
+logger = logging.getLogger(__name__)
+
+# Sink subfolders and extensions per artifact kind, named like the pipeline's patient folders
+ARTIFACT_FOLDERS = {
+    "segments": ("segments", ".nrrd"),
+    "dmaps": ("dmaps", ".mha"),
+    "points": ("fcsvs", ".fcsv"),
+    "warps": ("warps", ".mha"),
+}
+
+class Sink:
+    # Optional persistence of chained artifacts under out_dir/<kind folder>/<name><ext>. `kinds` limits what is
+    # written (None writes every kind); files are written to a temporary name and renamed, like the stage outputs.
+    def __init__(self, out_dir, kinds=None) -> None:
+        self.out_dir = out_dir
+        self.kinds = set(kinds) if kinds is not None else set(ARTIFACT_FOLDERS)
+
+    def path(self, kind, name):
+        folder, extension = ARTIFACT_FOLDERS[kind]
+        return os.path.join(self.out_dir, folder, f"{name}{extension}")
+
+    def __call__(self, kind, name, artifact):
+        if kind not in self.kinds:
+            return artifact
+        path = self.path(kind, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = os.path.join(os.path.dirname(path), f".{os.getpid()}.{os.path.basename(path)}")
+        if kind == "points":
+            write_fcsv(artifact, tmp_path)
+        else:
+            sitk.WriteImage(artifact, tmp_path)
+        os.replace(tmp_path, path)
+        logger.debug("[SINK] %s written to %s", name, path)
+        return artifact
+
+
+def _persist(sink, kind, name, artifact):
+    return sink(kind, name, artifact) if sink is not None and artifact is not None else artifact
+
+
+def read_image(path) -> "sitk.Image":
+    # A volume file or a DICOM series folder
+    if os.path.isdir(path):
+        reader = sitk.ImageSeriesReader()
+        reader.SetFileNames(reader.GetGDCMSeriesFileNames(path))
+        return reader.Execute()
+    return sitk.ReadImage(path)
+
+
+def segment(image, roi_subset=None, sink=None):
+    # TotalSegmentator structures of an image (sitk.Image or path) as {name: mask}. TotalSegmentator only reads and
+    # writes files, so its input and output live in a temporary folder that is removed before returning.
+    with tempfile.TemporaryDirectory(prefix="ts_") as tmp_dir:
+        input_path = image
+        if not isinstance(image, str):
+            input_path = os.path.join(tmp_dir, "input.nii.gz")
+            sitk.WriteImage(image, input_path)
+        out_dir = os.path.join(tmp_dir, "segments")
+        ts_api.totalsegmentator(input_path, output=out_dir, roi_subset=roi_subset, quiet=not logger.isEnabledFor(logging.DEBUG))
+        masks = {}
+        for path in sorted(glob(os.path.join(out_dir, "*.nii.gz"))):
+            name = os.path.basename(path)[:-len(".nii.gz")]
+            # Loaded into memory before the folder goes away
+            masks[name] = _persist(sink, "segments", name, sitk.Image(sitk.ReadImage(path)))
+    return masks
+
+
+def crop_segments(ct_segments, cbct_segments, configs, sink=None):
+    # The pipeline's segment cropping (Pipeline._crop_segments) on {name: mask} dicts; returns new dicts and writes
+    # only the masks that changed to the sink, CT ones prefixed "CT_" and CBCT ones "CBCT_"
+    c, utils = configs, Utils(configs)
+    ct, cbct = dict(ct_segments), dict(cbct_segments)
+    changed = set()
+
+    def put(segments, prefix, name, image):
+        if image is not None:
+            segments[name] = image
+            changed.add((prefix, name))
+
+    if c.use_extended_ts_organs:
+        bladder = c.TS_BLADDER_CLASS
+        if bladder in ct and bladder in cbct:
+            result = utils.crop_larger_bladder_image(ct[bladder], cbct[bladder])
+            if result is not None:
+                larger, image = result
+                put((ct, cbct)[larger], ("CT", "CBCT")[larger], bladder, image)
+        colon = c.TS_COLON
+        if c.crop_colon and colon in ct and colon in cbct:
+            put(cbct, "CBCT", colon, utils.crop_colon_to_lower_sac_image(cbct[colon], keep_ratio=0.8))
+            put(ct, "CT", colon, utils.crop_ct_colon_by_cbct_sac_image(ct[colon], cbct[colon]))
+        for femur in (c.TS_FEMUR_LEFT, c.TS_FEMUR_RIGHT):
+            if femur in ct and femur in cbct:
+                put(ct, "CT", femur, utils.crop_ct_femur_using_cbct_image(cbct[femur], ct[femur]))
+        for hip in (c.TS_HIP_LEFT, c.TS_HIP_RIGHT):
+            if hip in ct and hip in cbct:
+                put(ct, "CT", hip, utils.crop_hip_by_femurs_image(cbct[hip], ct[hip]))
+
+    for prefix, name in sorted(changed):
+        _persist(sink, "segments", f"{prefix}_{name}", (ct if prefix == "CT" else cbct)[name])
+    return ct, cbct
+
+
+def distance_map(mask, name="dmap", sink=None) -> "sitk.Image":
+    # Unsigned distance (mm) to the mask boundary, like `plastimatch dmap --absolute-distance`
+    binary = sitk.Cast(mask > 0, sitk.sitkUInt8)
+    dmap = sitk.Abs(sitk.SignedMaurerDistanceMap(binary, insideIsPositive=False, squaredDistance=False, useImageSpacing=True))
+    return _persist(sink, "dmaps", name, sitk.Cast(dmap, sitk.sitkFloat32))
+
+
+def surface_points(mask, every=25, name="points", sink=None) -> "np.ndarray":
+    # Boundary voxels of each axial contour (a connected boundary on a slice), every `every`-th one of each as
+    # physical (LPS) points; the in-memory counterpart of the cxt -> fcsv conversion, which keeps every 25th point of
+    # each contour. Points within a contour are taken in voxel order rather than along the traced polygon.
+    binary = sitk.Cast(mask > 0, sitk.sitkUInt8)
+    indices = []
+    for z in range(binary.GetSize()[2]):
+        contour = sitk.BinaryContour(binary[:, :, z], fullyConnected=True)
+        labels = sitk.GetArrayFromImage(sitk.ConnectedComponent(contour, True))
+        for label in range(1, int(labels.max()) + 1):
+            ys, xs = np.nonzero(labels == label)
+            indices.append(np.stack([xs, ys, np.full(len(xs), z)], axis=1)[::every])
+    if not indices:
+        points = np.empty((0, 3))
+    else:
+        indices = np.concatenate(indices).astype(np.float64)
+        direction = np.array(mask.GetDirection()).reshape(3, 3)
+        points = np.array(mask.GetOrigin()) + (indices * np.array(mask.GetSpacing())) @ direction.T
+    return _persist(sink, "points", name, points)
+
+
+def write_fcsv(points, fcsv_path):
+    # Slicer markups in RAS, the same layout create_fcsv writes from a cxt
+    with open(fcsv_path, "w") as f:
+        f.write(FCSV_HEADER)
+        for count, (x, y, z) in enumerate(np.asarray(points, dtype=np.float64)):
+            f.write(f"{count}, {-x}, {-y}, {z}, 1, 1\n")
+
+
+def read_fcsv(fcsv_path) -> "np.ndarray":
+    # Points of an fcsv back in LPS
+    points = []
+    with open(fcsv_path) as f:
+        for line in f:
+            if line.startswith("#") or not line.strip():
+                continue
+            values = line.split(",")
+            points.append((-float(values[1]), -float(values[2]), float(values[3])))
+    return np.array(points).reshape(-1, 3)
+
+
+def read_vf(path) -> "sitk.Image":
+    # A registration VF (.nrrd, or the compressed .vfz store) as a vector image
+    if path.endswith(".vfz"):
+        with vf_store.VectorFieldStore(path) as store:
+            return store.to_image()
+    return sitk.ReadImage(path)
+
+
+def _displacement(vf):
+    # The transform takes over the image it is built from, so it gets a float64 copy
+    return sitk.DisplacementFieldTransform(sitk.Cast(vf, sitk.sitkVectorFloat64))
+
+
+def warp_mask(mask, vf, name="warp", sink=None) -> "sitk.Image":
+    # Mask resampled through the VF onto the VF grid (nearest neighbour), like `plastimatch warp --xf`
+    warped = sitk.Resample(mask, vf, _displacement(vf), sitk.sitkNearestNeighbor, 0, mask.GetPixelID())
+    return _persist(sink, "warps", name, warped)
+
+
+def warp_points(points, vf, name="points", sink=None) -> "np.ndarray":
+    # Each point moved by the displacement interpolated at it
+    transform = _displacement(vf)
+    warped = np.array([transform.TransformPoint(tuple(map(float, p))) for p in np.asarray(points)]).reshape(-1, 3)
+    return _persist(sink, "points", name, warped)
+
+
+def dice(reference, mask) -> float:
+    # Dice of two masks, the second resampled onto the first's grid when they differ
+    reference, mask = sitk.Cast(reference > 0, sitk.sitkUInt8), sitk.Cast(mask > 0, sitk.sitkUInt8)
+    if not _same_grid(reference, mask):
+        mask = Utils(None).resample_to_reference(mask, reference)
+    overlap = sitk.LabelOverlapMeasuresImageFilter()
+    overlap.Execute(reference, mask)
+    return overlap.GetDiceCoefficient()
+
+
+def hausdorff(reference, mask):
+    # (Hausdorff, average Hausdorff) distance in mm between two non-empty masks
+    hd = sitk.HausdorffDistanceImageFilter()
+    hd.Execute(sitk.Cast(reference > 0, sitk.sitkUInt8), sitk.Cast(mask > 0, sitk.sitkUInt8))
+    return hd.GetHausdorffDistance(), hd.GetAverageHausdorffDistance()
+
+
+def point_distances(points, reference_points) -> "np.ndarray":
+    # Distance (mm) of each point to its counterpart, e.g. warped FDMs against the planning CT FDMs
+    return np.linalg.norm(np.asarray(points) - np.asarray(reference_points), axis=1)
+
+
+def surface_distances(points, reference_mask) -> "np.ndarray":
+    # Distance (mm) of each point to the reference mask's boundary, sampled from its distance map
+    dmap = distance_map(reference_mask)
+    array = sitk.GetArrayViewFromImage(dmap)
+    distances = []
+    for p in np.asarray(points):
+        index = dmap.TransformPhysicalPointToIndex(tuple(map(float, p)))
+        inside = all(0 <= i < s for i, s in zip(index, dmap.GetSize()))
+        distances.append(array[index[2], index[1], index[0]] if inside else np.nan)
+    return np.array(distances)
+
+
+def _same_grid(a, b):
+    return (a.GetSize() == b.GetSize() and np.allclose(a.GetSpacing(), b.GetSpacing())
+            and np.allclose(a.GetOrigin(), b.GetOrigin()) and np.allclose(a.GetDirection(), b.GetDirection()))
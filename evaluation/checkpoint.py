@@ -0,0 +1,160 @@
+import os
+import json
+import shutil
+import logging
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Written last into a stage's output folder; a folder without it is an interrupted run and gets redone
+MARKER = ".complete"
+PARTIAL_SUFFIX = ".partial"
+# Written next to the marker when a stage commits without some of its work (tags preflight skipped); the folder
+# is reopened by the next attempt at that work, which keeps what was committed
+SKIPPED = ".skipped"
+
+
+def partial_path(final_dir):
+    return f"{os.path.normpath(final_dir)}{PARTIAL_SUFFIX}"
+
+
+def is_committed(final_dir):
+    return os.path.isfile(os.path.join(final_dir, MARKER))
+
+
+def skipped_work(final_dir):
+    try:
+        with open(os.path.join(final_dir, SKIPPED)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return []
+
+
+def record_skipped(partial, items):
+    if items:
+        with open(os.path.join(partial, SKIPPED), "w") as f:
+            json.dump(sorted(items), f)
+
+
+def _link_tree(src, dst):
+    # Hard links where possible: committed files are only ever replaced, never written in place
+    for root, _, files in os.walk(src):
+        rel = os.path.relpath(root, src)
+        os.makedirs(os.path.join(dst, rel), exist_ok=True)
+        for name in files:
+            target = os.path.join(dst, rel, name)
+            if (rel == "." and name in (MARKER, SKIPPED)) or os.path.exists(target):
+                continue
+            try:
+                os.link(os.path.join(root, name), target)
+            except OSError:
+                shutil.copy2(os.path.join(root, name), target)
+
+
+def is_legacy(final_dir):
+    # A folder written before stages were committed: there, unmarked and without a partial (which a crash would leave)
+    return os.path.isdir(final_dir) and not is_committed(final_dir) and not os.path.exists(partial_path(final_dir))
+
+
+def adopt(final_dir):
+    # Commits a legacy folder as it is
+    _mark(os.path.join(final_dir, MARKER))
+    logger.info("adopted %s as committed", final_dir)
+
+
+def _mark(path):
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def _swap(partial, final_dir):
+    # The partial already carries its marker, so a crash in between is finished by the next _swap
+    if os.path.exists(final_dir):
+        shutil.rmtree(final_dir)
+    os.rename(partial, final_dir)
+
+
+def finish_commits(final_dirs):
+    for final_dir in final_dirs:
+        partial = partial_path(final_dir)
+        if is_committed(partial):
+            _swap(partial, final_dir)
+
+
+@contextmanager
+def staged_dirs(final_dirs, force=False, resume=False, scratch=None):
+    # Yields one <dir>.partial sibling per output folder to write into, or None when every folder is committed.
+    # On a clean exit all partials are marked, then renamed over their final folders. When the block raises
+    # (or the process dies) nothing is committed; resume=True keeps a partial's content for the next attempt, and
+    # starts a reopened folder (committed with skipped work) from its committed content.
+    # With a scratch tier (evaluation.scratch) the partials are on local disk and copied back at commit.
+    if force:
+        for path in final_dirs:
+            local = [scratch.partial_dir(path), scratch.local_dir(path)] if scratch is not None else []
+            for p in [path, partial_path(path)] + local:
+                if os.path.exists(p):
+                    shutil.rmtree(p)
+    finish_commits(final_dirs)
+    if all(is_committed(path) and not skipped_work(path) for path in final_dirs):
+        logger.info("skipping result creation, %s already committed", ", ".join(os.path.basename(p) for p in final_dirs))
+        # Local partials left by a commit interrupted after its copy-back
+        for path in final_dirs if scratch is not None else []:
+            shutil.rmtree(scratch.partial_dir(path), ignore_errors=True)
+        yield None
+        return
+
+    partials = [scratch.partial_dir(path) if scratch is not None else partial_path(path) for path in final_dirs]
+    for partial in partials:
+        if not resume and os.path.exists(partial):
+            shutil.rmtree(partial)
+        os.makedirs(partial, exist_ok=True)
+    if resume:
+        for partial, path in zip(partials, final_dirs):
+            if is_committed(path):
+                _link_tree((scratch.cached(path) if scratch is not None else None) or path, partial)
+    yield partials
+    for partial in partials:
+        _mark(os.path.join(partial, MARKER))
+    # Every folder is back next to its final one before the first swap, and the local partials are only cached
+    # after the last one, so an interrupted commit is finished from the shared partials (finish_commits)
+    shared = [scratch.copy_back(partial, final_dir) for partial, final_dir in zip(partials, final_dirs)] \
+        if scratch is not None else partials
+    for partial, final_dir in zip(shared, final_dirs):
+        _swap(partial, final_dir)
+    if scratch is not None:
+        for partial, final_dir in zip(partials, final_dirs):
+            scratch.cache(partial, final_dir)
+
+
+@contextmanager
+def staged_dir(final_dir, force=False, resume=False, scratch=None):
+    with staged_dirs([final_dir], force, resume, scratch) as partials:
+        yield partials[0] if partials else None
+
+
+def step_marker(folder, step):
+    return os.path.join(folder, f".{step}{MARKER}")
+
+
+def is_step_done(folder, step):
+    return os.path.isfile(step_marker(folder, step))
+
+
+def mark_step(folder, step):
+    os.makedirs(folder, exist_ok=True)
+    _mark(step_marker(folder, step))
+
+
+def clear_step(folder, step):
+    if is_step_done(folder, step):
+        os.remove(step_marker(folder, step))
+
+
+def replace_file(src, dst):
+    # Copy next to dst, then rename over it, so dst is always either the old or the new content
+    tmp = f"{dst}.tmp"
+    shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
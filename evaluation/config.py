@@ -1,5 +1,5 @@
 from dataclasses import dataclass, field
-from typing import List
+from typing import List, Optional
 import os
 
 
@@ -13,6 +13,78 @@ class EvaluationConfig:
     # Change Set 3: where we are adding new organs for totalsegmentator to be segmented
     use_extended_ts_organs: bool = False
     crop_colon: bool = True
+    # VF storage format: "nrrd" keeps plastimatch's float32 output, "float16"/"int16" store chunked, compressed .vfz files
+    vf_storage: str = "nrrd"
+    vf_chunk_slices: int = 16
+    # Compressed VFs whose max displacement error exceeds this (mm) are discarded and the float32 NRRD is kept
+    vf_max_error_mm: float = 0.05
+    # VF quality metrics (Jacobian determinant, folding, displacement percentiles) computed while warping
+    vf_quality: bool = True
+    # 0 computes the metrics on the whole VF, otherwise in z-slabs of this many slices to bound memory
+    vf_quality_chunk_slices: int = 0
+    # Jacobian determinant maps (JAC_<tag>.nrrd) are written into the warps folder, committed with the warps
+    save_jacobian_maps: bool = False
+    # Fused CBCT preprocessing: raw CBCT + Slicer affine + pw-linear HU curve (+ optional FOV crop) in one resample
+    fused_preprocessing: bool = False
+    # HU threshold (after the pw-linear mapping) defining the CBCT FOV to crop to, None keeps the full volume
+    cbct_fov_threshold: Optional[float] = None
+    # Decode the CT/CBCT/generated CT DICOM series once per patient (multithreaded) into <patient>/.series/<series>.nii,
+    # shared by all variants and rebuilt when the series' files change; later stages and the params files read that volume
+    cache_series: bool = False
+    series_decode_threads: int = 0
+    # Store each TotalSegmentator output (and its uncropped copy) as one uint8 label map with a JSON label table
+    # instead of one NRRD per structure; per-structure files are exported only where plastimatch and the croppers need them
+    compact_segments: bool = False
+    # Z-slab streaming for HU mapping, z-cropping, bounding-box scans and mask resampling, bounded by stream_memory_mb
+    streaming: bool = False
+    stream_memory_mb: int = 512
+    # Patients processed concurrently, each stage is admitted under the RAM (MB) / CPU budgets (0 = 80% of RAM / all cores)
+    workers: int = 1
+    ram_budget_mb: int = 0
+    cpu_budget: int = 0
+    # Threads shared by all patients for per-structure work inside a stage (dmaps, cxt -> fcsv, VF loads -> warps), 0 = all cores
+    structure_workers: int = 0
+    # Read the input files of the next N patients into the page cache while the current ones compute (0 = off),
+    # keeping at most prefetch_budget_mb read ahead of the patients not started yet
+    prefetch_patients: int = 0
+    prefetch_budget_mb: int = 2048
+    # Header-only check of the inputs the pending stages need before anything runs: patients with missing images are
+    # skipped, registration tags / warps with missing, empty or misplaced contours, empty TS masks or missing FDMs too
+    preflight: bool = False
+    # Treat stage folders written before stages were committed (no .complete marker, no .partial) as committed and mark them
+    adopt_legacy: bool = False
+    # Select patients, detect GT (patients_with_GT) and size the plan from the cohort manifest (MANIFEST_PATH),
+    # rescanning only the patients whose folders changed
+    use_manifest: bool = False
+    # Fast QA preview: CT/CBCT series and GT contours downsampled in-plane by preview_factor, TotalSegmentator's fast
+    # model and a single coarse B-spline stage; main.py runs it as variant <variant>_preview so outputs stay separate
+    preview: bool = False
+    preview_factor: int = 4
+    # Local scratch tier (SSD/tmpfs) for the registration and warp stages: their folders are written under scratch_dir and,
+    # at commit, only the scratch_durable folders are copied back to eval_<variant> (the others are committed empty).
+    # Committed copies stay on scratch as a read cache (the warps read their VFs there), least recently used evicted
+    # above scratch_cap_mb. Empty scratch_dir writes everything next to the patient data
+    scratch_dir: str = ""
+    scratch_cap_mb: int = 20480
+    scratch_durable: List[str] = field(default_factory=lambda: ["VFs", "warps"])
+    # Print the N slowest stages and patients at the end of evaluate (0 = off), the JSONL trace is always written
+    profile_top: int = 0
+    # Plastimatch executor: concurrent commands (0 = all cores), per-command timeouts (s) and retries of
+    # commands killed by a signal, with exponential backoff starting at plastimatch_backoff_s
+    plastimatch_concurrency: int = 0
+    plastimatch_timeout_s: int = 3600
+    register_timeout_s: int = 6 * 3600
+    plastimatch_retries: int = 2
+    plastimatch_backoff_s: float = 5.0
+    # Logging: level of log_<variant>.txt and patients/<patient>.log, level shown on the console besides
+    # the per-stage progress lines, and rotation size (MB) / number of rotated files kept
+    log_level: str = "INFO"
+    console_log_level: str = "WARNING"
+    log_max_mb: int = 50
+    log_backups: int = 3
+    # Set in worker/shard mode: the results store, ledger, cost model and score tables go to RESULTS_DIR/partitions/<partition>
+    # (combined by --merge) and logs/traces to structures_tables_<variant>/partitions/<partition>, so nodes never write the same file
+    partition: str = ""
 
     # a new variable: patient prefix and which dataset (MGH or PRD)
     VARIANT_TAG: str = "baseline"
@@ -48,6 +120,8 @@ class EvaluationConfig:
     patients_with_GT: List = field(default_factory= lambda: ["001","002", "007", "009", "010", "012", "016", "018", "020","023"])
     CT_DIR = "CT"
     CBCT_DIR = "CBCT"
+    RAW_CBCT_DIR = "CBCT_raw"
+    PREPROCESSED_CBCT_FILENAME = "LT_CBCT_preprocessed.nrrd"
     GT_CONTOURS_DIR = "GT_contours"
     FDMS_DIR = "FDMs"
     FCVS = "fcsvs"
@@ -78,6 +152,20 @@ class EvaluationConfig:
     def WARPS_DIR(self): return self.get_subdir("warps")
     @property
     def SCORES_DIR(self): return self.get_subdir("scores")
+    @property
+    def PREVIEW_DIR(self): return self.get_subdir("preview")
+
+    def results_path(self, path):
+        # A shared results file (COST_MODEL_PATH, LEDGER_PATH, RESULTS_STORE_PATH), this partition's own copy in worker/shard mode
+        if not self.partition:
+            return path
+        return os.path.join(self.PARTITIONS_DIR, self.partition, os.path.basename(path))
+
+    def gt_contours_dir(self, image):
+        # GT contours of an image (CT_DIR/CBCT_DIR) relative to the patient folder, their downsampled copies in preview mode
+        if self.preview:
+            return os.path.join(self.PREVIEW_DIR, self.GT_CONTOURS_DIR, image)
+        return os.path.join(self.GT_CONTOURS_DIR, image)
         
     TS = "TS"
     GT = "GT"
@@ -85,13 +173,24 @@ class EvaluationConfig:
     GT_BLADDER_ONLY = "GT_bladder_only"
     GT_BLADDER_RECTUM_ONLY: str = "GT_bladder_rectum_only"
     VF_PREFIX = "VF_"
+    VF_CACHE_DIR = ".cache"
+    SERIES_CACHE_DIR = ".series"
+    JAC_PREFIX = "JAC_"
     WARP_PREFIX = "W_"
     AFFINE_TRANSFORM_FILENAME = "LinearTransform.txt"
+    LINEAR_TRANSFORMS_DIR = os.path.join(os.path.curdir, "LineraTransforms")
     PATIENT_NUM_KEY = "Patient #"
     RESULTS_DIR = os.path.join(os.path.curdir, "results")
+    COST_MODEL_PATH = os.path.join(RESULTS_DIR, "cost_model.json")
+    LEDGER_PATH = os.path.join(RESULTS_DIR, "ledger.sqlite")
+    RESULTS_STORE_PATH = os.path.join(RESULTS_DIR, "results.sqlite")
+    MANIFEST_PATH = os.path.join(RESULTS_DIR, "manifest.json")
+    PARTITIONS_DIR = os.path.join(RESULTS_DIR, "partitions")
     DICE_CSV_FILENAME = "dice.csv"
     HD_CSV_FILENAME = "hd.csv"
     FD_SEP_CSV_FILENAME = "fd-sep.csv"
+    VF_QUALITY_CSV_FILENAME = "vf_quality.csv"
+    REGISTRATION_KEY = "Registration"
     LAMBDA = 10000
 
     # LUT = {
@@ -0,0 +1,188 @@
+import os
+import re
+import time
+import signal
+import logging
+import asyncio
+import threading
+import itertools
+import tempfile
+import subprocess
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from evaluation.resources import CommandUsage, current_monitor
+
+logger = logging.getLogger(__name__)
+
+
+class CommandTimeout(subprocess.TimeoutExpired):
+    pass
+
+
+class PlastimatchExecutor:
+    # Runs plastimatch commands on a private asyncio loop shared by every calling thread.
+    # A semaphore on that loop is the global concurrency limit; each command's stdout/stderr
+    # stream to its own log files, and the child is reaped with wait4() so its rusage still
+    # reaches the calling stage's ResourceMonitor.
+    def __init__(self, max_concurrency=0, timeout_s=3600, retries=2, backoff_s=5.0, log_dir=None) -> None:
+        self.max_concurrency = max_concurrency or os.cpu_count() or 1
+        self.timeout_s = timeout_s
+        self.retries = retries
+        self.backoff_s = backoff_s
+        self.log_dir = log_dir
+        self._counter = itertools.count(1)
+        self._loop = None
+        self._thread = None
+        self._semaphore = None
+        self._start_lock = threading.Lock()
+
+    def _ensure_loop(self):
+        with self._start_lock:
+            if self._loop is not None:
+                return self._loop
+            self._loop = asyncio.new_event_loop()
+            self._loop.set_default_executor(ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix="plastimatch"))
+            ready = threading.Event()
+
+            def serve():
+                asyncio.set_event_loop(self._loop)
+                self._semaphore = asyncio.Semaphore(self.max_concurrency)
+                ready.set()
+                self._loop.run_forever()
+
+            self._thread = threading.Thread(target=serve, name="plastimatch-loop", daemon=True)
+            self._thread.start()
+            ready.wait()
+            return self._loop
+
+    def close(self):
+        with self._start_lock:
+            if self._loop is None:
+                return
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop.close()
+            self._loop = None
+
+    def _log_stem(self, command, monitor):
+        with self._start_lock:
+            if self.log_dir is None:
+                self.log_dir = tempfile.mkdtemp(prefix="plastimatch_logs_")
+        tags = [monitor.usage.patient, monitor.usage.stage] if monitor is not None else []
+        name = os.path.basename(str(command[1])) if len(command) > 1 else "plastimatch"
+        stem = "_".join([f"{next(self._counter):05d}"] + [t for t in tags if t] + [re.sub(r"[^\w.-]", "_", name)])
+        os.makedirs(self.log_dir, exist_ok=True)
+        return os.path.join(self.log_dir, stem)
+
+    def _log_paths(self, stem, attempt):
+        # One pair per attempt, so a retry never overwrites the log of the attempt that failed
+        return f"{stem}.attempt{attempt + 1}.stdout.log", f"{stem}.attempt{attempt + 1}.stderr.log"
+
+    def _run_blocking(self, command, stdout_path, stderr_path, started):
+        # Runs in the loop's thread pool: spawn, reap with wait4(), return (returncode, CommandUsage)
+        stdout, stderr = open(stdout_path, "w"), open(stderr_path, "w")
+        try:
+            start_time, start = time.time(), time.perf_counter()
+            proc = subprocess.Popen(command, stdout=stdout, stderr=stderr)
+            started(proc)
+            _, status, rusage = os.wait4(proc.pid, 0)
+            proc.returncode = os.waitstatus_to_exitcode(status)
+        finally:
+            stdout.close()
+            stderr.close()
+        return proc.returncode, CommandUsage(
+            command=[str(c) for c in command],
+            returncode=proc.returncode,
+            start_time=start_time,
+            wall_s=time.perf_counter() - start,
+            cpu_s=rusage.ru_utime + rusage.ru_stime,
+            peak_rss_mb=rusage.ru_maxrss / 1024,
+            read_bytes=rusage.ru_inblock * 512,
+            write_bytes=rusage.ru_oublock * 512,
+        )
+
+    async def _attempt(self, command, timeout, stdout_path, stderr_path, usages):
+        loop = asyncio.get_running_loop()
+        # The timeout can fire before the pool thread has spawned the child: whichever side comes second kills it
+        lock, procs, timed_out = threading.Lock(), [], []
+
+        def started(proc):
+            with lock:
+                procs.append(proc)
+                if timed_out:
+                    proc.send_signal(signal.SIGKILL)
+
+        future = loop.run_in_executor(None, self._run_blocking, command, stdout_path, stderr_path, started)
+        try:
+            returncode, usage = await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError:
+            with lock:
+                timed_out.append(True)
+                if procs:
+                    procs[0].send_signal(signal.SIGKILL)
+            _, usage = await future
+            usages.append(usage)
+            raise CommandTimeout(command, timeout)
+        usages.append(usage)
+        return returncode
+
+    async def _run(self, command, timeout, monitor):
+        # Killed by a signal or failing to spawn (other than a missing/unrunnable binary) counts as transient and is retried with exponential backoff;
+        # a non-zero exit code or a timeout is final
+        stem = self._log_stem(command, monitor)
+        usages = []
+        async with self._semaphore:
+            for attempt in range(self.retries + 1):
+                stdout_path, stderr_path = self._log_paths(stem, attempt)
+                try:
+                    returncode = await self._attempt(command, timeout, stdout_path, stderr_path, usages)
+                except CommandTimeout:
+                    return None, usages, stdout_path, stderr_path
+                except (FileNotFoundError, PermissionError):
+                    raise
+                except OSError as e:
+                    if attempt == self.retries:
+                        raise
+                    logger.warning("[RETRY] %s failed to start (%s), attempt %s/%s", command[:2], e, attempt + 2, self.retries + 1)
+                else:
+                    if returncode >= 0 or attempt == self.retries:
+                        return returncode, usages, stdout_path, stderr_path
+                    logger.warning("[RETRY] %s killed by signal %s (see %s), attempt %s/%s", command[:2], -returncode, stderr_path,
+                                   attempt + 2, self.retries + 1)
+                await asyncio.sleep(self.backoff_s * 2 ** attempt)
+
+    def _finish(self, command, timeout, outcome, monitor):
+        returncode, usages, stdout_path, stderr_path = outcome
+        if monitor is not None:
+            for usage in usages:
+                monitor.record(usage)
+        if returncode is None:
+            raise CommandTimeout(command, timeout, stderr=stderr_path)
+        with open(stdout_path) as f:
+            stdout = f.read()
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, command, stdout, f"see {stderr_path}")
+        return subprocess.CompletedProcess(command, returncode, stdout=stdout)
+
+    def run(self, command, timeout=None):
+        # Blocking call from any thread, returns CompletedProcess with stdout read back from the log file
+        return self.run_batch([(command, timeout)])[0].result()
+
+    def run_batch(self, calls):
+        # calls: [(command, timeout or None)]; all are submitted at once and awaited together.
+        # Returns one concurrent.futures.Future per call, already completed.
+        loop = self._ensure_loop()
+        monitor = current_monitor()
+        futures = [
+            asyncio.run_coroutine_threadsafe(self._run(command, timeout or self.timeout_s, monitor), loop)
+            for command, timeout in calls
+        ]
+        results = []
+        for (command, timeout), future in zip(calls, futures):
+            result = Future()
+            try:
+                result.set_result(self._finish(command, timeout or self.timeout_s, future.result(), monitor))
+            except Exception as e:
+                result.set_exception(e)
+            results.append(result)
+        return results
@@ -1,12 +1,11 @@
 import re
+import logging
 import argparse
 
-def create_fcsv(cxt_filepath, fcsv_filepath, csv_filepath):
-    
-    cxt_file = open(cxt_filepath, 'r')
-    fcsv_file = open(fcsv_filepath, "w")
-    csv_file = open(csv_filepath, "w")
-    metadata = """# numPoints = 4
+logger = logging.getLogger(__name__)
+
+# Slicer markups header of the fcsv files written from cxt contours and point sets
+FCSV_HEADER = """# numPoints = 4
 # symbolScale = 5
 # symbolType = 12
 # visibility = 1
@@ -22,19 +21,25 @@ def create_fcsv(cxt_filepath, fcsv_filepath, csv_filepath):
 # numberingScheme = 0
 # columns = label,x,y,z,sel,vis
     """
+
+def create_fcsv(cxt_filepath, fcsv_filepath, csv_filepath):
+    
+    cxt_file = open(cxt_filepath, 'r')
+    fcsv_file = open(fcsv_filepath, "w")
+    csv_file = open(csv_filepath, "w")
     count = 0
     regex = r"[+-]?\d+(?:\.\d+)?"
-    fcsv_file.write(metadata)
+    fcsv_file.write(FCSV_HEADER)
     cxt_contents = cxt_file.readlines()
     OG = cxt_contents[7].split()
     ox, oy, oz = float(OG[1]), float(OG[2]), float(OG[3])
 
     SP = cxt_contents[9].split()
     spx, spy, spz = float(SP[1]), float(SP[1]), float(SP[1])
-    print(SP)
+    logger.debug("CXT spacing: %s", SP)
 
     cxt_contents = cxt_contents[28:]
-    print(len(cxt_contents))
+    logger.debug("%s contour lines in %s", len(cxt_contents), cxt_filepath)
 
     for cxt_content in cxt_contents:
         cxt_content = cxt_content[10:].split("\\")
@@ -57,7 +62,7 @@ def create_fcsv(cxt_filepath, fcsv_filepath, csv_filepath):
     fcsv_file.close()
     csv_file.close()
     cxt_file.close()
-    print(count)
+    logger.debug("%s points written to %s", count, fcsv_filepath)
 
 
 if __name__=="__main__":
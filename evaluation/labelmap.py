@@ -0,0 +1,131 @@
+import os
+import json
+import glob
+import logging
+import numpy as np
+import SimpleITK as sitk
+
+logger = logging.getLogger(__name__)
+
+# Hidden, so the glob("<seg dir>/*") of the dmap/cxt stages and the score calculation skip them
+LABELMAP_FILENAME = ".labelmap.nrrd"
+LABELS_FILENAME = ".labelmap.json"
+
+
+def labelmap_paths(seg_dir):
+    return os.path.join(seg_dir, LABELMAP_FILENAME), os.path.join(seg_dir, LABELS_FILENAME)
+
+
+def has_labelmap(seg_dir) -> bool:
+    return all(os.path.exists(p) for p in labelmap_paths(seg_dir))
+
+
+def _structure_name(path):
+    name = os.path.basename(path)
+    for suffix in (".nii.gz", ".nrrd", ".mha"):
+        name = name.removesuffix(suffix)
+    return name
+
+
+def pack_segments(seg_dir, remove=True):
+    # Packs the per-structure masks of seg_dir (TotalSegmentator .nii.gz or .nrrd, all on one grid) into a
+    # uint8 label volume plus a JSON label table. TotalSegmentator classes don't overlap; where masks do,
+    # the later structure wins and the overlap is logged.
+    mask_paths = sorted(glob.glob(os.path.join(seg_dir, "*.nii.gz")) + glob.glob(os.path.join(seg_dir, "*.nrrd")))
+    if not mask_paths:
+        raise FileNotFoundError(f"No segment masks to pack in {seg_dir}")
+    if len(mask_paths) > 255:
+        raise ValueError(f"{len(mask_paths)} structures in {seg_dir}, a uint8 label map holds at most 255")
+
+    reference, labels, voxels = None, {}, {}
+    for label, path in enumerate(mask_paths, start=1):
+        image = sitk.ReadImage(path)
+        mask = sitk.GetArrayViewFromImage(image) > 0
+        if reference is None:
+            reference = image
+            label_array = np.zeros(mask.shape, dtype=np.uint8)
+        elif mask.shape != label_array.shape:
+            raise ValueError(f"{path} is not on the grid of {mask_paths[0]}")
+        overlap = int(np.count_nonzero(label_array[mask]))
+        if overlap:
+            logger.warning("%s overlaps earlier structures in %s voxels, the overlap is assigned to it", path, overlap)
+        label_array[mask] = label
+        name = _structure_name(path)
+        labels[name] = label
+        voxels[name] = int(np.count_nonzero(mask))
+
+    labelmap = sitk.GetImageFromArray(label_array)
+    labelmap.CopyInformation(reference)
+    labelmap_path, labels_path = labelmap_paths(seg_dir)
+    sitk.WriteImage(labelmap, labelmap_path, True)
+    with open(labels_path, "w") as f:
+        json.dump({"labels": labels, "voxels": voxels}, f, indent=2)
+    if remove:
+        for path in mask_paths:
+            os.remove(path)
+    return labelmap_path
+
+
+class LabelMap:
+    # Read access to a packed segmentation: single-structure views in memory, or per-structure NRRD
+    # exports for tools (plastimatch, the croppers) that only read files
+    def __init__(self, seg_dir) -> None:
+        self.seg_dir = seg_dir
+        labelmap_path, labels_path = labelmap_paths(seg_dir)
+        with open(labels_path) as f:
+            table = json.load(f)
+        self.labels = table["labels"]
+        self.voxels = table.get("voxels", {})
+        self._path = labelmap_path
+        self._image = None
+
+    @property
+    def names(self):
+        return list(self.labels)
+
+    def image(self) -> sitk.Image:
+        # Decoded once, every view and export reuses it
+        if self._image is None:
+            self._image = sitk.ReadImage(self._path)
+        return self._image
+
+    def mask(self, name) -> sitk.Image:
+        # uint8 0/1 mask of one structure on the label map's grid
+        mask = sitk.Equal(self.image(), self.labels[name])
+        return sitk.Cast(mask, sitk.sitkUInt8)
+
+    def export(self, out_dir, names=None):
+        # <out_dir>/<name>.nrrd for each structure (all by default), each written next to its target then
+        # renamed, so a crash never leaves a truncated mask behind
+        os.makedirs(out_dir, exist_ok=True)
+        paths = []
+        for name in names or self.names:
+            path = os.path.join(out_dir, f"{name}.nrrd")
+            tmp = os.path.join(out_dir, f".{name}.tmp.nrrd")
+            sitk.WriteImage(self.mask(name), tmp)
+            os.replace(tmp, path)
+            paths.append(path)
+        return paths
+
+
+def link_labelmap(src_dir, dst_dir, link_or_copy):
+    os.makedirs(dst_dir, exist_ok=True)
+    for src, dst in zip(labelmap_paths(src_dir), labelmap_paths(dst_dir)):
+        link_or_copy(src, dst)
+
+
+if __name__=="__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Pack a folder of per-structure masks into a label map, or export it back")
+    parser.add_argument("seg_dir", type=str, help="segmentation folder")
+    parser.add_argument("--export", type=str, default=None, help="write per-structure .nrrd files to this folder instead of packing")
+    parser.add_argument("--keep", action="store_true", help="keep the per-structure masks after packing")
+
+    args = parser.parse_args()
+    if args.export:
+        for path in LabelMap(args.seg_dir).export(args.export):
+            print(path)
+    else:
+        before = sum(os.path.getsize(p) for p in glob.glob(os.path.join(args.seg_dir, "*.n*")))
+        labelmap_path = pack_segments(args.seg_dir, remove=not args.keep)
+        print(f"{labelmap_path}: {before} -> {os.path.getsize(labelmap_path)} bytes")
@@ -0,0 +1,196 @@
+import os
+import sys
+import json
+import socket
+import sqlite3
+import hashlib
+import argparse
+import subprocess
+import dataclasses
+from datetime import datetime
+from uuid import uuid4
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id TEXT PRIMARY KEY,
+    started_at TEXT,
+    variant TEXT,
+    git_rev TEXT,
+    git_dirty INTEGER,
+    config_fingerprint TEXT,
+    config_json TEXT,
+    host TEXT,
+    patients INTEGER
+);
+CREATE TABLE IF NOT EXISTS stages (
+    run_id TEXT REFERENCES runs(run_id),
+    patient TEXT,
+    stage TEXT,
+    wall_s REAL,
+    cpu_s REAL,
+    peak_rss_mb REAL,
+    read_bytes INTEGER,
+    write_bytes INTEGER,
+    commands INTEGER,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS stages_run ON stages(run_id);
+"""
+
+
+def git_revision(repo_dir=None):
+    # (revision, dirty) of the checkout the pipeline runs from, ("unknown", False) outside git
+    repo_dir = repo_dir or os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        rev = subprocess.run(["git", "rev-parse", "HEAD"], cwd=repo_dir, stdout=subprocess.PIPE,
+                             stderr=subprocess.DEVNULL, text=True, check=True).stdout.strip()
+        status = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=repo_dir,
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, check=True).stdout
+        return rev, bool(status.strip())
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown", False
+
+
+def config_fingerprint(configs):
+    config_json = json.dumps(dataclasses.asdict(configs), sort_keys=True, default=str)
+    return hashlib.sha1(config_json.encode()).hexdigest()[:12], config_json
+
+
+class Ledger:
+    def __init__(self, path) -> None:
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path)
+        self._conn.executescript(SCHEMA)
+
+    def close(self):
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def record_run(self, configs, events, started_at=None):
+        # Stores the stage events of one evaluate() call, returns the new run id
+        run_id = datetime.now().strftime("%Y%m%d-%H%M%S") + "-" + str(uuid4())[:4]
+        rev, dirty = git_revision()
+        fingerprint, config_json = config_fingerprint(configs)
+        stages = [e for e in events if e["event"] == "stage"]
+        with self._conn:
+            self._conn.execute(
+                "INSERT INTO runs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (run_id, started_at or datetime.now().isoformat(timespec="seconds"), configs.VARIANT_TAG, rev, int(dirty),
+                 fingerprint, config_json, socket.gethostname(), len({e["patient"] for e in stages}))
+            )
+            self._conn.executemany(
+                "INSERT INTO stages VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [(run_id, e["patient"], e["stage"], e["wall_s"], e["cpu_s"], e["peak_rss_mb"],
+                  e["read_bytes"], e["write_bytes"], e["commands"], e["error"]) for e in stages]
+            )
+        return run_id
+
+    def merge(self, path):
+        # Copies the runs of another ledger (a partition's) that this one doesn't have yet, with their stages
+        self._conn.execute("ATTACH DATABASE ? AS other", (path,))
+        try:
+            run_ids = [(r[0],) for r in self._conn.execute(
+                "SELECT run_id FROM other.runs WHERE run_id NOT IN (SELECT run_id FROM runs)").fetchall()]
+            with self._conn:
+                self._conn.executemany("INSERT INTO runs SELECT * FROM other.runs WHERE run_id = ?", run_ids)
+                self._conn.executemany("INSERT INTO stages SELECT * FROM other.stages WHERE run_id = ?", run_ids)
+        finally:
+            self._conn.execute("DETACH DATABASE other")
+        return len(run_ids)
+
+    def resolve(self, selector):
+        # A run id (or unique prefix) selects one run, a git revision prefix selects every run at that revision
+        rows = self._conn.execute("SELECT run_id FROM runs WHERE run_id LIKE ?", (f"{selector}%",)).fetchall()
+        if len(rows) == 1:
+            return [rows[0][0]]
+        rows = self._conn.execute("SELECT run_id FROM runs WHERE git_rev LIKE ?", (f"{selector}%",)).fetchall()
+        if not rows:
+            raise ValueError(f"No run or revision matches '{selector}'")
+        return [r[0] for r in rows]
+
+    def timings(self, run_ids, by_patient=False):
+        # Mean wall/cpu/peak per stage (or per stage and patient) over the selected runs, failed stages excluded
+        keys = "stage, patient" if by_patient else "stage"
+        marks = ",".join("?" * len(run_ids))
+        rows = self._conn.execute(
+            f"SELECT {keys}, AVG(wall_s), AVG(cpu_s), MAX(peak_rss_mb), COUNT(*) FROM stages "
+            f"WHERE run_id IN ({marks}) AND error IS NULL GROUP BY {keys}", run_ids
+        ).fetchall()
+        if by_patient:
+            return {(r[0], r[1]): r[2:] for r in rows}
+        return {r[0]: r[1:] for r in rows}
+
+    def runs(self, variant=None):
+        query = ("SELECT r.run_id, r.started_at, r.variant, substr(r.git_rev, 1, 10), r.git_dirty, r.config_fingerprint, "
+                 "r.patients, SUM(s.wall_s) FROM runs r LEFT JOIN stages s ON s.run_id = r.run_id")
+        params = ()
+        if variant:
+            query += " WHERE r.variant = ?"
+            params = (variant,)
+        return self._conn.execute(query + " GROUP BY r.run_id ORDER BY r.started_at", params).fetchall()
+
+    def trend(self, stage, variant=None):
+        query = ("SELECT r.run_id, r.started_at, substr(r.git_rev, 1, 10), AVG(s.wall_s), MAX(s.peak_rss_mb), COUNT(*) "
+                 "FROM runs r JOIN stages s ON s.run_id = r.run_id WHERE s.stage = ? AND s.error IS NULL")
+        params = [stage]
+        if variant:
+            query += " AND r.variant = ?"
+            params.append(variant)
+        return self._conn.execute(query + " GROUP BY r.run_id ORDER BY r.started_at", params).fetchall()
+
+
+def compare(ledger, base, head, threshold=0.1, min_seconds=1.0, by_patient=False):
+    # Rows of (key, base wall, head wall, change, regression) for keys present in both selections
+    base_timings = ledger.timings(ledger.resolve(base), by_patient)
+    head_timings = ledger.timings(ledger.resolve(head), by_patient)
+    rows = []
+    for key in sorted(set(base_timings) & set(head_timings)):
+        base_wall, head_wall = base_timings[key][0], head_timings[key][0]
+        change = (head_wall - base_wall) / base_wall if base_wall > 0 else 0.0
+        regression = change > threshold and head_wall - base_wall > min_seconds
+        rows.append((key, base_wall, head_wall, change, regression))
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pipeline performance ledger")
+    parser.add_argument("--ledger", type=str, default=os.path.join(os.path.curdir, "results", "ledger.sqlite"), help="ledger database")
+    commands = parser.add_subparsers(dest="command", required=True)
+    p = commands.add_parser("runs", help="list recorded runs")
+    p.add_argument("--variant", type=str, default=None)
+    p = commands.add_parser("trend", help="mean wall time of one stage across runs")
+    p.add_argument("stage", type=str)
+    p.add_argument("--variant", type=str, default=None)
+    p = commands.add_parser("compare", help="diff two runs or two git revisions per stage")
+    p.add_argument("base", type=str, help="run id or git revision (prefix)")
+    p.add_argument("head", type=str, help="run id or git revision (prefix)")
+    p.add_argument("--threshold", type=float, default=0.1, help="relative slowdown flagged as a regression")
+    p.add_argument("--min-seconds", type=float, default=1.0, help="ignore slowdowns smaller than this")
+    p.add_argument("--by-patient", action="store_true", help="compare per stage and patient")
+    args = parser.parse_args()
+
+    with Ledger(args.ledger) as ledger:
+        if args.command == "runs":
+            print(f"{'run':<22}{'started':<21}{'variant':<20}{'revision':<12}{'config':<14}{'patients':>9}{'wall (s)':>10}")
+            for run_id, started_at, variant, rev, dirty, fingerprint, patients, wall_s in ledger.runs(args.variant):
+                print(f"{run_id:<22}{started_at:<21}{variant:<20}{rev + ('*' if dirty else ''):<12}{fingerprint:<14}{patients:>9}{wall_s or 0:>10.1f}")
+        elif args.command == "trend":
+            print(f"{'run':<22}{'started':<21}{'revision':<12}{'mean wall (s)':>14}{'peak (MB)':>11}{'n':>5}")
+            for run_id, started_at, rev, wall_s, peak_rss_mb, count in ledger.trend(args.stage, args.variant):
+                print(f"{run_id:<22}{started_at:<21}{rev:<12}{wall_s:>14.2f}{peak_rss_mb:>11.0f}{count:>5}")
+        else:
+            rows = compare(ledger, args.base, args.head, args.threshold, args.min_seconds, args.by_patient)
+            print(f"{'stage':<28}{'base (s)':>10}{'head (s)':>10}{'change':>9}")
+            for key, base_wall, head_wall, change, regression in rows:
+                label = " / ".join(key) if isinstance(key, tuple) else key
+                print(f"{label:<28}{base_wall:>10.2f}{head_wall:>10.2f}{change:>+9.1%}" + ("  REGRESSION" if regression else ""))
+            regressions = sum(r[4] for r in rows)
+            print(f"{regressions} regression(s) above {args.threshold:.0%} and {args.min_seconds} s")
+            sys.exit(1 if regressions else 0)
@@ -0,0 +1,141 @@
+import os
+import queue
+import logging
+import contextvars
+from contextlib import contextmanager
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+ROOT_LOGGER = "evaluation"
+# Per-stage progress lines, always shown on the console
+PROGRESS_LOGGER = "evaluation.progress"
+FILE_FORMAT = "%(asctime)s %(levelname)-7s [%(variant)s|%(patient)s] %(name)s: %(message)s"
+CONSOLE_FORMAT = "%(asctime)s [%(variant)s|%(patient)s] %(message)s"
+
+_patient = contextvars.ContextVar("log_patient", default="-")
+_variant = contextvars.ContextVar("log_variant", default="-")
+
+
+@contextmanager
+def log_context(patient=None, variant=None):
+    # Tags every record emitted by this thread/task until the block exits
+    tokens = []
+    if patient is not None:
+        tokens.append((_patient, _patient.set(patient)))
+    if variant is not None:
+        tokens.append((_variant, _variant.set(variant)))
+    try:
+        yield
+    finally:
+        for var, token in reversed(tokens):
+            var.reset(token)
+
+
+class ContextFilter(logging.Filter):
+    # Runs in the emitting thread, before the record crosses the queue
+    def filter(self, record):
+        if not hasattr(record, "patient"):
+            record.patient = _patient.get()
+        if not hasattr(record, "variant"):
+            record.variant = _variant.get()
+        return True
+
+
+class ConsoleFilter(logging.Filter):
+    def __init__(self, level) -> None:
+        super().__init__()
+        self.level = level
+
+    def filter(self, record):
+        return record.levelno >= self.level or record.name == PROGRESS_LOGGER
+
+
+class PatientFileHandler(logging.Handler):
+    # One rotating file per patient, opened on the patient's first record
+    def __init__(self, log_dir, max_bytes, backups, level=logging.NOTSET) -> None:
+        super().__init__(level)
+        self.log_dir = log_dir
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self._handlers = {}
+
+    def emit(self, record):
+        patient = getattr(record, "patient", "-")
+        if patient == "-":
+            return
+        handler = self._handlers.get(patient)
+        if handler is None:
+            os.makedirs(self.log_dir, exist_ok=True)
+            handler = RotatingFileHandler(os.path.join(self.log_dir, f"{patient}.log"), maxBytes=self.max_bytes, backupCount=self.backups)
+            handler.setFormatter(self.formatter)
+            self._handlers[patient] = handler
+        handler.emit(record)
+
+    def close(self):
+        for handler in self._handlers.values():
+            handler.close()
+        self._handlers.clear()
+        super().close()
+
+
+def variant_handlers(log_dir, variant, file_level="INFO", console_level="WARNING", max_mb=50, backups=3):
+    # structures_tables_<variant>/log_<variant>.txt, .../patients/<patient>.log and a filtered console handler
+    file_level, console_level = logging.getLevelName(file_level), logging.getLevelName(console_level)
+    max_bytes = max_mb * 1024 * 1024
+    file_formatter = logging.Formatter(FILE_FORMAT)
+
+    variant_file = RotatingFileHandler(os.path.join(log_dir, f"log_{variant}.txt"), maxBytes=max_bytes, backupCount=backups)
+    variant_file.setLevel(file_level)
+    variant_file.setFormatter(file_formatter)
+
+    patient_files = PatientFileHandler(os.path.join(log_dir, "patients"), max_bytes, backups, file_level)
+    patient_files.setFormatter(file_formatter)
+
+    console = logging.StreamHandler()
+    console.setLevel(min(console_level, logging.INFO))
+    console.addFilter(ConsoleFilter(console_level))
+    console.setFormatter(logging.Formatter(CONSOLE_FORMAT, "%H:%M:%S"))
+    return [variant_file, patient_files, console]
+
+
+def attach_queue(log_queue, level):
+    # Routes every `evaluation.*` logger of this process into log_queue; also used in child processes
+    # with a multiprocessing queue so their records reach the parent's listener
+    logger = logging.getLogger(ROOT_LOGGER)
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+        handler.close()
+    handler = QueueHandler(log_queue)
+    handler.addFilter(ContextFilter())
+    logger.addHandler(handler)
+    # Records below every handler's level are dropped at the call site, so disabled debug output costs one check
+    logger.setLevel(level)
+    logger.propagate = False
+
+
+class LogService:
+    # Queue listener owning the real handlers; callers only enqueue records
+    def __init__(self, handlers, log_queue=None) -> None:
+        self.queue = log_queue if log_queue is not None else queue.SimpleQueue()
+        self.handlers = handlers
+        self._listener = QueueListener(self.queue, *handlers, respect_handler_level=True)
+
+    def start(self):
+        attach_queue(self.queue, min(h.level or logging.DEBUG for h in self.handlers))
+        self._listener.start()
+        return self
+
+    def stop(self):
+        self._listener.stop()
+        logger = logging.getLogger(ROOT_LOGGER)
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+        logger.propagate = True
+        for handler in self.handlers:
+            handler.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+        return False
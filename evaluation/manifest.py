@@ -0,0 +1,179 @@
+import os
+import json
+import socket
+import logging
+from dataclasses import dataclass, field, asdict
+from typing import Dict, List, Optional
+
+from evaluation.stages import lazy_import
+from evaluation.utils import Utils
+
+# Only needed when a patient is (re)scanned, an up-to-date manifest is read with the standard library
+sitk = lazy_import("SimpleITK")
+preprocess = lazy_import("evaluation.preprocess")
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_VERSION = 1
+
+
+@dataclass
+class SeriesInfo:
+    files: int
+    bytes: int
+    # Header-only geometry: in-plane size/spacing of the first slice, slice count and spacing from the first and last slice
+    size: Optional[List[int]] = None
+    spacing: Optional[List[float]] = None
+    origin: Optional[List[float]] = None
+
+
+@dataclass
+class PatientEntry:
+    patient_dir: str
+    patient: str
+    # mtimes of the folders whose contents the entry describes, the entry is rescanned when one changes
+    signature: List[int] = field(default_factory=list)
+    series: Dict[str, SeriesInfo] = field(default_factory=dict)
+    # GT contour structure names per image (CT, CBCT)
+    gt_contours: Dict[str, List[str]] = field(default_factory=dict)
+    fdms: List[str] = field(default_factory=list)
+    linear_transform: Optional[str] = None
+
+    @property
+    def has_gt(self):
+        return bool(self.gt_contours.get("CT"))
+
+    def slices(self, series_dir):
+        info = self.series.get(series_dir)
+        return info.size[2] if info and info.size else 0
+
+    @classmethod
+    def from_dict(cls, d):
+        d = dict(d)
+        d["series"] = {name: SeriesInfo(**info) for name, info in d.get("series", {}).items()}
+        return cls(**d)
+
+
+def series_geometry(series_dir):
+    # (size, spacing, origin, direction) from the headers of the first and last slice of the series in GDCM order, no pixel data
+    files = sitk.ImageSeriesReader.GetGDCMSeriesFileNames(series_dir)
+    if not files:
+        raise ValueError(f"No DICOM series in {series_dir}")
+    reader = sitk.ImageFileReader()
+    headers = []
+    for path in (files[0], files[-1]):
+        reader.SetFileName(path)
+        reader.ReadImageInformation()
+        headers.append((reader.GetSize(), reader.GetSpacing(), reader.GetOrigin(), reader.GetDirection()))
+    (size, spacing, origin, direction), (_, _, last_origin, _) = headers
+    z_spacing = spacing[2]
+    if len(files) > 1:
+        z_spacing = sum((a - b) ** 2 for a, b in zip(last_origin, origin)) ** 0.5 / (len(files) - 1)
+    return [size[0], size[1], len(files)], [spacing[0], spacing[1], z_spacing], list(origin), list(direction)
+
+
+class Manifest:
+    # Index of a cohort: per patient the series (with header-only geometry and sizes), GT contours, FDMs and
+    # LinearTransform file that exist, stored as JSON. refresh() rescans only the patients whose folders changed.
+    def __init__(self, path, configs) -> None:
+        self.path = path
+        self.configs = configs
+        self.entries: Dict[str, PatientEntry] = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                data = json.load(f)
+            if data.get("version") == MANIFEST_VERSION:
+                self.entries = {e["patient_dir"]: PatientEntry.from_dict(e) for e in data["patients"]}
+
+    def watched(self, patient_dir):
+        # Input folders whose mtime changes when a series, contour, FDM or transform file is added or removed. The
+        # patient folder itself is not watched, the pipeline's outputs (eval_<variant>, caches) change its mtime;
+        # the transform exported next to the patient is watched as a file instead
+        c = self.configs
+        folders = [c.GT_CONTOURS_DIR, os.path.join(c.GT_CONTOURS_DIR, c.CT_DIR),
+                   os.path.join(c.GT_CONTOURS_DIR, c.CBCT_DIR), c.FDMS_DIR,
+                   c.CT_DIR, c.CBCT_DIR, c.RAW_CBCT_DIR, c.GENERATED_CT_DIR]
+        patient_transform = f"{os.path.basename(os.path.normpath(patient_dir)).split('-')[-1]}-{c.AFFINE_TRANSFORM_FILENAME}"
+        return [os.path.join(patient_dir, f) for f in folders + [patient_transform]] + [c.LINEAR_TRANSFORMS_DIR]
+
+    def signature(self, patient_dir):
+        signature = []
+        for path in self.watched(patient_dir):
+            try:
+                signature.append(os.stat(path).st_mtime_ns)
+            except OSError:
+                signature.append(0)
+        return signature
+
+    def scan(self, patient_dir, signature) -> PatientEntry:
+        c = self.configs
+        entry = PatientEntry(patient_dir, Utils(c).get_patient_number(patient_dir), signature)
+        for series_dir in (c.CT_DIR, c.CBCT_DIR, c.RAW_CBCT_DIR, c.GENERATED_CT_DIR):
+            path = os.path.join(patient_dir, series_dir)
+            if not os.path.isdir(path):
+                continue
+            files = [os.path.join(path, f) for f in os.listdir(path)]
+            info = SeriesInfo(len(files), sum(os.path.getsize(f) for f in files))
+            try:
+                info.size, info.spacing, info.origin, _ = series_geometry(path)
+            except Exception as e:
+                logger.warning("[MANIFEST] No geometry for %s: %s", path, e)
+            entry.series[series_dir] = info
+        for image in (c.CT_DIR, c.CBCT_DIR):
+            path = os.path.join(patient_dir, c.GT_CONTOURS_DIR, image)
+            if os.path.isdir(path):
+                entry.gt_contours[image] = sorted(os.path.splitext(f)[0] for f in os.listdir(path) if f.endswith(".mha"))
+        fdms_dir = os.path.join(patient_dir, c.FDMS_DIR)
+        if os.path.isdir(fdms_dir):
+            entry.fdms = sorted(os.listdir(fdms_dir))
+        entry.linear_transform = preprocess.find_linear_transform(patient_dir, c)
+        return entry
+
+    def refresh(self, patient_dirs) -> List[PatientEntry]:
+        # Entries of the given patient folders, sorted by patient number; saved when any entry was (re)scanned
+        entries, scanned = [], 0
+        for patient_dir in patient_dirs:
+            if not os.path.isdir(patient_dir):
+                continue
+            signature = self.signature(patient_dir)
+            entry = self.entries.get(patient_dir)
+            if entry is None or entry.signature != signature:
+                entry = self.entries[patient_dir] = self.scan(patient_dir, signature)
+                scanned += 1
+            entries.append(entry)
+        if scanned:
+            self.save()
+        logger.info("[MANIFEST] %s patient(s), %s rescanned (%s)", len(entries), scanned, self.path)
+        return sorted(entries, key=lambda e: (e.patient, e.patient_dir))
+
+    def get(self, patient_dir) -> Optional[PatientEntry]:
+        return self.entries.get(patient_dir)
+
+    def save(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        # Unique per writer, runs on other hosts may refresh the same manifest
+        tmp_path = f"{self.path}.{socket.gethostname()}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"version": MANIFEST_VERSION, "patients": [asdict(e) for e in self.entries.values()]}, f, indent=1)
+        os.replace(tmp_path, self.path)
+
+
+def _shape(entry, series_dir):
+    info = entry.series.get(series_dir)
+    return "x".join(map(str, info.size)) if info and info.size else "-"
+
+
+if __name__=="__main__":
+    import argparse
+    from glob import glob
+    from evaluation.config import EvaluationConfig
+    parser = argparse.ArgumentParser(description="Build or refresh the cohort manifest and print it")
+    parser.add_argument("data", type=str, nargs="+", help="patient folders (globs)")
+    parser.add_argument("--manifest", type=str, default=EvaluationConfig.MANIFEST_PATH, help="manifest file")
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    entries = Manifest(args.manifest, EvaluationConfig()).refresh([d for path in args.data for d in glob(path)])
+    print(f"{'patient':<9}{'CT':>14}{'CBCT':>14}  {'GT':<4}{'FDMs':>5}  LinearTransform")
+    for e in entries:
+        print(f"{e.patient:<9}{_shape(e, 'CT'):>14}{_shape(e, 'CBCT'):>14}  {'yes' if e.has_gt else 'no':<4}{len(e.fdms):>5}  {e.linear_transform or '-'}")
@@ -0,0 +1,178 @@
+import os
+import json
+import shutil
+import logging
+import threading
+from dataclasses import dataclass, asdict
+from typing import List, Optional
+
+import numpy as np
+import SimpleITK as sitk
+
+from evaluation.stages import lazy_import
+
+streaming = lazy_import("evaluation.streaming")
+
+logger = logging.getLogger(__name__)
+
+# One index per folder, hidden like the label map files so the glob("<folder>/*") of the stages skips it
+INDEX_FILENAME = ".mask_index.json"
+INDEX_VERSION = 1
+# Structure threads of one patient write masks into the same folder
+_lock = threading.Lock()
+
+
+@dataclass
+class MaskStats:
+    # basename:size:mtime_ns of the mask file described, an entry with another key is stale
+    key: str
+    size: List[int]
+    spacing: List[float]
+    origin: List[float]
+    direction: List[float]
+    voxels: int
+    volume_ml: float
+    # Non-zero voxels in sitk (x, y, z) index order and in physical mm (voxel centres), None for an empty mask
+    bbox_index: Optional[List[List[int]]] = None
+    bbox_mm: Optional[List[List[float]]] = None
+    centroid_mm: Optional[List[float]] = None
+
+    @property
+    def empty(self):
+        return self.voxels == 0
+
+    @property
+    def z_extent(self):
+        # (z_min, z_max) of the non-zero slices like streaming.z_extent, None for an empty mask
+        return None if self.empty else (self.bbox_index[0][2], self.bbox_index[1][2])
+
+    @property
+    def header(self):
+        # (size, spacing, origin, direction), as preflight.read_header returns it
+        return self.size, self.spacing, self.origin, self.direction
+
+
+def file_key(path):
+    st = os.stat(path)
+    return f"{os.path.basename(path)}:{st.st_size}:{st.st_mtime_ns}"
+
+
+def index_path(mask_path):
+    return os.path.join(os.path.dirname(os.path.abspath(mask_path)), INDEX_FILENAME)
+
+
+def stats_from_slabs(key, slabs, size, spacing, origin, direction) -> MaskStats:
+    # One pass over (z0, slab) pairs: per-axis voxel counts give the bounding box, the count and the centroid
+    counts = [np.zeros(size[0], dtype=np.int64), np.zeros(size[1], dtype=np.int64), np.zeros(size[2], dtype=np.int64)]
+    for z0, slab in slabs:
+        mask = slab > 0
+        counts[2][z0:z0 + mask.shape[0]] = mask.sum(axis=(1, 2))
+        counts[1] += mask.sum(axis=(0, 2))
+        counts[0] += mask.sum(axis=(0, 1))
+    voxels = int(counts[2].sum())
+    stats = MaskStats(key, list(size), list(spacing), list(origin), list(direction), voxels,
+                      voxels * float(np.prod(spacing)) / 1000.0)
+    if voxels:
+        lo = [int(np.flatnonzero(c)[0]) for c in counts]
+        hi = [int(np.flatnonzero(c)[-1]) for c in counts]
+        centroid = [float((c * np.arange(len(c))).sum()) / voxels for c in counts]
+        matrix = np.array(direction).reshape(3, 3)
+        to_mm = lambda index: (np.array(origin) + matrix @ (np.array(index, dtype=np.float64) * np.array(spacing))).tolist()
+        corners = np.array([to_mm(lo), to_mm(hi)])
+        stats.bbox_index = [lo, hi]
+        stats.bbox_mm = [corners.min(axis=0).tolist(), corners.max(axis=0).tolist()]
+        stats.centroid_mm = to_mm(centroid)
+    return stats
+
+
+def image_stats(key, image) -> MaskStats:
+    return stats_from_slabs(key, [(0, sitk.GetArrayViewFromImage(image))], image.GetSize(), image.GetSpacing(),
+                            image.GetOrigin(), image.GetDirection())
+
+
+def file_stats(path, memory_mb=None) -> MaskStats:
+    # Decodes the mask, slab by slab under memory_mb when given
+    if memory_mb:
+        reader = streaming.SlabReader(path)
+        slabs = streaming.iter_slabs(reader, reader.slab_depth(memory_mb, reader.dtype.itemsize * 2))
+        return stats_from_slabs(file_key(path), slabs, reader.size, reader.spacing, reader.origin, reader.direction)
+    return image_stats(file_key(path), sitk.ReadImage(path))
+
+
+def _load(path):
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return data.get("masks", {}) if data.get("version") == INDEX_VERSION else {}
+
+
+def _store(mask_path, stats):
+    path = index_path(mask_path)
+    with _lock:
+        entries = _load(path)
+        entries[os.path.basename(mask_path)] = asdict(stats)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"version": INDEX_VERSION, "masks": entries}, f, indent=1)
+        os.replace(tmp_path, path)
+    return stats
+
+
+def lookup(mask_path) -> Optional[MaskStats]:
+    # The indexed stats of a mask if they describe the file as it is now, without decoding anything
+    entry = _load(index_path(mask_path)).get(os.path.basename(mask_path))
+    if entry is None:
+        return None
+    try:
+        current = file_key(mask_path)
+    except OSError:
+        return None
+    return MaskStats(**entry) if entry["key"] == current else None
+
+
+def record(mask_path, image=None, memory_mb=None) -> MaskStats:
+    # (Re)indexes a mask, from the image just written when given
+    stats = image_stats(file_key(mask_path), image) if image is not None else file_stats(mask_path, memory_mb)
+    return _store(mask_path, stats)
+
+
+def mask_stats(mask_path, memory_mb=None) -> MaskStats:
+    # Indexed stats, computed and indexed when missing or stale
+    return lookup(mask_path) or record(mask_path, memory_mb=memory_mb)
+
+
+def write_mask(image, mask_path, *args) -> MaskStats:
+    # sitk.WriteImage plus the index entry, computed from the image in memory
+    sitk.WriteImage(image, mask_path, *args)
+    return record(mask_path, image)
+
+
+def copy_mask(src, dst):
+    # Copies a mask and carries its index entry over under the copy's key
+    shutil.copy(src, dst)
+    stats = lookup(src)
+    if stats is not None:
+        stats.key = file_key(dst)
+        _store(dst, stats)
+    return dst
+
+
+if __name__=="__main__":
+    import argparse
+    from glob import glob
+    parser = argparse.ArgumentParser(description="Index masks (folders or files) and print their stats")
+    parser.add_argument("masks", type=str, nargs="+", help="mask files or folders of .nrrd/.mha masks")
+    parser.add_argument("--memory-mb", type=int, default=None, help="stream masks in z-slabs under this memory ceiling (MB)")
+
+    args = parser.parse_args()
+    paths = []
+    for path in args.masks:
+        paths += sorted(glob(os.path.join(path, "*.nrrd")) + glob(os.path.join(path, "*.mha"))) if os.path.isdir(path) else [path]
+    print(f"{'mask':<40}{'voxels':>10}{'mL':>9}  {'z-extent':<12}centroid (mm)")
+    for path in paths:
+        s = mask_stats(path, args.memory_mb)
+        centroid = ", ".join(f"{v:.1f}" for v in s.centroid_mm) if s.centroid_mm else "-"
+        extent = f"{s.z_extent[0]}-{s.z_extent[1]}" if s.z_extent else "-"
+        print(f"{os.path.relpath(path):<40}{s.voxels:>10}{s.volume_ml:>9.2f}  {extent:<12}{centroid}")
@@ -1,8 +1,11 @@
 import os
+import logging
 from evaluation.config import EvaluationConfig
 from evaluation.utils import Utils
 
-def create_params_txt(patient_dir, filename, configs, segements=[]):
+logger = logging.getLogger(__name__)
+
+def create_params_txt(patient_dir, filename, configs, segements=[], fixed_image=None):
     
     utils = Utils(configs)
     patient_number = utils.get_patient_number(patient_dir)
@@ -11,7 +14,8 @@ def create_params_txt(patient_dir, filename, configs, segements=[]):
     img_out = os.path.join(patient_dir, configs.REGISTERED_VOLUMES_DIR, f"{filename}.nrrd")
     vf_out = os.path.join(patient_dir, configs.VF_VOLUMES_DIR, f"{configs.VF_PREFIX}{filename}.nrrd")
     
-    ct_path = os.path.join(patient_dir, configs.CT_DIR)
+    # fixed_image: the decoded CT volume when the series cache is on, the CT folder by default
+    ct_path = fixed_image or os.path.join(patient_dir, configs.CT_DIR)
     cbct_path = os.path.join(patient_dir, configs.LT_CBCT_DIR)
     total_segements = [{
             "fixed_file": ct_path,
@@ -19,7 +23,19 @@ def create_params_txt(patient_dir, filename, configs, segements=[]):
         }]
     total_segements = total_segements + segements
 
-    stage_params = f"""
+    if configs.preview:
+        # One coarse stage on the already downsampled images, enough to see whether the registration roughly aligns
+        stage_params = """
+xform=bspline
+impl=plastimatch
+grid_spac=100 100 100
+curvature_penalty=100
+res=2 2 1
+max_its=30
+flavor=p
+"""
+    else:
+        stage_params = f"""
 xform=bspline
 impl=plastimatch
 grid_spac=100 100 100
@@ -64,8 +80,22 @@ vf_out={vf_out}\n\n"""
         file = open(params_txt, 'w')
         file.write(global_params + metric_params + stage_params)
         file.close()
-        print(f"CREATED: {params_txt}")
+        logger.info("CREATED: %s", params_txt)
         return True
     except Exception as e:
-        print(f"Exception: {e}")
+        logger.error("Creating %s failed: %s", params_txt, e)
         return False
+
+
+def retarget_params_txt(params_txt, out_txt, img_out, vf_out):
+    # Copy of params_txt whose registered volume and VF go to img_out/vf_out
+    with open(params_txt) as f:
+        lines = f.read().splitlines()
+    for i, line in enumerate(lines):
+        if line.startswith("img_out="):
+            lines[i] = f"img_out={img_out}"
+        elif line.startswith("vf_out="):
+            lines[i] = f"vf_out={vf_out}"
+    with open(out_txt, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    return out_txt
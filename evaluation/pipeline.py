@@ -1,30 +1,84 @@
 from glob import glob
 from typing import List
-from uuid import uuid4
 import shutil
-from evaluation.evaluator import Evaluator
-import sys
-from contextlib import redirect_stdout, redirect_stderr
-from evaluation.params import create_params_txt
-from totalsegmentator.python_api import totalsegmentator
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from evaluation.checkpoint import staged_dir, staged_dirs, is_committed, is_legacy, adopt, skipped_work, record_skipped, is_step_done, mark_step, clear_step, replace_file
+from evaluation.scheduler import AdmissionScheduler, CostModel
+from evaluation.tracing import Tracer, summarize
+from evaluation.ledger import Ledger
+from evaluation.logs import LogService, log_context, variant_handlers, PROGRESS_LOGGER
+from evaluation.planner import plan_patients, longest_first, estimate_makespan, format_duration
+from evaluation.stages import lazy_import, load_stages
+from evaluation.taskgraph import TaskGraph
+from evaluation.prefetch import Prefetcher, patient_files
+from evaluation.manifest import Manifest
+from evaluation.scratch import ScratchTier
+from evaluation.preflight import preflight_patient, write_report, GT_WARPS, FDM_WARPS
+from evaluation.params import create_params_txt, retarget_params_txt
 import os
-import re
 
 from evaluation.fcsv import create_fcsv
-from evaluation.plastimatch import Plastimatch
+from evaluation.plastimatch import Plastimatch, PW_LINEAR_CURVE
+from evaluation.executor import PlastimatchExecutor
 from evaluation.config import EvaluationConfig
 from evaluation.utils import Utils
-import pandas as pd
-import numpy as np
 from datetime import datetime
 
+# Heavy dependencies, imported by the stages that need them (see evaluation.stages.STAGE_IMPORTS)
+np = lazy_import("numpy")
+sitk = lazy_import("SimpleITK")
+ts_api = lazy_import("totalsegmentator.python_api")
+evaluator_module = lazy_import("evaluation.evaluator")
+preprocess = lazy_import("evaluation.preprocess")
+streaming = lazy_import("evaluation.streaming")
+vf_store = lazy_import("evaluation.vf_store")
+vf_metrics = lazy_import("evaluation.vf_metrics")
+labelmap = lazy_import("evaluation.labelmap")
+results_store = lazy_import("evaluation.results_store")
+series_cache = lazy_import("evaluation.series_cache")
+preview = lazy_import("evaluation.preview")
+mask_index = lazy_import("evaluation.mask_index")
+api = lazy_import("evaluation.api")
+
+logger = logging.getLogger(__name__)
+progress = logging.getLogger(PROGRESS_LOGGER)
+# Per-structure masks exported from a packed uncropped segmentation for plastimatch, removed once used
+SEGMENT_EXPORT_DIR = ".export"
+# Stages reading the per-structure (cropped) masks in CT_seg/LT_CBCT_seg
+SEGMENT_READERS = ("dmap", "cxt", "warp", "metric")
+# Step marker of packed segments whose per-structure copies were dropped after scoring
+SEGMENTS_DROPPED = "segments_dropped"
+
+
+def resolve_steps(all=False, seg=False, pw_linear=False, dmap=False, cxt=False, fcsv=False,
+                  params=False, register=False, warp=False, metric=False, decode=False, preview=False):
+    # Requested stages, in pipeline order; decode (--cache-series) and preview (--preview) run before any stage that reads a series
+    reads_series = all or pw_linear or seg or params or register or warp
+    return {
+        "decode": decode and reads_series,
+        "preview": preview and reads_series,
+        "pw_linear": all or pw_linear,
+        "segmentation": all or seg,
+        "dmap": all or dmap,
+        "cxt": all or cxt,
+        "fcsv": all or fcsv,
+        "params": all or params or register or warp,
+        "register": all or register,
+        "warp": all or warp,
+        "metric": all or metric,
+    }
+
 class EvaluationPipeline:
     def __init__(self, configs: EvaluationConfig) -> None:
         self.configs: EvaluationConfig = configs
 
-        self.merged_dice = [] 
-        self.merged_hd = []
-        self.merged_fd = []
+        self.merged_vf_quality = []
+        # Dice/Hausdorff records of --preview runs, scored on the downsampled grid instead of by the evaluator
+        self.preview_scores = []
 
         self.FD_SEP_df = {
             self.configs.PATIENT_NUM_KEY: [],
@@ -34,28 +88,185 @@ class EvaluationPipeline:
             self.configs.TS: []
         }
 
-        self._plastimatch = Plastimatch()
+        self._executor = PlastimatchExecutor(
+            self.configs.plastimatch_concurrency,
+            self.configs.plastimatch_timeout_s,
+            self.configs.plastimatch_retries,
+            self.configs.plastimatch_backoff_s,
+            log_dir=os.path.join(self.configs.RESULTS_DIR, f"structures_tables_{self.configs.VARIANT_TAG}", "plastimatch_logs")
+        )
+        self._plastimatch = Plastimatch(self._executor, self.configs.register_timeout_s)
         self._utils = Utils(self.configs)
+        self._cost_model = CostModel(self.configs.results_path(self.configs.COST_MODEL_PATH), self.configs.COST_MODEL_PATH)
+        self._scheduler = AdmissionScheduler(self._cost_model, self.configs.ram_budget_mb, self.configs.cpu_budget)
+        self._scores_lock = threading.Lock()
+        self._structure_pool = None
+        self._structure_pool_lock = threading.Lock()
+        self._tracer = None
+        self._prefetcher = None
+        self.manifest = None
+        self._preflight = {}
+        self._scratch = ScratchTier(self.configs.scratch_dir, self.configs.scratch_cap_mb, self.configs.scratch_durable) \
+            if self.configs.scratch_dir else None
+        self.run_id = None
+        self.failed_patients = []
+
+
+    def structure_tasks(self):
+        # Task graph on the structure pool shared by all patients of this pipeline
+        with self._structure_pool_lock:
+            if self._structure_pool is None:
+                self._structure_pool = ThreadPoolExecutor(self.configs.structure_workers or os.cpu_count() or 1,
+                                                          thread_name_prefix="structure")
+        return TaskGraph(self._structure_pool)
+
+    def close_structure_pool(self):
+        with self._structure_pool_lock:
+            if self._structure_pool is not None:
+                self._structure_pool.shutdown()
+                self._structure_pool = None
+
+    def load_manifest(self, data):
+        # GT detection from the contours each patient actually has, instead of the hard-coded patients_with_GT
+        if not self.configs.use_manifest:
+            return
+        self.manifest = Manifest(self.configs.MANIFEST_PATH, self.configs)
+        entries = self.manifest.refresh(data)
+        self.configs.patients_with_GT = sorted({entry.patient for entry in entries if entry.has_gt})
+        logger.info("[MANIFEST] patients with GT: %s", ", ".join(self.configs.patients_with_GT) or "-")
+
+    def run_preflight(self, log_dir, data, steps, force):
+        # Returns the patients that pass; what each one skips is kept for params, registration and warps
+        reports = [preflight_patient(self, patient_dir, steps, force) for patient_dir in data]
+        self._preflight = {report.patient_dir: report for report in reports}
+        report_path = os.path.join(log_dir, f"preflight_{self.configs.VARIANT_TAG}.json")
+        write_report(report_path, self.configs.VARIANT_TAG, reports)
+        for report in reports:
+            for problem in report.problems:
+                logger.warning("[PREFLIGHT] %s: %s %s (%s), skipping %s", report.patient, problem.check, problem.path,
+                               problem.reason, problem.tag or "the patient")
+        skipped = [report for report in reports if report.skip_patient]
+        progress.info("[PREFLIGHT] %s of %s patient(s) skipped, %s with skipped registrations/warps (%s)", len(skipped), len(reports),
+                      sum(1 for r in reports if r.skipped_tags and not r.skip_patient), report_path)
+        return [report.patient_dir for report in reports if not report.skip_patient]
+
+    def preflight_skips(self, patient_dir):
+        report = self._preflight.get(patient_dir)
+        return set(report.skipped_tags) if report is not None else set()
 
+    def cached_series(self, patient_dir):
+        # DICOM series this variant reads
+        series = [self.configs.CT_DIR]
+        if not self.configs.use_generated_ct_everywhere:
+            series.append(self.configs.CBCT_DIR)
+        if self.configs.use_generated_ct_everywhere or self.configs.use_generated_ct_for_segmentation:
+            series.append(self.configs.GENERATED_CT_DIR)
+        return [s for s in series if os.path.isdir(os.path.join(patient_dir, s))]
+
+    def decode_series(self, patient_dir):
+        for series_dir in self.cached_series(patient_dir):
+            series_cache.cache_series(
+                os.path.join(patient_dir, series_dir),
+                series_cache.cache_path(patient_dir, series_dir, self.configs.SERIES_CACHE_DIR),
+                self.configs.series_decode_threads
+            )
+
+    def preview_inputs(self, patient_dir, force):
+        with staged_dir(os.path.join(patient_dir, self.configs.PREVIEW_DIR), force) as preview_out:
+            if preview_out is not None:
+                series = {s: self.source_series_path(patient_dir, s) for s in self.cached_series(patient_dir)}
+                contour_dirs = {}
+                for image in (self.configs.CT_DIR, self.configs.CBCT_DIR):
+                    source = os.path.join(patient_dir, self.configs.GT_CONTOURS_DIR, image)
+                    if os.path.isdir(source):
+                        contour_dirs[os.path.join(self.configs.GT_CONTOURS_DIR, image)] = source
+                preview.write_preview(series, contour_dirs, preview_out, self.configs.preview_factor)
+
+    def series_path(self, patient_dir, series_dir):
+        # What the stages read for a series: its downsampled copy with --preview, the source otherwise
+        if self.configs.preview:
+            return os.path.join(patient_dir, self.configs.PREVIEW_DIR, f"{series_dir}.nrrd")
+        return self.source_series_path(patient_dir, series_dir)
+
+    def source_series_path(self, patient_dir, series_dir):
+        # The decoded volume of a series when --cache-series is on and it is current, the DICOM folder otherwise
+        path = os.path.join(patient_dir, series_dir)
+        if self.configs.cache_series:
+            volume_path = series_cache.cache_path(patient_dir, series_dir, self.configs.SERIES_CACHE_DIR)
+            if series_cache.is_current(path, volume_path):
+                return volume_path
+        return path
+
+    def prefetch_files(self, patient_dir, force):
+        # Inputs in the order the stages read them; this variant's committed outputs (segments, VFs) only when a
+        # rerun without -f reuses them
+        series = [os.path.relpath(self.source_series_path(patient_dir, s), patient_dir) for s in self.cached_series(patient_dir)]
+        if self.configs.fused_preprocessing:
+            series += [self.configs.RAW_CBCT_DIR, self.configs.PREPROCESSED_CBCT_FILENAME]
+        folders = series + [self.configs.GT_CONTOURS_DIR, self.configs.FDMS_DIR]
+        if not force:
+            folders.append(self.configs.get_eval_dir())
+        return patient_files(patient_dir, folders)
 
     def pw_linear_transformation(self, patient_dir, force):
         ltcbct_path = os.path.join(patient_dir, self.configs.LT_CBCT_DIR)
-        is_skip = self._utils.replace_or_skip(ltcbct_path, force)
-     
-        if is_skip:
+        with staged_dir(ltcbct_path, force) as ltcbct_out:
+            if ltcbct_out is None:
+                return
+            self._pw_linear_transformation(patient_dir, ltcbct_path, ltcbct_out)
+
+    def _pw_linear_transformation(self, patient_dir, ltcbct_path, ltcbct_out):
+        # The intermediate NRRD keeps its name next to LT_CBCT, the DICOM series goes to the staged folder
+        # The preview grid comes from the CBCT series, the fused path would resample the raw CBCT at full resolution
+        if self.configs.fused_preprocessing and not self.configs.use_generated_ct_everywhere and not self.configs.preview:
+            raw_cbct_path = os.path.join(patient_dir, self.configs.RAW_CBCT_DIR)
+            if os.path.exists(raw_cbct_path):
+                affine_path = preprocess.find_linear_transform(patient_dir, self.configs)
+                if affine_path is None:
+                    logger.warning("No %s found for %s, using identity", self.configs.AFFINE_TRANSFORM_FILENAME, patient_dir)
+                preprocessed_path = preprocess.preprocess_cbct_cached(
+                    raw_cbct_path,
+                    os.path.join(patient_dir, self.configs.PREPROCESSED_CBCT_FILENAME),
+                    affine_path,
+                    fov_threshold=self.configs.cbct_fov_threshold
+                )
+                nrrd_file = f"{ltcbct_path}.nrrd"
+                self._utils.link_or_copy(preprocessed_path, nrrd_file)
+                self._plastimatch.convert("input", nrrd_file, "output-dicom", ltcbct_out)
+                return
+            logger.warning("%s not found, falling back to plastimatch pw-linear on %s", raw_cbct_path, self.configs.CBCT_DIR)
+
+        # A fused run leaves LT_CBCT.nrrd hard-linked to the patient's LT_CBCT_preprocessed.nrrd; plastimatch and the
+        # streamed writer write in place, which would change the cached volume under its unchanged key
+        if os.path.exists(f"{ltcbct_path}.nrrd"):
+            os.remove(f"{ltcbct_path}.nrrd")
+
+        if self.configs.streaming:
+            # Slab-wise HU mapping straight from the DICOM series (identity copy for the generated CT)
+            if self.configs.use_generated_ct_everywhere:
+                source_path, curve = self.series_path(patient_dir, self.configs.GENERATED_CT_DIR), None
+            else:
+                source_path, curve = self.series_path(patient_dir, self.configs.CBCT_DIR), PW_LINEAR_CURVE
+            nrrd_file = f"{ltcbct_path}.nrrd"
+            streaming.stream_pw_linear(source_path, nrrd_file, curve, self.configs.stream_memory_mb)
+            self._plastimatch.convert("input", nrrd_file, "output-dicom", ltcbct_out)
             return
-     
+
         if self.configs.use_generated_ct_everywhere:
             generated_dicom_folder = os.path.join(patient_dir, "GENERATED_CT")
             generated_nrrd_path = os.path.join(patient_dir, "GENERATED_CT.nrrd")
+            cached_path = self.series_path(patient_dir, self.configs.GENERATED_CT_DIR)
      
-            if not os.path.exists(generated_nrrd_path):
-                print(f"[INFO] Converting GENERATED_CT DICOM to NRRD: {generated_nrrd_path}")
+            if cached_path != generated_dicom_folder:
+                # Already decoded by the decode stage, no plastimatch conversion
+                generated_nrrd_path = cached_path
+            elif not os.path.exists(generated_nrrd_path):
+                logger.info("Converting GENERATED_CT DICOM to NRRD: %s", generated_nrrd_path)
                 self._plastimatch.convert("input", generated_dicom_folder, "output-img", generated_nrrd_path)
      
             cbct_path = generated_nrrd_path
         else:
-            cbct_path = os.path.join(patient_dir, self.configs.CBCT_DIR)
+            cbct_path = self.series_path(patient_dir, self.configs.CBCT_DIR)
      
         self._plastimatch.pw_linear_transform(
             cbct_path,
@@ -67,62 +278,249 @@ class EvaluationPipeline:
         if not os.path.exists(nrrd_file):
             raise FileNotFoundError(f"Error: {nrrd_file} not created after pw-linear transform.")
      
-        self._plastimatch.convert("input", nrrd_file, "output-dicom", ltcbct_path)
+        self._plastimatch.convert("input", nrrd_file, "output-dicom", ltcbct_out)
     
     def segmentation(self, input_path, output_seg_path, force, roi_subset=None):
-        is_skip = self._utils.replace_or_skip(output_seg_path, force)
-        if is_skip:
+        # Returns True when the segments were (re)computed
+        with staged_dir(output_seg_path, force) as seg_out:
+            if seg_out is None:
+                return False
+
+            if roi_subset is None:
+                _, roi_subset = self._utils.get_roi_subset(input_path)
+
+            ts_api.totalsegmentator(input_path, output=seg_out, roi_subset=roi_subset, fast=self.configs.preview,
+                                    quiet=not logger.isEnabledFor(logging.DEBUG))
+
+            if self.configs.compact_segments:
+                labelmap.pack_segments(seg_out)
+            else:
+                for nifti_file_path in glob(f"{seg_out}/*"):
+                    self._utils.convert_nifti_to_nrrd(nifti_file_path)
+        return True
+
+    def uncropped_dirs(self, patient_dir):
+        # uncropped CT segments, LT_CBCT segments, dmaps, cxts and fcsvs
+        eval_dir = os.path.join(patient_dir, self.configs.get_eval_dir())
+        return [os.path.join(eval_dir, name) for name in
+                ["uncrp_CT_segments", "uncrp_LT_CBCT_segments", "uncropped_dmaps", "uncropped_cxts", "uncropped_fcsvs"]]
+
+    def segment_patient(self, patient_dir, force):
+        ltcbct_path = os.path.join(patient_dir, self.configs.LT_CBCT_DIR)
+        ltcbct_seg_path = os.path.join(patient_dir, self.configs.LT_CBCT_SEG_DIR)
+        generatedct_path = self.series_path(patient_dir, self.configs.GENERATED_CT_DIR)
+
+        seg_input_path = (
+            generatedct_path if (
+                self.configs.use_generated_ct_everywhere or self.configs.use_generated_ct_for_segmentation
+            ) else ltcbct_path
+        )
+
+        roi_subset = [self.configs.TS_BLADDER_CLASS]
+        # roi_subset = [self.configs.TS_PROSTATE_CLASS]
+
+        if self.configs.use_extended_ts_organs:
+            roi_subset += [
+                self.configs.TS_COLON,
+                self.configs.TS_FEMUR_LEFT,
+                self.configs.TS_FEMUR_RIGHT,
+                self.configs.TS_HIP_LEFT, self.configs.TS_HIP_RIGHT
+            ]
+     # self.configs.TS_SACRUM
+
+     # self.configs.TS_PROSTATE_CLASS
+        # Segment LT_CBCT (or generated) and CT
+        redo = self.segmentation(seg_input_path, ltcbct_seg_path, force, roi_subset=roi_subset)
+        ct_path = self.series_path(patient_dir, self.configs.CT_DIR)
+        ct_seg_path = os.path.join(patient_dir, self.configs.CT_SEG_DIR)
+        redo = self.segmentation(ct_path, ct_seg_path, force, roi_subset=roi_subset) or redo
+
+        # Uncropped copies and their DMAPs/CXTs/FCSVs are derived from fresh segments, commit them together
+        with staged_dirs(self.uncropped_dirs(patient_dir), force or redo) as partials:
+            if partials is not None:
+                self.uncropped_outputs(ct_seg_path, ltcbct_seg_path, *partials)
+                redo = True
+
+        self.crop_segments(patient_dir, force or redo)
+
+    def uncropped_outputs(self, ct_seg_path, ltcbct_seg_path, uncropped_ct_dir, uncropped_cbct_dir,
+                          uncropped_dmap_dir, uncropped_cxt_dir, uncropped_fcsv_dir):
+        seg_dirs = []
+        for seg_path, uncropped_dir in [(ct_seg_path, uncropped_ct_dir), (ltcbct_seg_path, uncropped_cbct_dir)]:
+            if labelmap.has_labelmap(seg_path):
+                # Packed segments are linked as is; plastimatch reads per-structure masks exported to a scratch folder
+                labelmap.link_labelmap(seg_path, uncropped_dir, self._utils.link_or_copy)
+                scratch_dir = os.path.join(uncropped_dir, SEGMENT_EXPORT_DIR)
+                labelmap.LabelMap(uncropped_dir).export(scratch_dir)
+                seg_dirs.append(scratch_dir)
+            else:
+                # Copy uncropped segments, with their mask index entries
+                for f in glob(f"{seg_path}/*.nrrd"):
+                    mask_index.copy_mask(f, os.path.join(uncropped_dir, os.path.basename(f)))
+                seg_dirs.append(uncropped_dir)
+        ct_segments_dir = seg_dirs[0]
+
+        graph = self.structure_tasks()
+        # Generate DMAPs from uncropped segments
+        for seg_dir in seg_dirs:
+            for seg_path in glob(f"{seg_dir}/*.nrrd"):
+                class_name = self._utils.get_class_name(seg_path)
+                dmap_path = os.path.join(uncropped_dmap_dir, f"{class_name}.mha")
+                graph.add(self._plastimatch.dmap, seg_path, dmap_path)
+
+        # Convert uncropped CT segments to CXT, then each to FCSV as soon as its CXT exists
+        for seg_path in glob(f"{ct_segments_dir}/*.nrrd"):
+            class_name = self._utils.get_class_name(seg_path)
+            cxt_path = os.path.join(uncropped_cxt_dir, f"{class_name}.cxt")
+            fcsv_path = os.path.join(uncropped_fcsv_dir, f"{class_name}.fcsv")
+            csv_path = os.path.join(uncropped_fcsv_dir, f"{class_name}.csv")
+            cxt = graph.add(self._plastimatch.convert, "input-ss-img", seg_path, "output-cxt", cxt_path)
+            graph.add(create_fcsv, cxt_path, fcsv_path, csv_path, after=[cxt])
+        graph.run()
+        for uncropped_dir in [uncropped_ct_dir, uncropped_cbct_dir]:
+            shutil.rmtree(os.path.join(uncropped_dir, SEGMENT_EXPORT_DIR), ignore_errors=True)
+
+    def restore_uncropped(self, patient_dir):
+        uncropped_ct_dir, uncropped_cbct_dir = self.uncropped_dirs(patient_dir)[:2]
+        for uncropped_dir, seg_dir in [(uncropped_ct_dir, self.configs.CT_SEG_DIR), (uncropped_cbct_dir, self.configs.LT_CBCT_SEG_DIR)]:
+            if labelmap.has_labelmap(uncropped_dir):
+                # The croppers, dmap/cxt stages, warps and scores read per-structure files
+                labelmap.LabelMap(uncropped_dir).export(os.path.join(patient_dir, seg_dir))
+                continue
+            for f in glob(f"{uncropped_dir}/*.nrrd"):
+                replace_file(f, os.path.join(patient_dir, seg_dir, os.path.basename(f)))
+
+    def drop_segment_copies(self, patient_dir):
+        # Packed segments: the per-structure working copies next to the label maps go once scored. A separate step
+        # marker records it, so segmentation stays committed and a later stage reading them exports and crops them
+        # again (ensure_segment_copies)
+        eval_dir = os.path.join(patient_dir, self.configs.get_eval_dir())
+        for seg_dir in [self.configs.CT_SEG_DIR, self.configs.LT_CBCT_SEG_DIR]:
+            seg_dir = os.path.join(patient_dir, seg_dir)
+            if labelmap.has_labelmap(seg_dir):
+                mark_step(eval_dir, SEGMENTS_DROPPED)
+                for f in glob(f"{seg_dir}/*.nrrd"):
+                    os.remove(f)
+
+    def ensure_segment_copies(self, patient_dir, steps, force):
+        eval_dir = os.path.join(patient_dir, self.configs.get_eval_dir())
+        if not is_step_done(eval_dir, SEGMENTS_DROPPED):
             return
-    
-        if roi_subset is None:
-            _, roi_subset = self._utils.get_roi_subset(input_path)
-    
-        totalsegmentator(input_path, output=output_seg_path, roi_subset=roi_subset)
-        
-        for nifti_file_path in glob(f"{output_seg_path}/*"):
-            self._utils.convert_nifti_to_nrrd(nifti_file_path)
+        if not any(steps[s] and (force or not self.is_stage_committed(s, patient_dir)) for s in SEGMENT_READERS):
+            return
+        self.restore_uncropped(patient_dir)
+        self._crop_segments(patient_dir)
+        clear_step(eval_dir, SEGMENTS_DROPPED)
 
-    def dmap_calcualtion(self, patient_dir, force):
-        dmaps_dir = os.path.join(patient_dir, self.configs.DMAPS_DIR)
-        is_skip = self._utils.replace_or_skip(dmaps_dir, force)
-        if is_skip:
+    def crop_segments(self, patient_dir, force=False):
+        # Cropping edits CT_seg/LT_CBCT_seg in place, so every attempt starts again from the committed
+        # uncropped copies and a step marker records the finished crop
+        eval_dir = os.path.join(patient_dir, self.configs.get_eval_dir())
+        if force:
+            clear_step(eval_dir, "crop")
+        if is_step_done(eval_dir, "crop"):
             return
+        self.restore_uncropped(patient_dir)
+        self._crop_segments(patient_dir)
+        mark_step(eval_dir, "crop")
+        clear_step(eval_dir, SEGMENTS_DROPPED)
+
+    def _crop_segments(self, patient_dir):
+        # Automatically crop larger bladder to match smaller one
+        # Automatically crop bladder with larger Z-extent to the other
+        if self.configs.use_extended_ts_organs:
+            bladder_ct = os.path.join(patient_dir, self.configs.CT_SEG_DIR, f"{self.configs.TS_BLADDER_CLASS}.nrrd")
+            bladder_cbct = os.path.join(patient_dir, self.configs.LT_CBCT_SEG_DIR, f"{self.configs.TS_BLADDER_CLASS}.nrrd")
+            self._utils.crop_larger_bladder_to_smaller_extent_by_zmm(bladder_ct, bladder_cbct)
+
+        # Cropping colon using CBCT sac extent
+        if self.configs.use_extended_ts_organs and self.configs.crop_colon:
+            colon_ct_path = os.path.join(patient_dir, self.configs.CT_SEG_DIR, f"{self.configs.TS_COLON}.nrrd")
+            colon_cbct_path = os.path.join(patient_dir, self.configs.LT_CBCT_SEG_DIR, f"{self.configs.TS_COLON}.nrrd")
+
+            # Apply sac filtering to CBCT colon (with height truncation)
+            # Keep bottom 30% of lowest colon structure
+            # Step 1: Crop the CBCT colon with bottom focus (you said leave this unchanged)
+            self._utils.crop_colon_to_lower_sac(colon_cbct_path, keep_ratio=0.8)
+
+            # Step 2: Use CBCT colon to crop CT colon (now aligned properly!)
+            self._utils.crop_ct_colon_by_cbct_sac(colon_ct_path, colon_cbct_path)
+
+
+
+            femur_left_ct = os.path.join(patient_dir, self.configs.CT_SEG_DIR, f"{self.configs.TS_FEMUR_LEFT}.nrrd")
+            femur_right_ct = os.path.join(patient_dir, self.configs.CT_SEG_DIR, f"{self.configs.TS_FEMUR_RIGHT}.nrrd")
+            femur_left_cbct = os.path.join(patient_dir, self.configs.LT_CBCT_SEG_DIR, f"{self.configs.TS_FEMUR_LEFT}.nrrd")
+            femur_right_cbct = os.path.join(patient_dir, self.configs.LT_CBCT_SEG_DIR, f"{self.configs.TS_FEMUR_RIGHT}.nrrd")
+
+            # self._utils.crop_colon_by_femurs(femur_left_ct, femur_right_ct, colon_ct_path)
+            # self._utils.crop_colon_by_femurs(femur_left_cbct, femur_right_cbct, colon_cbct_path)
+        if self.configs.use_extended_ts_organs:
+            # ----------- Define paths -----------
+            hip_left_ct = os.path.join(patient_dir, self.configs.CT_SEG_DIR, f"{self.configs.TS_HIP_LEFT}.nrrd")
+            hip_right_ct = os.path.join(patient_dir, self.configs.CT_SEG_DIR, f"{self.configs.TS_HIP_RIGHT}.nrrd")
+
+            hip_left_cbct = os.path.join(patient_dir, self.configs.LT_CBCT_SEG_DIR, f"{self.configs.TS_HIP_LEFT}.nrrd")
+            hip_right_cbct = os.path.join(patient_dir, self.configs.LT_CBCT_SEG_DIR, f"{self.configs.TS_HIP_RIGHT}.nrrd")
+
+            # sacrum_ct = os.path.join(patient_dir, self.configs.CT_SEG_DIR, f"{self.configs.TS_SACRUM}.nrrd")
+            # sacrum_cbct = os.path.join(patient_dir, self.configs.LT_CBCT_SEG_DIR, f"{self.configs.TS_SACRUM}.nrrd")
+
+            # ----------- Crop CT hips using femur pair -----------
+            self._utils.crop_ct_femur_using_cbct(femur_left_cbct, femur_left_ct)
+            self._utils.crop_ct_femur_using_cbct(femur_right_cbct, femur_right_ct)                    
+            # # ----------- Crop CT hips using femur pair -----------
+            self._utils.crop_hip_by_femurs(hip_left_cbct, hip_left_ct)
+            self._utils.crop_hip_by_femurs(hip_right_cbct, hip_right_ct)
+            # # ----------- Crop CT hips using femur pair -----------
+            # self._utils.crop_hip_by_femurs(sacrum_cbct, sacrum_ct)
+
+    def dmap_calcualtion(self, patient_dir, force):
+        with staged_dir(os.path.join(patient_dir, self.configs.DMAPS_DIR), force) as dmaps_dir:
+            if dmaps_dir is not None:
+                self._dmap_calcualtion(patient_dir, dmaps_dir)
+
+    def _dmap_calcualtion(self, patient_dir, dmaps_dir):
         ltcbct_seg_path = os.path.join(patient_dir, self.configs.LT_CBCT_SEG_DIR)
-        cbct_gt_contours_path = os.path.join(patient_dir, self.configs.GT_CONTOURS_DIR, self.configs.CBCT_DIR)
+        cbct_gt_contours_path = os.path.join(patient_dir, self.configs.gt_contours_dir(self.configs.CBCT_DIR))
         input_paths = glob(f"{ltcbct_seg_path}/*") + glob(f"{cbct_gt_contours_path}/*")
-        for input_path in input_paths:
-            class_name = self._utils.get_class_name(input_path)
-            if class_name:
-                output_path = os.path.join(dmaps_dir, f"{class_name}.mha")
-                self._plastimatch.dmap(input_path, output_path)
+        with self._plastimatch.batch() as batch:
+            for input_path in input_paths:
+                class_name = self._utils.get_class_name(input_path)
+                if class_name:
+                    output_path = os.path.join(dmaps_dir, f"{class_name}.mha")
+                    batch.dmap(input_path, output_path)
 
     def cxt_conversion(self, patient_dir, force):
-        cxts_dir = os.path.join(patient_dir, self.configs.CXTS_DIR)
-        is_skip = self._utils.replace_or_skip(cxts_dir, force)
-        if is_skip:
-            return
-        
+        with staged_dir(os.path.join(patient_dir, self.configs.CXTS_DIR), force) as cxts_dir:
+            if cxts_dir is not None:
+                self._cxt_conversion(patient_dir, cxts_dir)
+
+    def _cxt_conversion(self, patient_dir, cxts_dir):
         ct_seg_path = os.path.join(patient_dir, self.configs.CT_SEG_DIR)
-        ct_gt_contours_path = os.path.join(patient_dir, self.configs.GT_CONTOURS_DIR, self.configs.CT_DIR)
+        ct_gt_contours_path = os.path.join(patient_dir, self.configs.gt_contours_dir(self.configs.CT_DIR))
         input_paths = glob(f"{ct_seg_path}/*") + glob(f"{ct_gt_contours_path}/*")
-        for input_path in input_paths:
-            class_name = self._utils.get_class_name(input_path)
-            if class_name:
-                output_path = os.path.join(cxts_dir, f"{class_name}.cxt")
-                self._plastimatch.convert("input-ss-img", input_path, "output-cxt", output_path)
+        with self._plastimatch.batch() as batch:
+            for input_path in input_paths:
+                class_name = self._utils.get_class_name(input_path)
+                if class_name:
+                    output_path = os.path.join(cxts_dir, f"{class_name}.cxt")
+                    batch.convert("input-ss-img", input_path, "output-cxt", output_path)
 
     def create_fcsvfile(self, patient_dir, force):
-        fcsvs_dir = os.path.join(patient_dir, self.configs.FCVS_DIR)
-        is_skip = self._utils.replace_or_skip(fcsvs_dir, force)
-        if is_skip:
-            return
-        
+        with staged_dir(os.path.join(patient_dir, self.configs.FCVS_DIR), force) as fcsvs_dir:
+            if fcsvs_dir is not None:
+                self._create_fcsvfile(patient_dir, fcsvs_dir)
+
+    def _create_fcsvfile(self, patient_dir, fcsvs_dir):
         cxts_dir = os.path.join(patient_dir, self.configs.CXTS_DIR)
+        graph = self.structure_tasks()
         for cxt_filepath in glob(f"{cxts_dir}/*"):
             class_name = self._utils.get_class_name(cxt_filepath)
             fcsv_filepath = os.path.join(fcsvs_dir, f"{class_name}.fcsv")
             csv_filepath = os.path.join(fcsvs_dir, f"{class_name}.csv")
-            create_fcsv(cxt_filepath, fcsv_filepath, csv_filepath)
+            graph.add(create_fcsv, cxt_filepath, fcsv_filepath, csv_filepath)
+        graph.run()
 
     def create_register_params(self, patient_dir, force):
         # Flags to keep track of the register params file created
@@ -134,16 +532,19 @@ class EvaluationPipeline:
         os.makedirs(reg_params_dir, exist_ok=True)
     
         patient_number, TS_roi_subset = self._utils.get_roi_subset(patient_dir)
-        print(f"[DEBUG] patient_number: {patient_number}")
-        print(f"[DEBUG] patients_with_GT: {self.configs.patients_with_GT}")
+        logger.debug("patient_number: %s", patient_number)
+        logger.debug("patients_with_GT: %s", self.configs.patients_with_GT)
     
         # Exclude femurs from registration (they're only used for colon cropping)
         TS_roi_subset_filtered = TS_roi_subset
-        print(f"[DEBUG] Final TS_roi_subset_filtered for registration: {TS_roi_subset_filtered}")
+        logger.debug("Final TS_roi_subset_filtered for registration: %s", TS_roi_subset_filtered)
     
+        # Fixed image of every params file: the CT series, or its decoded volume with --cache-series
+        ct_path = self.series_path(patient_dir, self.configs.CT_DIR)
+
         # Create NOPD params
-        NOPD = create_params_txt(patient_dir, self.configs.NOPD, self.configs)
-        print(f"[DEBUG] NOPD param created: {NOPD}")
+        NOPD = create_params_txt(patient_dir, self.configs.NOPD, self.configs, fixed_image=ct_path)
+        logger.debug("NOPD param created: %s", NOPD)
     
         # Create TS params (conditionally includes colon if extended organs are enabled)
         segments = []
@@ -153,12 +554,12 @@ class EvaluationPipeline:
                 "fixed_file": os.path.join(patient_dir, self.configs.FCVS_DIR, f"{name}.fcsv"),
                 "moving_file": os.path.join(patient_dir, self.configs.DMAPS_DIR, f"{name}.mha")
             })
-        TS = create_params_txt(patient_dir, self.configs.TS, self.configs, segments)
-        print(f"[DEBUG] TS param created: {TS}")
+        TS = create_params_txt(patient_dir, self.configs.TS, self.configs, segments, fixed_image=ct_path)
+        logger.debug("TS param created: %s", TS)
     
         # Create GT-based params (bladder-only and all)
-        ct_gt_contours_path = os.path.join(patient_dir, self.configs.GT_CONTOURS_DIR, self.configs.CT_DIR)
-        print(f"[DEBUG] CT_GT folder exists: {os.path.exists(ct_gt_contours_path)}")
+        ct_gt_contours_path = os.path.join(patient_dir, self.configs.gt_contours_dir(self.configs.CT_DIR))
+        logger.debug("CT_GT folder exists: %s", os.path.exists(ct_gt_contours_path))
         
         if (str(patient_number) in self.configs.patients_with_GT) and os.path.exists(ct_gt_contours_path):
             # GT Bladder and Rectum Only
@@ -169,8 +570,8 @@ class EvaluationPipeline:
                     "fixed_file": os.path.join(patient_dir, self.configs.FCVS_DIR, f"{name}.fcsv"),
                     "moving_file": os.path.join(patient_dir, self.configs.DMAPS_DIR, f"{name}.mha")
                 })
-            GT_bladder_rectum_only = create_params_txt(patient_dir, self.configs.GT_BLADDER_RECTUM_ONLY, self.configs, segments)
-            print(f"[DEBUG] GT_bladder_rectum_only param created: {GT_bladder_rectum_only}")
+            GT_bladder_rectum_only = create_params_txt(patient_dir, self.configs.GT_BLADDER_RECTUM_ONLY, self.configs, segments, fixed_image=ct_path)
+            logger.debug("GT_bladder_rectum_only param created: %s", GT_bladder_rectum_only)
     
             # GT All
             segments = []
@@ -180,104 +581,232 @@ class EvaluationPipeline:
                     "fixed_file": os.path.join(patient_dir, self.configs.FCVS_DIR, f"{name}.fcsv"),
                     "moving_file": os.path.join(patient_dir, self.configs.DMAPS_DIR, f"{name}.mha")
                 })
-            GT = create_params_txt(patient_dir, self.configs.GT, self.configs, segments)
-            print(f"[DEBUG] GT param created: {GT}")
+            GT = create_params_txt(patient_dir, self.configs.GT, self.configs, segments, fixed_image=ct_path)
+            logger.debug("GT param created: %s", GT)
         else:
-            print(f"[WARNING] Skipping GT param creation for patient {patient_number}.")
-    
-        return (NOPD, TS, GT_bladder_rectum_only, GT)
+            logger.warning("Skipping GT param creation for patient %s.", patient_number)
+
+        skipped = self.preflight_skips(patient_dir)
+        tags = (self.configs.NOPD, self.configs.TS, self.configs.GT_BLADDER_RECTUM_ONLY, self.configs.GT)
+        if skipped & set(tags):
+            logger.warning("[PREFLIGHT] Not registering %s", ", ".join(sorted(skipped & set(tags))))
+        return tuple(flag and tag not in skipped for tag, flag in zip(tags, (NOPD, TS, GT_bladder_rectum_only, GT)))
 
 
     def start_registration(self, patient_dir, flags, force):
         
         reg_vol_dir = os.path.join(patient_dir, self.configs.REGISTERED_VOLUMES_DIR)
-        is_skip = self._utils.replace_or_skip(reg_vol_dir, force)
-        if is_skip:
+        vf_dir = os.path.join(patient_dir, self.configs.VF_VOLUMES_DIR)
+        # resume=True: registrations finished before an interruption stay in the partial folders
+        with staged_dirs([reg_vol_dir, vf_dir], force, resume=True, scratch=self._scratch) as partials:
+            if partials is None:
+                return
+            reg_out, vf_out = partials
+
+            NOPD, TS, GT_bladder_rectum_only, GT = flags
+            params_dir = os.path.join(patient_dir, self.configs.REGISTER_PARAMS_DIR)
+            # Registered volumes the scratch tier does not copy back are committed empty, so once the local cache is
+            # evicted a reopened stage only finds the VFs; those decide what is already registered
+            vf_resume = self._scratch is not None and not self._scratch.is_durable(reg_vol_dir)
+
+            if NOPD:
+                self.register(params_dir, self.configs.NOPD, reg_out, vf_out, vf_resume)
+            else:
+                logger.warning("NOPD Params file not created")
+
+            if TS:
+                self.register(params_dir, self.configs.TS, reg_out, vf_out, vf_resume)
+            else:
+                logger.warning("TS Params file not created")
+
+            if GT_bladder_rectum_only:
+                self.register(params_dir, self.configs.GT_BLADDER_RECTUM_ONLY, reg_out, vf_out, vf_resume)
+            else:
+                logger.warning("GT Bladder Only Params file not created")
+
+            if GT:
+                self.register(params_dir, self.configs.GT, reg_out, vf_out, vf_resume)
+            else:
+                logger.warning("GT Params file not created")
+
+            shutil.rmtree(os.path.join(reg_out, ".work"), ignore_errors=True)
+            if self.configs.vf_storage != "nrrd":
+                self.compress_vfs(vf_out)
+            # Registrations preflight skipped keep the stage pending; a later attempt keeps the ones done here
+            skipped = self.preflight_skips(patient_dir) & {self.configs.NOPD, self.configs.TS, self.configs.GT_BLADDER_RECTUM_ONLY, self.configs.GT}
+            for partial in partials:
+                record_skipped(partial, skipped)
+
+    def register(self, params_dir, tag, reg_out, vf_out, vf_resume=False):
+        # plastimatch writes into .work/ through a copy of the params file, outputs move into the partial
+        # folders only after a clean exit, so a kill never leaves a half-written VF that looks finished.
+        # vf_resume: the VF alone marks a finished registration (its registered volume may not be kept)
+        img_path = os.path.join(reg_out, f"{tag}.nrrd")
+        vf_path = os.path.join(vf_out, f"{self.configs.VF_PREFIX}{tag}.nrrd")
+        if (vf_resume or os.path.exists(img_path)) and (os.path.exists(vf_path) or os.path.exists(vf_store.compressed_vf_path(vf_path))):
+            logger.info("[RESUME] %s registration kept from the interrupted run", tag)
             return
 
-        NOPD, TS, GT_bladder_rectum_only, GT = flags
-        params_dir = os.path.join(patient_dir, self.configs.REGISTER_PARAMS_DIR)
+        work_dir = os.path.join(reg_out, ".work")
+        os.makedirs(work_dir, exist_ok=True)
+        work_img, work_vf = os.path.join(work_dir, os.path.basename(img_path)), os.path.join(work_dir, os.path.basename(vf_path))
+        params_txt = retarget_params_txt(os.path.join(params_dir, f"{tag}.txt"), os.path.join(work_dir, f"{tag}.txt"), work_img, work_vf)
+        result = self._plastimatch.register(params_txt)
+        if result is None or not (os.path.exists(work_img) and os.path.exists(work_vf)):
+            logger.error("%s registration produced no outputs", tag)
+            return
+        os.replace(work_vf, vf_path)
+        os.replace(work_img, img_path)
 
-        if NOPD:
-            params_txt = os.path.join(params_dir, f"{self.configs.NOPD}.txt")
-            self._plastimatch.register(params_txt)
-        else:
-            print("NOPD Params file not created")
+    def compress_vfs(self, vf_dir):
+        for vf_nrrd in glob(f"{vf_dir}/{self.configs.VF_PREFIX}*.nrrd"):
+            try:
+                vfz_path, max_error = vf_store.compress_vf(vf_nrrd, dtype=self.configs.vf_storage, chunk_slices=self.configs.vf_chunk_slices)
+                logger.info("[VF] %s: %s -> %s bytes, max displacement error %.4f mm", os.path.basename(vfz_path), os.path.getsize(vf_nrrd), os.path.getsize(vfz_path), max_error)
+                if max_error > self.configs.vf_max_error_mm:
+                    logger.warning("VF error above %s mm, keeping float32 %s", self.configs.vf_max_error_mm, vf_nrrd)
+                    os.remove(vfz_path)
+                else:
+                    os.remove(vf_nrrd)
+            except Exception as e:
+                logger.error("VF compression failed for %s: %s", vf_nrrd, e)
 
-        if TS:
-            params_txt = os.path.join(params_dir, f"{self.configs.TS}.txt")
-            self._plastimatch.register(params_txt)
-        else:
-            print("TS Params file not created")
-        
-        if GT_bladder_rectum_only:
-            params_txt = os.path.join(params_dir, f"{self.configs.GT_BLADDER_RECTUM_ONLY}.txt")
-            self._plastimatch.register(params_txt)
-        else:
-            print("GT Bladder Only Params file not created")
+    def _warp_with_vf(self, input, output_cmd, output, vf_task):
+        self._plastimatch.warp(input, output_cmd, output, vf_task.result())
 
-        if GT:
-            params_txt = os.path.join(params_dir, f"{self.configs.GT}.txt")
-            self._plastimatch.register(params_txt)
-        else:
-            print("GT Params file not created")
+    def resolve_vf(self, patient_dir, tag, vf_dir=None, jac_dir=None):
+        # Registered VFs are either plastimatch's float32 NRRD or a compressed .vfz that is materialized on demand.
+        # Called once per VF and warp stage (one task per tag). The quality metrics read the field in z-slabs with
+        # -vq (NRRD slabs straight from the file, .vfz chunks), or whole; plastimatch reads the NRRD itself.
+        vf_dir = vf_dir or os.path.join(patient_dir, self.configs.VF_VOLUMES_DIR)
+        vf = os.path.join(vf_dir, f"{self.configs.VF_PREFIX}{tag}.nrrd")
+        vfz = vf_store.compressed_vf_path(vf)
+        cached_vf = os.path.join(vf_dir, self.configs.VF_CACHE_DIR, os.path.basename(vf))
+
+        if os.path.exists(vf) or not os.path.exists(vfz):
+            if os.path.exists(vf) and self.configs.vf_quality:
+                reader = streaming.SlabReader(vf)
+                self.calculate_vf_quality(patient_dir, tag, reader.read, reader, jac_dir)
+            return vf
+
+        chunked = self.configs.vf_quality_chunk_slices
+        with vf_store.VectorFieldStore(vfz) as store:
+            if self.configs.vf_quality and chunked:
+                self.calculate_vf_quality(patient_dir, tag, store.read_slab, store, jac_dir)
+            vf_img = store.to_image()
+            if self.configs.vf_quality and not chunked:
+                # Whole-field metrics hold the decoded field anyway, they share it with the float32 copy
+                vf_array = sitk.GetArrayViewFromImage(vf_img)
+                self.calculate_vf_quality(patient_dir, tag, lambda z0, z1: vf_array[z0:z1], store, jac_dir)
+        os.makedirs(os.path.dirname(cached_vf), exist_ok=True)
+        sitk.WriteImage(vf_img, cached_vf)
+        return cached_vf
+
+    def calculate_vf_quality(self, patient_dir, tag, read_slab, geometry, jac_dir=None):
+        # read_slab(z0, z1) -> (z, y, x, 3) displacements; geometry has size/spacing/origin/direction. The chunked mode
+        # reads and scores chunk_slices z-slices at a time and streams the Jacobian map to disk
+        size, spacing, origin, direction = geometry.size, geometry.spacing, geometry.origin, geometry.direction
+        jac_path = os.path.join(jac_dir, f"{self.configs.JAC_PREFIX}{tag}.nrrd") if jac_dir and self.configs.save_jacobian_maps else None
+        try:
+            chunk_slices = self.configs.vf_quality_chunk_slices
+            if chunk_slices:
+                jac_writer = streaming.SlabWriter(jac_path, size, spacing, origin, direction, np.float32) if jac_path else None
+                summary = vf_metrics.vf_quality_chunked(read_slab, size[2], spacing, direction, chunk_slices,
+                                                        jac_slab_callback=(lambda z0, jac_slab: jac_writer.write(jac_slab)) if jac_writer else None)
+                if jac_writer is not None:
+                    jac_writer.close()
+            else:
+                summary, jac = vf_metrics.vf_quality(read_slab(0, size[2]), spacing, direction)
+                if jac_path:
+                    sitk.WriteImage(vf_metrics.jacobian_image(jac, spacing, origin, direction), jac_path)
+        except Exception as e:
+            logger.error("VF quality calculation failed for %s: %s", tag, e)
+            return
+
+        logger.info("[VF] %s: folding %.4f%%, jacobian [%.3f, %.3f], |u| p95 %.2f mm", tag, 100 * summary['folding_fraction'],
+                    summary['jac_min'], summary['jac_max'], summary['disp_p95_mm'])
+        self.merged_vf_quality.append({
+            self.configs.PATIENT_NUM_KEY: self._utils.get_patient_number(patient_dir),
+            self.configs.REGISTRATION_KEY: tag,
+            **summary
+        })
 
     def start_warp(self, patient_dir, force):
-        warps_dir = os.path.join(patient_dir, self.configs.WARPS_DIR)
-        is_skip = self._utils.replace_or_skip(warps_dir, force)
-        if is_skip: return
+        with staged_dir(os.path.join(patient_dir, self.configs.WARPS_DIR), force, scratch=self._scratch) as warps_dir:
+            if warps_dir is not None:
+                with self.read_dir(os.path.join(patient_dir, self.configs.VF_VOLUMES_DIR)) as vf_dir:
+                    self._start_warp(patient_dir, warps_dir, vf_dir)
+
+    @contextmanager
+    def read_dir(self, final_dir):
+        # The scratch tier's cached copy of a committed folder when it has a current one, else the folder itself
+        if self._scratch is None:
+            yield final_dir
+            return
+        with self._scratch.reading(final_dir) as path:
+            yield path
 
+    def _start_warp(self, patient_dir, warps_dir, vf_dir):
         warps_seg_dir = os.path.join(warps_dir, self.configs.SEGMENTS)
         patient_number, TS_roi_subset = self._utils.get_roi_subset(patient_dir)
-        input_dir = os.path.join(patient_dir, self.configs.GT_CONTOURS_DIR, self.configs.CBCT_DIR)
-        vf_dir = os.path.join(patient_dir, self.configs.VF_VOLUMES_DIR)
-        ct_gt_contours_path = os.path.join(patient_dir, self.configs.GT_CONTOURS_DIR, self.configs.CT_DIR)
+        input_dir = os.path.join(patient_dir, self.configs.gt_contours_dir(self.configs.CBCT_DIR))
+        ct_gt_contours_path = os.path.join(patient_dir, self.configs.gt_contours_dir(self.configs.CT_DIR))
+
+        # Each VF is loaded (and scored) by one task; the warps using it start as soon as it is ready
+        graph = self.structure_tasks()
+        vf_tasks = {}
+        skipped = self.preflight_skips(patient_dir)
+
+        def warp(input, output_cmd, output, tag, required=True):
+            if tag in skipped:
+                return
+            if tag not in vf_tasks:
+                # Jacobian maps are committed with the warps, the VFs folder is already committed
+                vf_tasks[tag] = graph.add(self.resolve_vf, patient_dir, tag, vf_dir, warps_dir, required=required)
+            graph.add(self._warp_with_vf, input, output_cmd, output, vf_tasks[tag], after=[vf_tasks[tag]], required=required)
 
-        if (str(patient_number) in self.configs.patients_with_GT) and (os.path.exists(ct_gt_contours_path)):
+        if (str(patient_number) in self.configs.patients_with_GT) and (os.path.exists(ct_gt_contours_path)) \
+                and GT_WARPS not in skipped:
 
             for segment in self.configs.GT_roi_subset:
                 input = os.path.join(input_dir, f"{segment}.mha")
                 # Warping the segment with VF_GT.nrrd
                 output = os.path.join(warps_seg_dir, f"{self.configs.WARP_PREFIX}{self.configs.GT}_{segment}.mha")
-                vf = os.path.join(vf_dir, f"{self.configs.VF_PREFIX}{self.configs.GT}.nrrd")
-                self._plastimatch.warp(input, "output-img", output, vf)
-                
+                warp(input, "output-img", output, self.configs.GT)
+
                 # Warping the segment with VF_NOPD.nrrd
                 output = os.path.join(warps_seg_dir, f"{self.configs.WARP_PREFIX}{self.configs.NOPD}_{segment}.mha")
-                vf = os.path.join(vf_dir, f"{self.configs.VF_PREFIX}{self.configs.NOPD}.nrrd")
-                self._plastimatch.warp(input, "output-img", output, vf)
-                
+                warp(input, "output-img", output, self.configs.NOPD)
+
                 # Warping the segment with VF_GT_bladder_only.nrrd
                 output = os.path.join(warps_seg_dir, f"{self.configs.WARP_PREFIX}{self.configs.GT_BLADDER_RECTUM_ONLY}_{segment}.mha")
-                vf = os.path.join(vf_dir, f"{self.configs.VF_PREFIX}{self.configs.GT_BLADDER_RECTUM_ONLY}.nrrd")
-                self._plastimatch.warp(input, "output-img", output, vf)
-                
-                try:
-                    # Warping the segment with VF_TS.nrrd
-                    output = os.path.join(warps_seg_dir, f"{self.configs.WARP_PREFIX}{self.configs.TS}_{segment}.mha")
-                    vf = os.path.join(vf_dir, f"{self.configs.VF_PREFIX}{self.configs.TS}.nrrd")
-                    self._plastimatch.warp(input, "output-img", output, vf)
-                except Exception as e:
-                    print(e)
-
-            
+                warp(input, "output-img", output, self.configs.GT_BLADDER_RECTUM_ONLY)
+
+                # Warping the segment with VF_TS.nrrd, failures are logged only
+                output = os.path.join(warps_seg_dir, f"{self.configs.WARP_PREFIX}{self.configs.TS}_{segment}.mha")
+                warp(input, "output-img", output, self.configs.TS, required=False)
+
             # Warping for fiducial markers
             filename = f"{patient_number}-{self.configs.CBCT_DIR}-fdm.fcsv"
             input = os.path.join(patient_dir, self.configs.FDMS_DIR, filename)
-            for vf in glob(f"{vf_dir}/*"):
-                output = os.path.basename(vf).removeprefix(self.configs.VF_PREFIX).removesuffix('.nrrd')
-                output = os.path.join(warps_dir, self.configs.FCVS, f"{self.configs.WARP_PREFIX}{output}_{filename}")
-                self._plastimatch.warp(input, "output-pointset", output, vf)
+            vf_tags = {
+                os.path.basename(vf).removeprefix(self.configs.VF_PREFIX).removesuffix('.nrrd').removesuffix(vf_store.VFZ_SUFFIX)
+                for vf in glob(f"{vf_dir}/{self.configs.VF_PREFIX}*")
+            } if FDM_WARPS not in skipped else set()
+            for tag in sorted(vf_tags):
+                output = os.path.join(warps_dir, self.configs.FCVS, f"{self.configs.WARP_PREFIX}{tag}_{filename}")
+                warp(input, "output-pointset", output, tag)
 
-        try:
-            for segment in TS_roi_subset:
-                # Warping the segment with VF_TS.nrrd
-                input = os.path.join(patient_dir, self.configs.LT_CBCT_SEG_DIR, f"{segment}.nrrd")
-                output = os.path.join(warps_seg_dir, f"{self.configs.WARP_PREFIX}{self.configs.TS}_{segment}.mha")
-                vf = os.path.join(vf_dir, f"{self.configs.VF_PREFIX}{self.configs.TS}.nrrd")
-                self._plastimatch.warp(input, "output-img", output, vf)
-        except Exception as e:
-            print(e)
+        for segment in TS_roi_subset:
+            # Warping the segment with VF_TS.nrrd
+            input = os.path.join(patient_dir, self.configs.LT_CBCT_SEG_DIR, f"{segment}.nrrd")
+            output = os.path.join(warps_seg_dir, f"{self.configs.WARP_PREFIX}{self.configs.TS}_{segment}.mha")
+            warp(input, "output-img", output, self.configs.TS, required=False)
+        graph.run()
+        record_skipped(warps_dir, skipped)
+
+        # Drop float32 copies materialized from compressed VFs
+        shutil.rmtree(os.path.join(vf_dir, self.configs.VF_CACHE_DIR), ignore_errors=True)
 
 
     # def calculate_fiducial_sep(self, patient_dir):
@@ -318,244 +847,311 @@ class EvaluationPipeline:
     #             self.FD_SEP_df[key].append("inf")
 
 
-    def write_results(self, all, metric, fiducial_sep):
-        results_dir = os.path.join(self.configs.RESULTS_DIR, datetime.now().strftime('%Y_%m_%d-%H_%M') + "_" + str(uuid4())[:4])
-        os.makedirs(results_dir, exist_ok=True)
-    
-        with open(os.path.join(results_dir, "config_summary.txt"), "w") as f:
-            f.write(f"use_generated_ct_everywhere: {self.configs.use_generated_ct_everywhere}\n")
-            f.write(f"use_generated_ct_for_segmentation: {self.configs.use_generated_ct_for_segmentation}\n")
-            f.write(f"use_extended_ts_organs: {self.configs.use_extended_ts_organs}\n")
-            f.write(f"LAMBDA: {self.configs.LAMBDA}\n")
-            f.write(f"Timestamp: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
-    
-        # Save global metrics to run-specific folder
-        if all or metric:
-            df_dice = pd.DataFrame(self.merged_dice)
-            df_hd = pd.DataFrame(self.merged_hd)
-            df_dice.to_csv(os.path.join(results_dir, self.configs.DICE_CSV_FILENAME), index=False)
-            df_hd.to_csv(os.path.join(results_dir, self.configs.HD_CSV_FILENAME), index=False)
-    
-        if all or fiducial_sep:
-            df_fd = pd.DataFrame(self.FD_SEP_df)
-            df_fd.to_csv(os.path.join(results_dir, self.configs.FD_SEP_CSV_FILENAME), index=False)
-    
-        # Always update merged results
-        merged_dir = os.path.join(self.configs.RESULTS_DIR, "merged_all")
-        os.makedirs(merged_dir, exist_ok=True)
-        pd.DataFrame(self.merged_dice).to_csv(os.path.join(merged_dir, "merged_dice.csv"), index=False)
-        pd.DataFrame(self.merged_hd).to_csv(os.path.join(merged_dir, "merged_hd.csv"), index=False)
+    def score_preview(self, patient_dir):
+        # The evaluator reads the full-resolution GT contours; preview warps are compared with the downsampled CT GT
+        # contours written by preview_inputs, so both sides are on the preview grid
+        patient_number = self._utils.get_patient_number(patient_dir)
+        reference_dir = os.path.join(patient_dir, self.configs.gt_contours_dir(self.configs.CT_DIR))
+        warps_seg_dir = os.path.join(patient_dir, self.configs.WARPS_DIR, self.configs.SEGMENTS)
+        rows = []
+        for tag in (self.configs.GT, self.configs.NOPD, self.configs.GT_BLADDER_RECTUM_ONLY, self.configs.TS):
+            for segment in self.configs.GT_roi_subset:
+                reference_path = os.path.join(reference_dir, f"{segment}.mha")
+                warp_path = os.path.join(warps_seg_dir, f"{self.configs.WARP_PREFIX}{tag}_{segment}.mha")
+                if not (os.path.exists(reference_path) and os.path.exists(warp_path)):
+                    continue
+                # Warps are on the VF grid; Hausdorff needs both masks on one grid
+                reference = sitk.ReadImage(reference_path)
+                warped = self._utils.resample_to_reference(sitk.ReadImage(warp_path), reference)
+                row = {self.configs.PATIENT_NUM_KEY: patient_number, self.configs.REGISTRATION_KEY: tag,
+                       "dice": api.dice(reference, warped)}
+                # Hausdorff is undefined for an empty mask
+                if sitk.GetArrayViewFromImage(reference).any() and sitk.GetArrayViewFromImage(warped).any():
+                    row["hd"], row["avghd"] = api.hausdorff(reference, warped)
+                rows.append((segment, row))
+        for segment, row in rows:
+            self.preview_scores += results_store.melt_rows([row], self.configs.VARIANT_TAG, self.configs.PATIENT_NUM_KEY,
+                                                           self.configs.REGISTRATION_KEY, structure=segment)
+        logger.info("[PREVIEW] %s warp(s) scored against the downsampled GT contours", len(rows))
 
-    def evaluate(self, data: str, force: bool=False, nums: List[int]=[], all: bool=False, seg: bool=False,
-                 pw_linear: bool=False, dmap: bool=False, cxt: bool=False, fcsv: bool=False,
-                 params: bool=False, register: bool=False, warp: bool=False, metric: bool=False,
-                 fiducial_sep: bool=False, shared_variant: str = None):
-        # Create the structure_tables_<variant> folder path
-        log_dir = os.path.join(self.configs.RESULTS_DIR, f"structures_tables_{self.configs.VARIANT_TAG}")
-        os.makedirs(log_dir, exist_ok=True)
-        log_path = os.path.join(log_dir, f"log_{self.configs.VARIANT_TAG}.txt")
-        
-        log_file = open(log_path, "w")
-        sys.stdout = log_file
-        sys.stderr = log_file
-        print("--------------------------------------------------")
-        print("PIPELINE CONFIGURATION:")
-        if self.configs.use_generated_ct_everywhere:
-            print("  - Using Generated CT everywhere (no pw-linear)")
-        elif self.configs.use_generated_ct_for_segmentation:
-            print("  - Using Generated CT only for segmentation")
-        else:
-            print("  - Using CBCT + pw-linear for input")
-    
-        if self.configs.use_extended_ts_organs:
-            print("  - Using extended TS organs (colon, Femurs and Hips)")
+    def record_scores(self, records):
+        # Upserts this run's scores; only the per-structure tables they touch are rewritten
+        if not records:
+            return
+        store_path = self.configs.results_path(self.configs.RESULTS_STORE_PATH)
+        run_id = self.run_id or datetime.now().strftime("%Y%m%d-%H%M%S") + "-unrecorded"
+        with results_store.ResultsStore(store_path) as store:
+            tables = store.record(records, run_id)
+            store.publish(self.scores_dir(), tables, self.configs.PATIENT_NUM_KEY, self.configs.REGISTRATION_KEY,
+                          self.configs.VF_QUALITY_CSV_FILENAME)
+        logger.info("[SCORES] %s score(s) recorded in %s, %s table(s) refreshed", len(records), store_path, len(tables))
+
+    def scores_dir(self):
+        if self.configs.partition:
+            return os.path.join(self.configs.PARTITIONS_DIR, self.configs.partition)
+        return os.path.join(self.configs.RESULTS_DIR, "merged_all")
+
+    @contextmanager
+    def stage(self, name, patient_dir):
+        # Admission under the RAM/CPU budgets; the measured usage feeds the cost model for later runs and the trace
+        monitor = None
+        start = time.perf_counter()
+        try:
+            with self._scheduler.stage(name, str(self._utils.get_patient_number(patient_dir))) as monitor:
+                progress.info("%s started", name)
+                yield monitor
+        except Exception:
+            progress.info("%s FAILED after %.1f s", name, time.perf_counter() - start)
+            raise
         else:
-            print("  - Using bladder-only segmentation")
-        print("--------------------------------------------------\n")
-        skip_gt_related = shared_variant is not None
-        if skip_gt_related:
-            print(f"[INFO] Skipping GT/NOPD-related steps. Reusing results from: {shared_variant}")
-        
-        evaluator = Evaluator(self.configs, self._utils, self._plastimatch)
+            progress.info("%s done in %.1f s", name, time.perf_counter() - start)
+        finally:
+            if monitor is not None and self._tracer is not None:
+                self._tracer.record(monitor.usage)
 
-        data = data if len(nums)==0 else [data[i] for i in nums]
-        for patient_dir in data:
-            print("--------------------------------------------------------------------")
-            print(f"\t START: {patient_dir}")
-            print("--------------------------------------------------------------------")
-            try:
+    def stage_outputs(self, name, patient_dir):
+        # Folders a stage commits; params and metric are cheap and always rerun
+        outputs = {
+            "preview": [self.configs.PREVIEW_DIR],
+            "pw_linear": [self.configs.LT_CBCT_DIR],
+            "segmentation": [self.configs.LT_CBCT_SEG_DIR, self.configs.CT_SEG_DIR],
+            "dmap": [self.configs.DMAPS_DIR],
+            "cxt": [self.configs.CXTS_DIR],
+            "fcsv": [self.configs.FCVS_DIR],
+            "register": [self.configs.REGISTERED_VOLUMES_DIR, self.configs.VF_VOLUMES_DIR],
+            "warp": [self.configs.WARPS_DIR],
+        }.get(name, [])
+        outputs = [os.path.join(patient_dir, d) for d in outputs]
+        if name == "segmentation":
+            outputs += self.uncropped_dirs(patient_dir)
+        return outputs
+
+    def is_stage_committed(self, name, patient_dir):
+        if name == "decode":
+            return all(series_cache.is_current(os.path.join(patient_dir, s),
+                                               series_cache.cache_path(patient_dir, s, self.configs.SERIES_CACHE_DIR))
+                       for s in self.cached_series(patient_dir))
+        if self.legacy_outputs(name, patient_dir):
+            return True
+        outputs = self.stage_outputs(name, patient_dir)
+        if not outputs or not all(is_committed(p) for p in outputs):
+            return False
+        # Work preflight skipped keeps the stage pending, unless this run's preflight skips it again
+        if set().union(*(skipped_work(p) for p in outputs)) - self.preflight_skips(patient_dir):
+            return False
+        return name != "segmentation" or is_step_done(os.path.join(patient_dir, self.configs.get_eval_dir()), "crop")
+
+    def legacy_outputs(self, name, patient_dir):
+        # With --adopt-legacy, the folders of a stage written before stages were committed, once all its outputs are there
+        outputs = self.stage_outputs(name, patient_dir)
+        if not self.configs.adopt_legacy or not outputs or not all(is_committed(p) or is_legacy(p) for p in outputs):
+            return []
+        return [p for p in outputs if is_legacy(p)]
+
+    def adopt_legacy(self, name, patient_dir):
+        legacy = self.legacy_outputs(name, patient_dir)
+        for path in legacy:
+            adopt(path)
+        # Those runs cropped the segments in place right after segmenting
+        if legacy and name == "segmentation":
+            mark_step(os.path.join(patient_dir, self.configs.get_eval_dir()), "crop")
+
+    def pending(self, name, patient_dir, steps, force):
+        # Committed stages are skipped before admission, so a rerun resumes at the first incomplete stage
+        if not steps[name]:
+            return False
+        if not force and self.is_stage_committed(name, patient_dir):
+            self.adopt_legacy(name, patient_dir)
+            progress.info("%s already committed, skipped", name)
+            return False
+        return True
+
+    def process_patient(self, patient_dir, steps, force, skip_gt_related, evaluator):
+        # Worker threads start with an empty context, tag their records with the patient here
+        with log_context(patient=str(self._utils.get_patient_number(patient_dir)), variant=self.configs.VARIANT_TAG):
+            if self._prefetcher is not None:
+                self._prefetcher.begin(patient_dir)
+            logger.info("START: %s", patient_dir)
+            self._process_patient(patient_dir, steps, force, skip_gt_related, evaluator)
 
-                ## Linear tranform of CBCT
-                if all or pw_linear:
+    def _process_patient(self, patient_dir, steps, force, skip_gt_related, evaluator):
+        try:
+            ## Decode the DICOM series once, later stages read the cached volumes
+            if self.pending("decode", patient_dir, steps, force):
+                with self.stage("decode", patient_dir):
+                    self.decode_series(patient_dir)
+
+            ## Downsampled series and GT contours for --preview
+            if self.pending("preview", patient_dir, steps, force):
+                with self.stage("preview", patient_dir):
+                    self.preview_inputs(patient_dir, force)
+
+            ## Linear tranform of CBCT
+            if self.pending("pw_linear", patient_dir, steps, force):
+                with self.stage("pw_linear", patient_dir):
                     self.pw_linear_transformation(patient_dir, force)
 
-                ## Segmenting the LTCBCT and the CT
-                if all or seg:
-                    ltcbct_path = os.path.join(patient_dir, self.configs.LT_CBCT_DIR)
-                    ltcbct_seg_path = os.path.join(patient_dir, self.configs.LT_CBCT_SEG_DIR)
-                    generatedct_path = os.path.join(patient_dir, self.configs.GENERATED_CT_DIR)
-                 
-                    seg_input_path = (
-                        generatedct_path if (
-                            self.configs.use_generated_ct_everywhere or self.configs.use_generated_ct_for_segmentation
-                        ) else ltcbct_path
-                    )
-                 
-                    roi_subset = [self.configs.TS_BLADDER_CLASS]
-                    # roi_subset = [self.configs.TS_PROSTATE_CLASS]
-
-                    if self.configs.use_extended_ts_organs:
-                        roi_subset += [
-                            self.configs.TS_COLON,
-                            self.configs.TS_FEMUR_LEFT,
-                            self.configs.TS_FEMUR_RIGHT,
-                            self.configs.TS_HIP_LEFT, self.configs.TS_HIP_RIGHT
-                        ]
-                 # self.configs.TS_SACRUM
-
-                 # self.configs.TS_PROSTATE_CLASS
-                    # Segment LT_CBCT (or generated) and CT
-                    self.segmentation(seg_input_path, ltcbct_seg_path, force, roi_subset=roi_subset)
-                    ct_path = os.path.join(patient_dir, self.configs.CT_DIR)
-                    ct_seg_path = os.path.join(patient_dir, self.configs.CT_SEG_DIR)
-                    self.segmentation(ct_path, ct_seg_path, force, roi_subset=roi_subset)
-                    
-                    # Create folders to save uncropped copies
-                    uncropped_ct_dir = os.path.join(patient_dir, f'eval_{self.configs.VARIANT_TAG}', "uncrp_CT_segments")
-                    uncropped_cbct_dir = os.path.join(patient_dir, f'eval_{self.configs.VARIANT_TAG}', "uncrp_LT_CBCT_segments")
-                    os.makedirs(uncropped_ct_dir, exist_ok=True)
-                    os.makedirs(uncropped_cbct_dir, exist_ok=True)
-                    
-                    # Copy uncropped CT segments
-                    for f in glob(f"{ct_seg_path}/*.nrrd"):
-                        shutil.copy(f, os.path.join(uncropped_ct_dir, os.path.basename(f)))
-                    
-                    # Copy uncropped CBCT segments
-                    for f in glob(f"{ltcbct_seg_path}/*.nrrd"):
-                        shutil.copy(f, os.path.join(uncropped_cbct_dir, os.path.basename(f)))
-
-                    # Define output dirs for DMAPs and FCSVs
-                    uncropped_dmap_dir = os.path.join(patient_dir, f'eval_{self.configs.VARIANT_TAG}', "uncropped_dmaps")
-                    uncropped_cxt_dir = os.path.join(patient_dir,  f'eval_{self.configs.VARIANT_TAG}', "uncropped_cxts")
-                    uncropped_fcsv_dir = os.path.join(patient_dir, f'eval_{self.configs.VARIANT_TAG}', "uncropped_fcsvs")
-                    os.makedirs(uncropped_dmap_dir, exist_ok=True)
-                    os.makedirs(uncropped_cxt_dir, exist_ok=True)
-                    os.makedirs(uncropped_fcsv_dir, exist_ok=True)
-                    
-                    # Generate DMAPs from uncropped segments
-                    for seg_dir in [uncropped_ct_dir, uncropped_cbct_dir]:
-                        for seg_path in glob(f"{seg_dir}/*.nrrd"):
-                            class_name = self._utils.get_class_name(seg_path)
-                            dmap_path = os.path.join(uncropped_dmap_dir, f"{class_name}.mha")
-                            self._plastimatch.dmap(seg_path, dmap_path)
-                    
-                    # Convert uncropped CT segments to CXT, then to FCSV
-                    for seg_path in glob(f"{uncropped_ct_dir}/*.nrrd"):
-                        class_name = self._utils.get_class_name(seg_path)
-                        cxt_path = os.path.join(uncropped_cxt_dir, f"{class_name}.cxt")
-                        fcsv_path = os.path.join(uncropped_fcsv_dir, f"{class_name}.fcsv")
-                        csv_path = os.path.join(uncropped_fcsv_dir, f"{class_name}.csv")
-                    
-                        self._plastimatch.convert("input-ss-img", seg_path, "output-cxt", cxt_path)
-                        create_fcsv(cxt_path, fcsv_path, csv_path)
-                        
-                    # Automatically crop larger bladder to match smaller one
-                    # Automatically crop bladder with larger Z-extent to the other
-                    if self.configs.use_extended_ts_organs:
-                        bladder_ct = os.path.join(patient_dir, self.configs.CT_SEG_DIR, f"{self.configs.TS_BLADDER_CLASS}.nrrd")
-                        bladder_cbct = os.path.join(patient_dir, self.configs.LT_CBCT_SEG_DIR, f"{self.configs.TS_BLADDER_CLASS}.nrrd")
-                        self._utils.crop_larger_bladder_to_smaller_extent_by_zmm(bladder_ct, bladder_cbct)
-
-                    # Cropping colon using CBCT sac extent
-                    if self.configs.use_extended_ts_organs and self.configs.crop_colon:
-                        colon_ct_path = os.path.join(patient_dir, self.configs.CT_SEG_DIR, f"{self.configs.TS_COLON}.nrrd")
-                        colon_cbct_path = os.path.join(patient_dir, self.configs.LT_CBCT_SEG_DIR, f"{self.configs.TS_COLON}.nrrd")
-                    
-                        # Apply sac filtering to CBCT colon (with height truncation)
-                        # Keep bottom 30% of lowest colon structure
-                        # Step 1: Crop the CBCT colon with bottom focus (you said leave this unchanged)
-                        self._utils.crop_colon_to_lower_sac(colon_cbct_path, keep_ratio=0.8)
-                        
-                        # Step 2: Use CBCT colon to crop CT colon (now aligned properly!)
-                        self._utils.crop_ct_colon_by_cbct_sac(colon_ct_path, colon_cbct_path)
-                                                
-
-
-                        femur_left_ct = os.path.join(patient_dir, self.configs.CT_SEG_DIR, f"{self.configs.TS_FEMUR_LEFT}.nrrd")
-                        femur_right_ct = os.path.join(patient_dir, self.configs.CT_SEG_DIR, f"{self.configs.TS_FEMUR_RIGHT}.nrrd")
-                        femur_left_cbct = os.path.join(patient_dir, self.configs.LT_CBCT_SEG_DIR, f"{self.configs.TS_FEMUR_LEFT}.nrrd")
-                        femur_right_cbct = os.path.join(patient_dir, self.configs.LT_CBCT_SEG_DIR, f"{self.configs.TS_FEMUR_RIGHT}.nrrd")
-                                        
-                        # self._utils.crop_colon_by_femurs(femur_left_ct, femur_right_ct, colon_ct_path)
-                        # self._utils.crop_colon_by_femurs(femur_left_cbct, femur_right_cbct, colon_cbct_path)
-                    if self.configs.use_extended_ts_organs:
-                        # ----------- Define paths -----------
-                        hip_left_ct = os.path.join(patient_dir, self.configs.CT_SEG_DIR, f"{self.configs.TS_HIP_LEFT}.nrrd")
-                        hip_right_ct = os.path.join(patient_dir, self.configs.CT_SEG_DIR, f"{self.configs.TS_HIP_RIGHT}.nrrd")
-
-                        hip_left_cbct = os.path.join(patient_dir, self.configs.LT_CBCT_SEG_DIR, f"{self.configs.TS_HIP_LEFT}.nrrd")
-                        hip_right_cbct = os.path.join(patient_dir, self.configs.LT_CBCT_SEG_DIR, f"{self.configs.TS_HIP_RIGHT}.nrrd")
-
-                        # sacrum_ct = os.path.join(patient_dir, self.configs.CT_SEG_DIR, f"{self.configs.TS_SACRUM}.nrrd")
-                        # sacrum_cbct = os.path.join(patient_dir, self.configs.LT_CBCT_SEG_DIR, f"{self.configs.TS_SACRUM}.nrrd")
-
-                        # ----------- Crop CT hips using femur pair -----------
-                        self._utils.crop_ct_femur_using_cbct(femur_left_cbct, femur_left_ct)
-                        self._utils.crop_ct_femur_using_cbct(femur_right_cbct, femur_right_ct)                    
-                        # # ----------- Crop CT hips using femur pair -----------
-                        self._utils.crop_hip_by_femurs(hip_left_cbct, hip_left_ct)
-                        self._utils.crop_hip_by_femurs(hip_right_cbct, hip_right_ct)
-                        # # ----------- Crop CT hips using femur pair -----------
-                        # self._utils.crop_hip_by_femurs(sacrum_cbct, sacrum_ct)
-                                                
-
-                ## LT_CBCT dmap calculation from the LTCBCT TS masks and CBCT GT masks
-                if all or dmap:
+            ## Segmenting the LTCBCT and the CT
+            if self.pending("segmentation", patient_dir, steps, force):
+                with self.stage("segmentation", patient_dir):
+                    self.segment_patient(patient_dir, force)
+
+            # Per-structure masks dropped after an earlier scoring run
+            self.ensure_segment_copies(patient_dir, steps, force)
+
+            ## LT_CBCT dmap calculation from the LTCBCT TS masks and CBCT GT masks
+            if self.pending("dmap", patient_dir, steps, force):
+                with self.stage("dmap", patient_dir):
                     self.dmap_calcualtion(patient_dir, force)
 
-                ## CT cxt creation from the CT TS and GT masks
-                if all or cxt:
+            ## CT cxt creation from the CT TS and GT masks
+            if self.pending("cxt", patient_dir, steps, force):
+                with self.stage("cxt", patient_dir):
                     self.cxt_conversion(patient_dir, force)
 
-                ## fcsv files creation
-                if all or fcsv:
+            ## fcsv files creation
+            if self.pending("fcsv", patient_dir, steps, force):
+                with self.stage("fcsv", patient_dir):
                     self.create_fcsvfile(patient_dir, force)
 
-                ## Registers params.txt file creation
-                if all or params or register or warp:
+            ## Registers params.txt file creation
+            if steps["params"]:
+                with self.stage("params", patient_dir):
                     if skip_gt_related:
-                        print("[INFO] Skipping GT/NOPD/GT Bladder Only registration param creation.")
+                        logger.info("Skipping GT/NOPD/GT Bladder Only registration param creation.")
                         NOPD = GT = GT_bladder_rectum_only = False
                         _, TS, _, _ = self.create_register_params(patient_dir, force=True)  # Only create TS params
                     else:
                         NOPD, TS, GT_bladder_rectum_only, GT = self.create_register_params(patient_dir, force)
 
-                ## Start regitration
-                if all or register:
+            ## Start regitration
+            if self.pending("register", patient_dir, steps, force):
+                with self.stage("register", patient_dir):
                     self.start_registration(patient_dir, (NOPD, TS, GT_bladder_rectum_only, GT), force)
 
-                ## Start warping
-                if all or warp:
+            ## Start warping
+            if self.pending("warp", patient_dir, steps, force):
+                with self.stage("warp", patient_dir):
                     self.start_warp(patient_dir, force)
 
+            # ## Calculate scores
+            # if all or fiducial_sep:
+            #     if not skip_gt_related:
+            #         self.calculate_fiducial_sep(patient_dir)
+            #     else:
+            #         print("[INFO] Skipping GT/NOPD fiducial distance calculation.")
 
-                # ## Calculate scores
-                # if all or fiducial_sep:
-                #     if not skip_gt_related:
-                #         self.calculate_fiducial_sep(patient_dir)
-                #     else:
-                #         print("[INFO] Skipping GT/NOPD fiducial distance calculation.")
-                
-                if all or metric:
-                    evaluator.calculate_scores(patient_dir)
+            if steps["metric"]:
+                with self.stage("metric", patient_dir), self._scores_lock:
+                    if self.configs.preview:
+                        self.score_preview(patient_dir)
+                    else:
+                        evaluator.calculate_scores(patient_dir)
+                self.drop_segment_copies(patient_dir)
+        except Exception:
+            logger.exception("Exception for patient: %s", patient_dir)
+            self.failed_patients.append(patient_dir)
 
-                # if all or metric:
-                #     self.calculate_scores(patient_dir)
-            except Exception as e:
-                print(f"Exception for patient: {patient_dir}")
-                print(f"Error: {e}")
-                
-        evaluator.export_scores(os.path.join(self.configs.RESULTS_DIR, "merged_all"))
-        sys.stdout = sys.__stdout__
-        sys.stderr = sys.__stderr__
-        log_file.close()
+    def plan(self, data: str, force: bool=False, nums: List[int]=[], all: bool=False, seg: bool=False,
+             pw_linear: bool=False, dmap: bool=False, cxt: bool=False, fcsv: bool=False,
+             params: bool=False, register: bool=False, warp: bool=False, metric: bool=False):
+        # Dry run of evaluate(): the stages each patient would run and their estimated cost, nothing is executed
+        steps = resolve_steps(all, seg, pw_linear, dmap, cxt, fcsv, params, register, warp, metric, self.configs.cache_series,
+                               self.configs.preview)
+        data = data if len(nums)==0 else [data[i] for i in nums]
+        self.load_manifest(data)
+        return plan_patients(self, data, steps, force)
+
+    def evaluate(self, data: str, force: bool=False, nums: List[int]=[], all: bool=False, seg: bool=False,
+                 pw_linear: bool=False, dmap: bool=False, cxt: bool=False, fcsv: bool=False,
+                 params: bool=False, register: bool=False, warp: bool=False, metric: bool=False,
+                 fiducial_sep: bool=False, shared_variant: str = None):
+        # Create the structure_tables_<variant> folder path
+        log_dir = os.path.join(self.configs.RESULTS_DIR, f"structures_tables_{self.configs.VARIANT_TAG}")
+        if self.configs.partition:
+            log_dir = os.path.join(log_dir, os.path.basename(self.configs.PARTITIONS_DIR), self.configs.partition)
+        os.makedirs(log_dir, exist_ok=True)
+        log_service = LogService(variant_handlers(
+            log_dir, self.configs.VARIANT_TAG, self.configs.log_level, self.configs.console_log_level,
+            self.configs.log_max_mb, self.configs.log_backups
+        ))
+        with log_service, log_context(variant=self.configs.VARIANT_TAG):
+            self._evaluate(log_dir, data, force, nums, all, seg, pw_linear, dmap, cxt, fcsv, params, register, warp, metric, shared_variant)
+
+    def _evaluate(self, log_dir, data, force, nums, all, seg, pw_linear, dmap, cxt, fcsv, params, register, warp, metric, shared_variant):
+        started_at = datetime.now().isoformat(timespec="seconds")
+        self._tracer = Tracer(os.path.join(log_dir, f"trace_{self.configs.VARIANT_TAG}.jsonl"), self.configs.VARIANT_TAG)
+        logger.info("--------------------------------------------------")
+        logger.info("PIPELINE CONFIGURATION:")
+        if self.configs.use_generated_ct_everywhere:
+            logger.info("- Using Generated CT everywhere (no pw-linear)")
+        elif self.configs.use_generated_ct_for_segmentation:
+            logger.info("- Using Generated CT only for segmentation")
+        else:
+            logger.info("- Using CBCT + pw-linear for input")
+    
+        if self.configs.use_extended_ts_organs:
+            logger.info("- Using extended TS organs (colon, Femurs and Hips)")
+        else:
+            logger.info("- Using bladder-only segmentation")
+        logger.info("--------------------------------------------------")
+        skip_gt_related = shared_variant is not None
+        if skip_gt_related:
+            logger.info("Skipping GT/NOPD-related steps. Reusing results from: %s", shared_variant)
+        
+        steps = resolve_steps(all, seg, pw_linear, dmap, cxt, fcsv, params, register, warp, metric, self.configs.cache_series,
+                               self.configs.preview)
+        for stage, seconds in load_stages({**steps, "results": True}).items():
+            logger.debug("[IMPORT] %s modules loaded in %.2f s", stage, seconds)
+        data = data if len(nums)==0 else [data[i] for i in nums]
+        self.load_manifest(data)
+        evaluator = evaluator_module.Evaluator(self.configs, self._utils, self._plastimatch)
+
+        # Longest patients first, so the slowest ones don't become the tail of the batch
+        if self.configs.preflight:
+            data = self.run_preflight(log_dir, data, steps, force)
+        plans = longest_first(plan_patients(self, data, steps, force))
+        data = [plan.patient_dir for plan in plans]
+        logger.info("[PLAN] %s patient(s), estimated %s with %s worker(s)", len(plans),
+                    format_duration(estimate_makespan(plans, self.configs.workers, self.configs.cpu_budget)), self.configs.workers)
+        if self.configs.prefetch_patients:
+            self._prefetcher = Prefetcher(lambda patient_dir: self.prefetch_files(patient_dir, force),
+                                          self.configs.prefetch_patients, self.configs.prefetch_budget_mb).start(data)
+        try:
+            self._scheduler.run(
+                data, lambda patient_dir: self.process_patient(patient_dir, steps, force, skip_gt_related, evaluator),
+                workers=self.configs.workers
+            )
+        finally:
+            if self._prefetcher is not None:
+                self._prefetcher.close()
+        if self._prefetcher is not None:
+            full, started, warmed, total = self._prefetcher.summary()
+            progress.info("[PREFETCH] %s of %s patient(s) fully read ahead, %.1f of %.1f MB (%.0f%% hit rate)",
+                          full, started, warmed / 2**20, total / 2**20, 100 * warmed / total if total else 0)
+            self._prefetcher = None
+        self._cost_model.save()
+        self._tracer.close()
+        self._executor.close()
+        self.close_structure_pool()
+        try:
+            ledger_path = self.configs.results_path(self.configs.LEDGER_PATH)
+            with Ledger(ledger_path) as ledger:
+                self.run_id = ledger.record_run(self.configs, self._tracer.events, started_at)
+            logger.info("[LEDGER] Recorded run %s in %s", self.run_id, ledger_path)
+        except Exception as e:
+            logger.warning("Could not record run in the performance ledger: %s", e)
+
+        # The evaluator's tables only hold this run's patients: they are read back into the store, and the published
+        # tables come from the store, so patients scored by earlier runs are kept
+        export_dir = os.path.join(self.scores_dir(), f".export_{self.configs.VARIANT_TAG}_{os.getpid()}")
+        try:
+            evaluator.export_scores(export_dir)
+            records = results_store.read_tables(export_dir)
+        finally:
+            shutil.rmtree(export_dir, ignore_errors=True)
+        self.record_scores(records + self.preview_scores + results_store.melt_rows(self.merged_vf_quality, self.configs.VARIANT_TAG, self.configs.PATIENT_NUM_KEY,
+                                                             self.configs.REGISTRATION_KEY, structure=results_store.VF_STRUCTURE))
+        if self.configs.profile_top:
+            progress.info("[PROFILE] %s (trace: %s)\n%s", self.configs.VARIANT_TAG, self._tracer.path,
+                          summarize(self._tracer.events, self.configs.profile_top))
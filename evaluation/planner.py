@@ -0,0 +1,87 @@
+import os
+from dataclasses import dataclass, field
+from typing import List, Tuple
+
+
+@dataclass
+class PatientPlan:
+    patient_dir: str
+    patient: str
+    # (stage, estimated wall s, estimated cores) for every stage that would run
+    stages: List[Tuple[str, float, float]] = field(default_factory=list)
+    # Requested stages whose outputs are already committed
+    skipped: List[str] = field(default_factory=list)
+
+    @property
+    def wall_s(self):
+        return sum(wall_s for _, wall_s, _ in self.stages)
+
+    @property
+    def core_s(self):
+        return sum(wall_s * cores for _, wall_s, cores in self.stages)
+
+
+def slice_count(patient_dir, configs, manifest=None):
+    # One DICOM file per CT slice, a cheap size proxy for patients without timing history
+    entry = manifest.get(patient_dir) if manifest is not None else None
+    if entry is not None:
+        return entry.slices(configs.CT_DIR)
+    ct_dir = os.path.join(patient_dir, configs.CT_DIR)
+    return len(os.listdir(ct_dir)) if os.path.isdir(ct_dir) else 0
+
+
+def plan_patients(pipeline, data, steps, force):
+    # Resolves, per patient, which requested stages would run given the committed outputs, and their cost.
+    # Estimates come from the cost model; cohort-level estimates are scaled by the patient's CT slice count.
+    cost_model = pipeline._cost_model
+    counts = {patient_dir: slice_count(patient_dir, pipeline.configs, pipeline.manifest) for patient_dir in data}
+    nonzero = sorted(c for c in counts.values() if c)
+    median = nonzero[len(nonzero) // 2] if nonzero else 0
+
+    plans = []
+    for patient_dir in data:
+        plan = PatientPlan(patient_dir, str(pipeline._utils.get_patient_number(patient_dir)))
+        for stage, requested in steps.items():
+            if not requested:
+                continue
+            if not force and pipeline.is_stage_committed(stage, patient_dir):
+                plan.skipped.append(stage)
+                continue
+            _, cores, wall_s = cost_model.estimate(stage, plan.patient)
+            if median and counts[patient_dir] and not cost_model.has_history(stage, plan.patient):
+                wall_s *= counts[patient_dir] / median
+            plan.stages.append((stage, wall_s, cores))
+        plans.append(plan)
+    return plans
+
+
+def longest_first(plans):
+    return sorted(plans, key=lambda plan: plan.wall_s, reverse=True)
+
+
+def estimate_makespan(plans, workers=1, cpu_budget=0):
+    # Longest-first list scheduling of whole patients onto `workers` workers, bounded below by
+    # the total core-seconds spread over the CPU budget (admission never oversubscribes it)
+    loads = [0.0] * max(workers, 1)
+    for plan in longest_first(plans):
+        loads[loads.index(min(loads))] += plan.wall_s
+    cpu_budget = cpu_budget or os.cpu_count() or 1
+    return max(max(loads), sum(plan.core_s for plan in plans) / cpu_budget)
+
+
+def format_duration(seconds):
+    hours, rest = divmod(int(round(seconds)), 3600)
+    return f"{hours}h{rest // 60:02d}m" if hours else f"{rest // 60}m{rest % 60:02d}s"
+
+
+def format_plan(plans, variant, workers=1, cpu_budget=0) -> str:
+    lines = [f"Plan for {variant}: {len(plans)} patient(s), longest first"]
+    lines.append(f"  {'patient':<10}{'est. wall':>11}  stages to run (committed stages in brackets)")
+    for plan in longest_first(plans):
+        stages = " ".join(f"{stage}:{format_duration(wall_s)}" for stage, wall_s, _ in plan.stages)
+        skipped = f" [{' '.join(plan.skipped)}]" if plan.skipped else ""
+        lines.append(f"  {plan.patient:<10}{format_duration(plan.wall_s):>11}  {stages or '-'}{skipped}")
+    serial = sum(plan.wall_s for plan in plans)
+    lines.append(f"Estimated wall time: {format_duration(estimate_makespan(plans, workers, cpu_budget))} "
+                 f"with {workers} worker(s), {format_duration(serial)} sequential")
+    return "\n".join(lines)
@@ -1,8 +1,28 @@
-import subprocess
+import logging
+from evaluation.executor import PlastimatchExecutor
+
+logger = logging.getLogger(__name__)
+
+PW_LINEAR_CURVE = "7, -981, 142, -895, 560, -112, 605, -97, 628, -90, 630, 38, 665, 55, 679, 96, 797, 255, 1072, 290, 1345, 902"
 
 class Plastimatch:
-    def __init__(self) -> None:
-        pass
+    def __init__(self, executor: PlastimatchExecutor = None, register_timeout_s=None) -> None:
+        self._executor = executor or PlastimatchExecutor()
+        self._register_timeout_s = register_timeout_s
+
+    def _execute(self, command, name, timeout=None):
+        logger.info("Running command: %s", command)
+        try:
+            result = self._executor.run(command, timeout)
+            logger.debug("Plastimatch %s completed successfully.", name)
+            return result
+        except Exception as e:
+            logger.error("Plastimatch %s failed with error: %s", name, e)
+            return None
+
+    def batch(self):
+        # Commands issued on the batch are queued and run concurrently when the `with` block exits
+        return PlastimatchBatch(self._executor, self._register_timeout_s)
 
     def convert(self, input_arg, input_path, output_arg, output_path):
         command = [
@@ -10,13 +30,7 @@ class Plastimatch:
             f"--{input_arg}", input_path,
             f"--{output_arg}", output_path
         ]
-        print(f"Running command: {command}")
-
-        try:
-            subprocess.run(command, stdout=subprocess.PIPE, text=True, check=True)
-            print("Plastimatch convert completed successfully.")
-        except Exception as e:
-            print(f"Error: Plastimatch convert failed with error: {e}")
+        self._execute(command, "convert")
 
 
     def pw_linear_transform(self, input_path, output_path, use_identity=False):
@@ -31,16 +45,10 @@ class Plastimatch:
             command = [
                 "plastimatch", "adjust",
                 "--input", input_path,
-                "--pw-linear", "7, -981, 142, -895, 560, -112, 605, -97, 628, -90, 630, 38, 665, 55, 679, 96, 797, 255, 1072, 290, 1345, 902",
+                "--pw-linear", PW_LINEAR_CURVE,
                 "--output", f"{output_path}.nrrd"
             ]
-    
-        print(f"Running command: {command}")
-        try:
-            subprocess.run(command, stdout=subprocess.PIPE, text=True, check=True)
-            print("Plastimatch adjustment completed successfully.")
-        except Exception as e:
-            print(f"Error: Plastimatch adjustment failed with error: {e}")
+        self._execute(command, "adjustment")
 
 
     def dmap(self, input_path, output_path):
@@ -50,22 +58,12 @@ class Plastimatch:
             "--absolute-distance",
             "--output", output_path
         ]
-        print(f"Running command: {command}")
-        try:
-            subprocess.run(command, stdout=subprocess.PIPE, text=True, check=True)
-            print("Plastimatch dmap calculation completed successfully.")
-        except Exception as e:
-            print(f"Error: Plastimatch dmap calculation with error: {e}")
+        self._execute(command, "dmap calculation")
 
     def register(self, params_filepath):
         command = ["plastimatch", params_filepath]
-        print(f"Running command: {command}")
-        try:
-            subprocess.run(command, stdout=subprocess.PIPE, text=True, check=True)
-            print("Plastimatch register completed successfully.")
-        except Exception as e:
-            print(f"Error: Plastimatch register failed with error: {e}")
-            
+        return self._execute(command, "register", self._register_timeout_s)
+
     def warp(self, input, output_cmd, output, vf):
         command = [
             "plastimatch", "warp",
@@ -73,24 +71,41 @@ class Plastimatch:
             f"--{output_cmd}", output,
             "--xf", vf
         ]
-        print(f"Running command: {command}")
-        try:
-            subprocess.run(command, stdout=subprocess.PIPE, text=True, check=True)
-            print("Plastimatch warp completed successfully.")
-        except Exception as e:
-            print(f"Error: Plastimatch warp failed with error: {e}")
-            
+        self._execute(command, "warp")
+
     def dice(self, segment, warp):
-        result = None
         command = [
             "plastimatch", "dice",
             "--all", segment, warp
         ]
-        print(f"Running command: {command}")
-        try:
-            result = subprocess.run(command, stdout=subprocess.PIPE, text=True, check=True)
-            print("Plastimatch dice completed successfully.")
-        except Exception as e:
-            print(f"Error: Plastimatch dice failed with error: {e}")
-        
-        return result
+        return self._execute(command, "dice")
+
+
+class PlastimatchBatch(Plastimatch):
+    def __init__(self, executor, register_timeout_s=None) -> None:
+        super().__init__(executor, register_timeout_s)
+        self._pending = []
+        self.results = []
+
+    def _execute(self, command, name, timeout=None):
+        self._pending.append((command, name, timeout))
+
+    def run(self):
+        pending, self._pending = self._pending, []
+        logger.debug("Running %s plastimatch commands", len(pending))
+        futures = self._executor.run_batch([(command, timeout) for command, _, timeout in pending])
+        for (command, name, _), future in zip(pending, futures):
+            try:
+                self.results.append(future.result())
+            except Exception as e:
+                logger.error("Plastimatch %s failed for %s with error: %s", name, command, e)
+                self.results.append(None)
+        return self.results
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        # Queued commands run even when the block raised, matching the unbatched behaviour
+        self.run()
+        return False
@@ -0,0 +1,148 @@
+import os
+import logging
+import threading
+from dataclasses import dataclass
+
+logger = logging.getLogger(__name__)
+
+CHUNK_BYTES = 4 * 1024 * 1024
+
+
+@dataclass
+class PrefetchStats:
+    patient: str
+    # Bytes of the patient's input files, and how many of them were read ahead before its processing started
+    total_bytes: int = 0
+    warmed_bytes: int = 0
+
+    @property
+    def hit_rate(self):
+        return self.warmed_bytes / self.total_bytes if self.total_bytes else 0.0
+
+
+class Prefetcher:
+    # Reads the input files of the next `depth` patients on a background thread while the current ones compute,
+    # so they come from the page cache instead of network storage when their stages open them. Bytes read ahead
+    # of patients that haven't started yet stay under budget_mb; a patient's bytes are released once it starts.
+    def __init__(self, files_of, depth=1, budget_mb=2048) -> None:
+        # files_of(patient_dir) -> files in the order the stages read them, listed on the prefetch thread
+        self._files_of = files_of
+        self._depth = depth
+        self._budget = budget_mb * 1024 * 1024
+        self._condition = threading.Condition()
+        self._patients = []
+        self._started = set()
+        self._next = 0
+        self._ahead = 0
+        self._closed = False
+        self._stats = {}
+        self._thread = None
+
+    def start(self, patient_dirs):
+        self._patients = list(patient_dirs)
+        self._thread = threading.Thread(target=self._run, name="prefetch", daemon=True)
+        self._thread.start()
+        return self
+
+    def begin(self, patient_dir):
+        # Called when a patient's processing starts: its read-ahead no longer counts against the budget,
+        # and the window moves on to the patients after it
+        with self._condition:
+            self._started.add(patient_dir)
+            missed = patient_dir not in self._stats
+            stats = self._stats.setdefault(patient_dir, PrefetchStats(patient_dir))
+            self._ahead -= stats.warmed_bytes
+            self._condition.notify_all()
+        if missed:
+            # Never reached by the prefetcher, all of its bytes count as misses
+            stats.total_bytes = sum(size for _, size in self._list(patient_dir))
+        logger.debug("[PREFETCH] %s: %.0f%% of %.1f MB read ahead", patient_dir, 100 * stats.hit_rate, stats.total_bytes / 2**20)
+
+    def _window_open(self, index):
+        # Patient `index` is within `depth` of the furthest started patient; nothing is read before the first one starts
+        if not self._started:
+            return False
+        started = max((i for i, p in enumerate(self._patients) if p in self._started), default=-1)
+        return index <= started + self._depth
+
+    def _run(self):
+        buffer = bytearray(CHUNK_BYTES)
+        while True:
+            with self._condition:
+                while not self._closed and self._next < len(self._patients) and not self._window_open(self._next):
+                    self._condition.wait()
+                if self._closed or self._next >= len(self._patients):
+                    return
+                patient_dir = self._patients[self._next]
+                self._next += 1
+                if patient_dir in self._started:
+                    continue
+                stats = self._stats.setdefault(patient_dir, PrefetchStats(patient_dir))
+            try:
+                self._warm(patient_dir, stats, buffer)
+            except Exception as e:
+                logger.warning("[PREFETCH] %s: %s", patient_dir, e)
+
+    def _list(self, patient_dir):
+        files = []
+        for path in self._files_of(patient_dir):
+            try:
+                files.append((path, os.path.getsize(path)))
+            except OSError:
+                continue
+        return files
+
+    def _warm(self, patient_dir, stats, buffer):
+        files = self._list(patient_dir)
+        stats.total_bytes = sum(size for _, size in files)
+        for path, _ in files:
+            with open(path, "rb", buffering=0) as f:
+                while True:
+                    with self._condition:
+                        while not self._closed and patient_dir not in self._started and self._ahead >= self._budget:
+                            self._condition.wait()
+                        if self._closed or patient_dir in self._started:
+                            return
+                    n = f.readinto(buffer)
+                    if not n:
+                        break
+                    with self._condition:
+                        # Not counted once the patient has started meanwhile, it was a miss by then
+                        if patient_dir in self._started:
+                            return
+                        stats.warmed_bytes += n
+                        self._ahead += n
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def summary(self):
+        # (patients fully read ahead, patients started, warmed bytes, total bytes) over the started patients
+        with self._condition:
+            started = [self._stats[p] for p in self._started if p in self._stats]
+        return (sum(1 for s in started if s.total_bytes and s.warmed_bytes >= s.total_bytes), len(started),
+                sum(s.warmed_bytes for s in started), sum(s.total_bytes for s in started))
+
+
+def patient_files(patient_dir, folders):
+    # Files under the given patient subfolders (or single files), skipping staged .partial folders
+    files = []
+    for folder in folders:
+        path = os.path.join(patient_dir, folder)
+        if os.path.isfile(path):
+            files.append(path)
+            continue
+        for root, dirs, names in os.walk(path):
+            dirs[:] = sorted(d for d in dirs if not d.endswith(".partial"))
+            files += [os.path.join(root, name) for name in sorted(names)]
+    return files
@@ -0,0 +1,179 @@
+import os
+import json
+import logging
+import itertools
+from dataclasses import dataclass, field, asdict
+from typing import List, Optional
+
+from evaluation.stages import lazy_import
+from evaluation.manifest import series_geometry
+
+np = lazy_import("numpy")
+sitk = lazy_import("SimpleITK")
+streaming = lazy_import("evaluation.streaming")
+labelmap = lazy_import("evaluation.labelmap")
+mask_index = lazy_import("evaluation.mask_index")
+
+logger = logging.getLogger(__name__)
+
+# Skip tags besides the registration tags: warps of the GT structures and of the fiducial markers
+GT_WARPS = "gt_warps"
+FDM_WARPS = "fdm"
+# Slack (mm) when checking that a mask lies inside its image
+OVERLAP_TOLERANCE_MM = 1.0
+
+
+@dataclass
+class Problem:
+    # missing / unreadable / empty / geometry
+    check: str
+    path: str
+    reason: str
+    # What is skipped because of it: a registration tag, GT_WARPS or FDM_WARPS; None skips the whole patient
+    tag: Optional[str] = None
+
+
+@dataclass
+class PreflightReport:
+    patient_dir: str
+    patient: str
+    problems: List[Problem] = field(default_factory=list)
+
+    @property
+    def skip_patient(self):
+        return any(p.tag is None for p in self.problems)
+
+    @property
+    def skipped_tags(self):
+        return sorted({p.tag for p in self.problems if p.tag})
+
+    def add(self, check, path, reason, tags=(None,)):
+        for tag in tags:
+            self.problems.append(Problem(check, path, reason, tag))
+
+    def to_dict(self):
+        return {"patient": self.patient, "patient_dir": self.patient_dir, "skip_patient": self.skip_patient,
+                "skipped_tags": self.skipped_tags, "problems": [asdict(p) for p in self.problems]}
+
+
+def read_header(path):
+    # (size, spacing, origin, direction) without reading pixel data
+    if os.path.isdir(path):
+        return series_geometry(path)
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(path)
+    reader.ReadImageInformation()
+    return reader.GetSize(), reader.GetSpacing(), reader.GetOrigin(), reader.GetDirection()
+
+
+def physical_bounds(header):
+    size, spacing, origin, direction = header
+    matrix = np.array(direction).reshape(3, 3)
+    corners = np.array([np.array(origin) + matrix @ (np.array(corner) * np.array(spacing))
+                        for corner in itertools.product(*[(-0.5, s - 0.5) for s in size])])
+    return corners.min(axis=0), corners.max(axis=0)
+
+
+def inside(mask_header, image_header, tolerance=OVERLAP_TOLERANCE_MM):
+    # The mask's extent overlaps the image's, i.e. both are in the same physical space
+    (mask_lo, mask_hi), (image_lo, image_hi) = physical_bounds(mask_header), physical_bounds(image_header)
+    return bool(np.all(mask_lo <= image_hi + tolerance) and np.all(image_lo <= mask_hi + tolerance))
+
+
+class PatientCheck:
+    def __init__(self, report, memory_mb) -> None:
+        self.report = report
+        self.memory_mb = memory_mb
+        self._headers = {}
+
+    def header(self, path, tags=(None,)):
+        # Header of an image or series, None (and a problem for `tags`) when it's missing or unreadable
+        if path not in self._headers:
+            if not os.path.exists(path):
+                self._headers[path] = ("missing", "not found")
+            else:
+                try:
+                    self._headers[path] = read_header(path)
+                except Exception as e:
+                    self._headers[path] = ("unreadable", str(e))
+        header = self._headers[path]
+        if isinstance(header[0], str):
+            self.report.add(header[0], path, header[1], tags)
+            return None
+        return header
+
+    def mask(self, path, image_header, tags):
+        # Readable, inside its image and non-empty; header and emptiness come from the mask index when its entry is
+        # current, otherwise the emptiness check streams z-slabs of the mask
+        stats = mask_index.lookup(path) if os.path.exists(path) else None
+        if stats is not None:
+            header = self._headers.setdefault(path, stats.header)
+        else:
+            header = self.header(path, tags)
+        if header is None:
+            return
+        if image_header is not None and not inside(header, image_header):
+            self.report.add("geometry", path, "outside the image it belongs to", tags)
+        elif (stats.empty if stats is not None else streaming.stream_z_extent(path, self.memory_mb) is None):
+            self.report.add("empty", path, "no foreground voxels", tags)
+
+    def segment(self, seg_dir, name, tags):
+        # A TotalSegmentator structure, from the label map's voxel table when the folder is packed
+        if labelmap.has_labelmap(seg_dir):
+            if not labelmap.LabelMap(seg_dir).voxels.get(name):
+                self.report.add("empty", os.path.join(seg_dir, labelmap.LABELMAP_FILENAME), f"no {name} voxels", tags)
+            return
+        self.mask(os.path.join(seg_dir, f"{name}.nrrd"), None, tags)
+
+
+def preflight_patient(pipeline, patient_dir, steps, force) -> PreflightReport:
+    # Checks every input the patient's pending stages need, from headers and mask bounding boxes only.
+    # Missing images skip the patient; bad contours, empty TS masks or missing FDMs skip the tags using them.
+    c = pipeline.configs
+    patient = str(pipeline._utils.get_patient_number(patient_dir))
+    report = PreflightReport(patient_dir, patient)
+    check = PatientCheck(report, c.stream_memory_mb)
+    pending = {stage for stage, requested in steps.items()
+               if requested and (force or not pipeline.is_stage_committed(stage, patient_dir))}
+
+    def path(*parts):
+        return os.path.join(patient_dir, *parts)
+
+    if "pw_linear" in pending:
+        if c.use_generated_ct_everywhere:
+            check.header(path(c.GENERATED_CT_DIR))
+        elif not (c.fused_preprocessing and os.path.isdir(path(c.RAW_CBCT_DIR))):
+            check.header(path(c.CBCT_DIR))
+    if "segmentation" in pending and (c.use_generated_ct_everywhere or c.use_generated_ct_for_segmentation):
+        check.header(path(c.GENERATED_CT_DIR))
+
+    needs_images = pending & {"segmentation", "register", "warp", "dmap", "cxt"}
+    ct_header = check.header(path(c.CT_DIR)) if needs_images else None
+    cbct_header = None
+    if needs_images and "pw_linear" not in pending:
+        cbct_header = check.header(path(c.LT_CBCT_DIR))
+
+    if patient in c.patients_with_GT and pending & {"dmap", "cxt", "register", "warp"}:
+        for structure in c.GT_roi_subset:
+            tags = [c.GT]
+            if structure in (c.GT_BLADDER_CLASS, c.GT_RECTUM_CLASS):
+                tags.append(c.GT_BLADDER_RECTUM_ONLY)
+            check.mask(path(c.GT_CONTOURS_DIR, c.CT_DIR, f"{structure}.mha"), ct_header, tags)
+            # The CBCT contours are also what every VF warps
+            cbct_tags = tags + ([GT_WARPS] if "warp" in pending else [])
+            check.mask(path(c.GT_CONTOURS_DIR, c.CBCT_DIR, f"{structure}.mha"), cbct_header, cbct_tags)
+        if "warp" in pending:
+            fdm = path(c.FDMS_DIR, f"{patient}-{c.CBCT_DIR}-fdm.fcsv")
+            if not os.path.exists(fdm) or os.path.getsize(fdm) == 0:
+                report.add("missing", fdm, "fiducial markers not found", [FDM_WARPS])
+
+    if "register" in pending and "segmentation" not in pending:
+        for seg_dir in (c.CT_SEG_DIR, c.LT_CBCT_SEG_DIR):
+            check.segment(path(seg_dir), c.TS_BLADDER_CLASS, [c.TS])
+    return report
+
+
+def write_report(path, variant, reports):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump({"variant": variant, "patients": [r.to_dict() for r in reports if r.problems]}, f, indent=2)
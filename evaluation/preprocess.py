@@ -0,0 +1,134 @@
+import os
+import json
+import logging
+import hashlib
+import itertools
+import numpy as np
+import SimpleITK as sitk
+
+from evaluation.plastimatch import PW_LINEAR_CURVE
+
+logger = logging.getLogger(__name__)
+
+
+def read_volume(path) -> sitk.Image:
+    if os.path.isdir(path):
+        reader = sitk.ImageSeriesReader()
+        reader.SetFileNames(reader.GetGDCMSeriesFileNames(path))
+        return reader.Execute()
+    return sitk.ReadImage(path)
+
+
+def source_files(path):
+    if os.path.isdir(path):
+        return sorted(os.path.join(path, f) for f in os.listdir(path))
+    return [path]
+
+
+def parse_pw_linear(curve=PW_LINEAR_CURVE):
+    values = [float(v) for v in curve.split(",")]
+    return np.array(values[0::2]), np.array(values[1::2])
+
+
+def apply_pw_linear(array, curve=PW_LINEAR_CURVE) -> np.ndarray:
+    # Same mapping as `plastimatch adjust --pw-linear`, extrapolating with slope 1 outside the curve
+    xs, ys = parse_pw_linear(curve)
+    mapped = np.interp(array, xs, ys).astype(np.float32)
+    below, above = array < xs[0], array > xs[-1]
+    mapped[below] = ys[0] + (array[below] - xs[0])
+    mapped[above] = ys[-1] + (array[above] - xs[-1])
+    return mapped
+
+
+def find_linear_transform(patient_dir, configs):
+    # Slicer exports live either next to the patient (NNN-LinearTransform.txt) or in the shared LineraTransforms/ folder
+    filename = f"{os.path.basename(os.path.normpath(patient_dir)).split('-')[-1]}-{configs.AFFINE_TRANSFORM_FILENAME}"
+    for candidate in [os.path.join(patient_dir, filename), os.path.join(configs.LINEAR_TRANSFORMS_DIR, filename)]:
+        if os.path.exists(candidate):
+            return candidate
+    return None
+
+
+def _output_grid(image, transform, index_min, index_max):
+    # Axis-aligned grid (input spacing/direction) covering the transformed index box, so translation-only
+    # affines map voxel centres onto voxel centres and the resample is exact
+    inverse = transform.GetInverse()
+    corners = [
+        inverse.TransformPoint(image.TransformContinuousIndexToPhysicalPoint([float(c) for c in corner]))
+        for corner in itertools.product(*zip(index_min, index_max))
+    ]
+    anchor = np.array(inverse.TransformPoint(image.GetOrigin()))
+    direction = np.array(image.GetDirection()).reshape(3, 3)
+    spacing = np.array(image.GetSpacing())
+    local = ((np.array(corners) - anchor) @ direction) / spacing
+    lo, hi = np.floor(local.min(axis=0) + 1e-3), np.ceil(local.max(axis=0) - 1e-3)
+    origin = anchor + direction @ (lo * spacing)
+    size = (hi - lo + 1).astype(int)
+    return [int(s) for s in size], tuple(float(o) for o in origin)
+
+
+def preprocess_cbct(input_path, output_path, affine_path=None, curve=PW_LINEAR_CURVE, fov_threshold=None, default_value=-1000):
+    # One read, HU mapping in memory, affine + optional FOV crop in a single resample, one write
+    image = read_volume(input_path)
+    array = sitk.GetArrayFromImage(image).astype(np.float32)
+    if curve:
+        array = apply_pw_linear(array, curve)
+
+    index_min, index_max = [0, 0, 0], [s - 1 for s in image.GetSize()]
+    if fov_threshold is not None:
+        nz = np.argwhere(array > fov_threshold)
+        if nz.size:
+            index_min, index_max = nz.min(axis=0)[::-1].tolist(), nz.max(axis=0)[::-1].tolist()
+
+    mapped = sitk.GetImageFromArray(array)
+    mapped.CopyInformation(image)
+    del array
+
+    transform = sitk.ReadTransform(affine_path) if affine_path else sitk.AffineTransform(3)
+    size, origin = _output_grid(image, transform, index_min, index_max)
+
+    resample = sitk.ResampleImageFilter()
+    resample.SetTransform(transform)
+    resample.SetInterpolator(sitk.sitkLinear)
+    resample.SetDefaultPixelValue(default_value)
+    resample.SetOutputSpacing(image.GetSpacing())
+    resample.SetOutputDirection(image.GetDirection())
+    resample.SetOutputOrigin(origin)
+    resample.SetSize(size)
+    output = resample.Execute(mapped)
+
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    sitk.WriteImage(output, output_path, useCompression=False)
+    return output_path
+
+
+def preprocess_key(input_path, affine_path, curve, fov_threshold) -> str:
+    hasher = hashlib.sha1()
+    for f in source_files(input_path):
+        stat = os.stat(f)
+        hasher.update(f"{os.path.basename(f)}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+    if affine_path:
+        with open(affine_path, "rb") as f:
+            hasher.update(f.read())
+    hasher.update(f"{curve}|{fov_threshold}".encode())
+    return hasher.hexdigest()
+
+
+def preprocess_cbct_cached(input_path, output_path, affine_path=None, curve=PW_LINEAR_CURVE, fov_threshold=None):
+    # The cached volume sits next to the patient's series and is shared by every variant;
+    # it is rebuilt only when the series, affine, curve or crop setting change
+    key = preprocess_key(input_path, affine_path, curve, fov_threshold)
+    key_path = f"{output_path}.json"
+    if os.path.exists(output_path) and os.path.exists(key_path):
+        with open(key_path) as f:
+            if json.load(f).get("key") == key:
+                logger.info("[CACHE] Reusing preprocessed CBCT: %s", output_path)
+                return output_path
+
+    logger.info("[PREPROCESS] %s -> %s (affine: %s, FOV threshold: %s)", input_path, output_path, affine_path, fov_threshold)
+    tmp_path = f"{output_path}.tmp.nrrd"
+    preprocess_cbct(input_path, tmp_path, affine_path, curve, fov_threshold)
+    os.replace(tmp_path, output_path)
+    with open(key_path, "w") as f:
+        json.dump({"key": key, "input": input_path, "affine": affine_path, "curve": curve, "fov_threshold": fov_threshold}, f, indent=2)
+    return output_path
@@ -0,0 +1,42 @@
+import os
+import logging
+from glob import glob
+
+import SimpleITK as sitk
+
+from evaluation.preprocess import read_volume
+from evaluation.mask_index import write_mask
+
+logger = logging.getLogger(__name__)
+
+
+def shrink_factors(factor):
+    # In-plane only: slices are already 2-3 mm apart, the in-plane grid is where the voxels are
+    return [factor, factor, 1]
+
+
+def downsample_image(image, factor) -> sitk.Image:
+    # Mean of each factor x factor block, the grid stays aligned with the original physical extent
+    return sitk.BinShrink(image, shrink_factors(factor))
+
+
+def downsample_mask(mask, factor) -> sitk.Image:
+    # A coarse voxel is inside when at least half of the fine voxels it covers are
+    fraction = sitk.BinShrink(sitk.Cast(mask > 0, sitk.sitkFloat32), shrink_factors(factor))
+    return sitk.Cast(fraction >= 0.5, sitk.sitkUInt8)
+
+
+def write_preview(series, contour_dirs, out_dir, factor):
+    # series: {name: DICOM folder or volume} written as out_dir/<name>.nrrd; contour_dirs: {subfolder: folder of .mha
+    # masks} written under out_dir/<subfolder>. Masks keep their own grids, downsampled the same way as the images.
+    for name, path in series.items():
+        image = read_volume(path)
+        preview = downsample_image(image, factor)
+        sitk.WriteImage(preview, os.path.join(out_dir, f"{name}.nrrd"))
+        logger.info("[PREVIEW] %s %s -> %s", name, "x".join(map(str, image.GetSize())), "x".join(map(str, preview.GetSize())))
+    for subfolder, contour_dir in contour_dirs.items():
+        masks = sorted(glob(os.path.join(contour_dir, "*.mha")))
+        os.makedirs(os.path.join(out_dir, subfolder), exist_ok=True)
+        for path in masks:
+            write_mask(downsample_mask(sitk.ReadImage(path), factor), os.path.join(out_dir, subfolder, os.path.basename(path)))
+        logger.debug("[PREVIEW] %s contour(s) from %s", len(masks), contour_dir)
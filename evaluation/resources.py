@@ -0,0 +1,117 @@
+import os
+import time
+import threading
+import contextvars
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+_current_monitor = contextvars.ContextVar("resource_monitor", default=None)
+
+
+def current_rss_mb() -> float:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def total_memory_mb() -> float:
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / (1024 * 1024)
+
+
+def io_bytes():
+    # Storage-level (read_bytes, write_bytes) of this process, (0, 0) where /proc/self/io is unavailable
+    try:
+        with open("/proc/self/io") as f:
+            counters = dict(line.split(": ") for line in f.read().splitlines())
+        return int(counters["read_bytes"]), int(counters["write_bytes"])
+    except (OSError, KeyError, ValueError):
+        return 0, 0
+
+
+@dataclass
+class CommandUsage:
+    command: List[str]
+    returncode: int
+    start_time: float
+    wall_s: float
+    cpu_s: float
+    peak_rss_mb: float
+    read_bytes: int
+    write_bytes: int
+
+
+@dataclass
+class StageUsage:
+    stage: str
+    patient: str
+    start_time: float = 0.0
+    wall_s: float = 0.0
+    cpu_s: float = 0.0
+    peak_rss_mb: float = 0.0
+    read_bytes: int = 0
+    write_bytes: int = 0
+    error: Optional[str] = None
+    commands: List[CommandUsage] = field(default_factory=list)
+
+
+def current_monitor():
+    # ResourceMonitor of the stage running in the calling context, None outside a stage
+    return _current_monitor.get()
+
+
+class ResourceMonitor:
+    # Measures one stage: wall time, CPU time of the calling thread plus its subprocesses, and peak RSS.
+    # In-process memory is sampled from /proc while the stage runs, subprocess peaks come from wait4().
+    # In-process I/O comes from /proc/self/io and is process-wide, so it overlaps between concurrent stages.
+    SAMPLE_INTERVAL_S = 0.1
+
+    def __init__(self, stage, patient="") -> None:
+        self.usage = StageUsage(stage, patient)
+        self._stop = threading.Event()
+        self._sampler: Optional[threading.Thread] = None
+        self._token = None
+        self._pool_cpu_s = 0.0
+        self._cpu_lock = threading.Lock()
+
+    def _sample(self):
+        while not self._stop.wait(self.SAMPLE_INTERVAL_S):
+            self._peak_rss = max(self._peak_rss, current_rss_mb())
+
+    def __enter__(self):
+        self.usage.start_time = time.time()
+        self._start_io = io_bytes()
+        self._start_wall = time.perf_counter()
+        self._start_cpu = time.thread_time()
+        self._start_rss = self._peak_rss = current_rss_mb()
+        self._sampler = threading.Thread(target=self._sample, daemon=True)
+        self._sampler.start()
+        self._token = _current_monitor.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _current_monitor.reset(self._token)
+        self._stop.set()
+        self._sampler.join()
+        self._peak_rss = max(self._peak_rss, current_rss_mb())
+        usage = self.usage
+        usage.wall_s = time.perf_counter() - self._start_wall
+        usage.cpu_s = time.thread_time() - self._start_cpu + self._pool_cpu_s + sum(c.cpu_s for c in usage.commands)
+        child_peak = max((c.peak_rss_mb for c in usage.commands), default=0.0)
+        usage.peak_rss_mb = max(self._peak_rss - self._start_rss, child_peak)
+        end_io = io_bytes()
+        usage.read_bytes = end_io[0] - self._start_io[0] + sum(c.read_bytes for c in usage.commands)
+        usage.write_bytes = end_io[1] - self._start_io[1] + sum(c.write_bytes for c in usage.commands)
+        if exc_value is not None:
+            usage.error = f"{exc_type.__name__}: {exc_value}"
+        return False
+
+    def record(self, command_usage):
+        self.usage.commands.append(command_usage)
+
+    def record_cpu(self, cpu_s):
+        # CPU time the stage spent in pool threads (structure fan-out), thread_time() only sees the caller
+        with self._cpu_lock:
+            self._pool_cpu_s += cpu_s
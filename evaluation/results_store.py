@@ -0,0 +1,203 @@
+import os
+import glob
+import sqlite3
+import argparse
+from datetime import datetime
+import pandas as pd
+
+KEY = ["patient", "variant", "registration", "structure", "metric"]
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS scores (
+    run_id TEXT,
+    patient TEXT,
+    variant TEXT,
+    registration TEXT,
+    structure TEXT,
+    metric TEXT,
+    value REAL,
+    recorded_at TEXT,
+    PRIMARY KEY (patient, variant, registration, structure, metric, run_id)
+);
+CREATE TABLE IF NOT EXISTS latest (
+    variant TEXT,
+    structure TEXT,
+    metric TEXT,
+    patient TEXT,
+    registration TEXT,
+    value REAL,
+    run_id TEXT,
+    recorded_at TEXT,
+    PRIMARY KEY (variant, structure, metric, patient, registration)
+);
+"""
+# Structure name of the whole-VF quality metrics
+VF_STRUCTURE = "VF"
+
+
+def melt_rows(rows, variant, patient_key, registration_key, metric=None, structure=None):
+    # Wide score rows ({patient_key, registration_key, <column>: value}) to store records: the other
+    # columns are structures when `metric` is given, metrics of `structure` otherwise
+    records = []
+    for row in rows:
+        for column, value in row.items():
+            if column in (patient_key, registration_key) or value is None or pd.isna(value):
+                continue
+            records.append({
+                "patient": str(row[patient_key]), "variant": variant, "registration": str(row.get(registration_key, "")),
+                "structure": column if metric else structure, "metric": metric or column, "value": float(value),
+            })
+    return records
+
+
+class ResultsStore:
+    # Every recorded score is appended to `scores` under its run id; `latest` holds the newest value
+    # per (variant, structure, metric, patient, registration) and backs the per-structure tables
+    def __init__(self, path) -> None:
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=60)
+        self._conn.executescript(SCHEMA)
+
+    def close(self):
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def record(self, records, run_id):
+        # Upserts records, returns the (variant, structure, metric) tables they touched
+        recorded_at = datetime.now().isoformat(timespec="seconds")
+        rows = [(run_id, *(r[k] for k in KEY), r["value"], recorded_at) for r in records]
+        with self._conn:
+            self._conn.executemany(
+                "INSERT INTO scores VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (patient, variant, registration, structure, metric, run_id) DO UPDATE "
+                "SET value = excluded.value, recorded_at = excluded.recorded_at", rows
+            )
+            self._conn.executemany(
+                "INSERT INTO latest VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (variant, structure, metric, patient, registration) DO UPDATE "
+                "SET value = excluded.value, run_id = excluded.run_id, recorded_at = excluded.recorded_at",
+                [(variant, structure, metric, patient, registration, value, run_id, at)
+                 for run_id, patient, variant, registration, structure, metric, value, at in rows]
+            )
+        return {(r["variant"], r["structure"], r["metric"]) for r in records}
+
+    def merge(self, path):
+        # Folds another store (a partition's) into this one: its scores are added, its latest values replace older ones.
+        # Returns the tables it holds; merging the same store again changes nothing
+        self._conn.execute("ATTACH DATABASE ? AS other", (path,))
+        try:
+            with self._conn:
+                self._conn.execute("INSERT OR IGNORE INTO scores SELECT * FROM other.scores")
+                self._conn.execute(
+                    "INSERT INTO latest SELECT * FROM other.latest WHERE true "
+                    "ON CONFLICT (variant, structure, metric, patient, registration) DO UPDATE "
+                    "SET value = excluded.value, run_id = excluded.run_id, recorded_at = excluded.recorded_at "
+                    "WHERE excluded.recorded_at >= latest.recorded_at"
+                )
+            tables = set(self._conn.execute("SELECT DISTINCT variant, structure, metric FROM other.latest").fetchall())
+        finally:
+            self._conn.execute("DETACH DATABASE other")
+        return tables
+
+    def tables(self, variant=None):
+        query, params = "SELECT DISTINCT variant, structure, metric FROM latest", ()
+        if variant:
+            query, params = query + " WHERE variant = ?", (variant,)
+        return set(self._conn.execute(query, params).fetchall())
+
+    def table(self, variant, structure, metric):
+        # Patients x registrations, newest value of each cell
+        df = pd.read_sql_query(
+            "SELECT patient, registration, value FROM latest WHERE variant = ? AND structure = ? AND metric = ?",
+            self._conn, params=(variant, structure, metric)
+        )
+        return df.pivot(index="patient", columns="registration", values="value").sort_index()
+
+    def long(self, variant, structure=None, metric=None, patient_key="patient", registration_key="registration"):
+        # (patient, registration) rows with one column per metric (structure given) or per structure (metric given)
+        column, other, value = ("metric", "structure", structure) if structure else ("structure", "metric", metric)
+        df = pd.read_sql_query(
+            f"SELECT patient, registration, {column}, value FROM latest WHERE variant = ? AND {other} = ?",
+            self._conn, params=(variant, value)
+        )
+        df = df.pivot_table(index=["patient", "registration"], columns=column, values="value", aggfunc="first")
+        df.columns.name = None
+        return df.reset_index().rename(columns={"patient": patient_key, "registration": registration_key})
+
+    def history(self, patient, variant=None):
+        query, params = "SELECT * FROM scores WHERE patient = ?", [patient]
+        if variant:
+            query += " AND variant = ?"
+            params.append(variant)
+        return pd.read_sql_query(query + " ORDER BY recorded_at", self._conn, params=params)
+
+    def materialize(self, out_dir, tables=None):
+        # Writes structure_tables_<variant>/<structure>_<metric>_table.csv for the given tables (all by default)
+        written = []
+        for variant, structure, metric in sorted(self.tables() if tables is None else tables):
+            table_dir = os.path.join(out_dir, f"structure_tables_{variant}")
+            os.makedirs(table_dir, exist_ok=True)
+            path = os.path.join(table_dir, f"{structure}_{metric}_table.csv")
+            write_csv(self.table(variant, structure, metric), path, index=True)
+            written.append(path)
+        return written
+
+    def publish(self, out_dir, tables, patient_key, registration_key, vf_filename):
+        # materialize() plus the <variant>_<vf_filename> table of every variant whose VF metrics are among the tables
+        written = self.materialize(out_dir, tables)
+        for variant in sorted({variant for variant, structure, _ in tables if structure == VF_STRUCTURE}):
+            path = os.path.join(out_dir, f"{variant}_{vf_filename}")
+            write_csv(self.long(variant, structure=VF_STRUCTURE, patient_key=patient_key, registration_key=registration_key), path)
+            written.append(path)
+        return written
+
+
+def read_tables(out_dir):
+    # Records of the structure_tables_<variant>/<structure>_<metric>_table.csv tables under out_dir (the layout
+    # materialize() and the evaluator's export_scores() write: patients as index, registrations as columns)
+    records = []
+    for path in sorted(glob.glob(os.path.join(out_dir, "structure_tables_*", "*_table.csv"))):
+        variant = os.path.basename(os.path.dirname(path))[len("structure_tables_"):]
+        structure, metric = os.path.basename(path)[:-len("_table.csv")].rsplit("_", 1)
+        # Read as text first, patient ids like 001 stay as they are
+        table = pd.read_csv(path, dtype=str)
+        table = table.set_index(table.columns[0]).apply(pd.to_numeric, errors="coerce")
+        for patient, row in table.iterrows():
+            records.extend({
+                "patient": str(patient), "variant": variant, "registration": str(registration),
+                "structure": structure, "metric": metric, "value": float(value),
+            } for registration, value in row.items() if not pd.isna(value))
+    return records
+
+
+def write_csv(df, path, index=False):
+    # Readers never see a half-written table
+    tmp = f"{path}.tmp"
+    df.to_csv(tmp, index=index)
+    os.replace(tmp, path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Append-only score store")
+    parser.add_argument("--store", type=str, default=os.path.join(os.path.curdir, "results", "results.sqlite"), help="store database")
+    commands = parser.add_subparsers(dest="command", required=True)
+    p = commands.add_parser("materialize", help="rewrite the per-structure tables from the newest scores")
+    p.add_argument("--out", type=str, default=os.path.join(os.path.curdir, "results", "merged_all"))
+    p.add_argument("--variant", type=str, default=None)
+    p = commands.add_parser("history", help="every recorded score of one patient")
+    p.add_argument("patient", type=str)
+    p.add_argument("--variant", type=str, default=None)
+    args = parser.parse_args()
+
+    with ResultsStore(args.store) as store:
+        if args.command == "materialize":
+            for path in store.materialize(args.out, store.tables(args.variant)):
+                print(path)
+        else:
+            print(store.history(args.patient, args.variant).to_string(index=False))
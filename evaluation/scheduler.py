@@ -0,0 +1,174 @@
+import os
+import json
+import fcntl
+import logging
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+from evaluation.resources import ResourceMonitor, total_memory_mb
+
+logger = logging.getLogger(__name__)
+
+# Fallback (peak RSS MB, cores, wall s) for stages without any history yet
+DEFAULT_STAGE_COSTS = {
+    "decode": (1000, os.cpu_count() or 1, 30),
+    "preview": (2000, 1, 30),
+    "pw_linear": (2000, 1, 60),
+    "segmentation": (8000, 4, 600),
+    "dmap": (2000, 1, 120),
+    "cxt": (500, 1, 30),
+    "fcsv": (100, 1, 5),
+    "params": (50, 1, 1),
+    "register": (4000, os.cpu_count() or 1, 1800),
+    "warp": (1500, 1, 120),
+    "metric": (500, 1, 30),
+}
+LIGHT_STAGE_COST = (200, 1, 10)
+
+
+def _read_stages(path):
+    if not path or not os.path.exists(path):
+        return {}
+    try:
+        with open(path) as f:
+            return json.load(f).get("stages", {})
+    except (OSError, ValueError) as e:
+        logger.warning("Ignoring unreadable cost model %s: %s", path, e)
+        return {}
+
+
+class CostModel:
+    # Per-stage, per-patient peak RSS / wall / CPU history, persisted as JSON between runs. Several processes may share
+    # the file: save() merges this process's measurements into the file's current content under a lock.
+    # Peaks of in-process stages are process-wide RSS growth, so stages running concurrently in one process inflate
+    # each other's peak (an overestimate, admission stays on the safe side); subprocess peaks come from wait4() and are exact.
+    # A partition (worker/shard mode) reads the shared model at base_path as well but saves only its own file, which
+    # --merge folds back into the shared one.
+    def __init__(self, path, base_path=None) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self.stages = _read_stages(base_path) if base_path and base_path != path else {}
+        self._absorb(_read_stages(path))
+        # (stage, patient) -> runs measured by this process since the last save
+        self._measured = {}
+
+    def update(self, usage):
+        # Failed stages stop early, their usage would drag the estimates down
+        if usage.error is not None:
+            return
+        with self._lock:
+            entry = self.stages.setdefault(usage.stage, {}).setdefault(usage.patient, {"runs": 0})
+            entry["peak_rss_mb"] = usage.peak_rss_mb
+            entry["wall_s"] = usage.wall_s
+            entry["cpu_s"] = usage.cpu_s
+            entry["runs"] += 1
+            key = (usage.stage, usage.patient)
+            self._measured[key] = self._measured.get(key, 0) + 1
+
+    def has_history(self, stage, patient):
+        with self._lock:
+            return patient in self.stages.get(stage, {})
+
+    def estimate(self, stage, patient):
+        # (peak RSS MB, cores, wall s): the patient's own history first, then the stage's
+        # worst-case peak and median wall over the cohort, then the static defaults
+        with self._lock:
+            history = self.stages.get(stage, {})
+            entry = history.get(patient)
+            if entry is None and history:
+                entries = list(history.values())
+                walls = sorted(e["wall_s"] for e in entries)
+                entry = {
+                    "peak_rss_mb": max(e["peak_rss_mb"] for e in entries),
+                    "wall_s": walls[len(walls) // 2],
+                    "cpu_s": walls[len(walls) // 2] * max(e["cpu_s"] / max(e["wall_s"], 1e-6) for e in entries),
+                }
+        if entry is None:
+            return DEFAULT_STAGE_COSTS.get(stage, LIGHT_STAGE_COST)
+        cores = min(max(entry["cpu_s"] / max(entry["wall_s"], 1e-6), 1.0), os.cpu_count() or 1)
+        return entry["peak_rss_mb"], cores, entry["wall_s"]
+
+    def save(self):
+        if not self.path:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with self._lock, open(f"{self.path}.lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            # Entries other processes wrote since this one loaded the file are kept, the ones measured here replace theirs
+            stages = _read_stages(self.path)
+            for (stage, patient), runs in self._measured.items():
+                entry = self.stages[stage][patient]
+                previous = stages.get(stage, {}).get(patient, {}).get("runs", 0)
+                # Merged entries (runs None) carry their own count
+                total = max(previous, entry["runs"]) if runs is None else previous + runs
+                stages.setdefault(stage, {})[patient] = dict(entry, runs=total)
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump({"stages": stages}, f, indent=2)
+            os.replace(tmp_path, self.path)
+            self._absorb(stages)
+            self._measured = {}
+
+    def _absorb(self, stages):
+        for stage, entries in stages.items():
+            self.stages.setdefault(stage, {}).update(entries)
+
+    def merge(self, path):
+        # Folds another model file (a partition's) into this one; its entries replace ours, keeping the larger run count,
+        # so merging the same partition again changes nothing
+        with self._lock:
+            for stage, entries in _read_stages(path).items():
+                for patient, entry in entries.items():
+                    runs = max(entry.get("runs", 0), self.stages.get(stage, {}).get(patient, {}).get("runs", 0))
+                    self.stages.setdefault(stage, {})[patient] = dict(entry, runs=runs)
+                    self._measured[(stage, patient)] = None
+
+
+class AdmissionScheduler:
+    # Admits a stage only while the estimated RAM and cores of everything running fit the budgets.
+    # Light stages (fcsv, params, scoring) have small estimates, so they run in the gaps left by heavy ones.
+    # A stage is always admitted when nothing else runs, even if its estimate exceeds the budget.
+    def __init__(self, cost_model, ram_budget_mb=0, cpu_budget=0, safety_factor=1.2) -> None:
+        self.cost_model = cost_model
+        self.ram_budget_mb = ram_budget_mb or 0.8 * total_memory_mb()
+        self.cpu_budget = cpu_budget or os.cpu_count() or 1
+        self.safety_factor = safety_factor
+        self._cond = threading.Condition()
+        self._ram_in_use = 0.0
+        self._cpu_in_use = 0.0
+        self._running = 0
+
+    @contextmanager
+    def stage(self, stage, patient):
+        peak_rss_mb, cores, _ = self.cost_model.estimate(stage, patient)
+        ram = min(peak_rss_mb * self.safety_factor, self.ram_budget_mb)
+        cores = min(cores, self.cpu_budget)
+        with self._cond:
+            while self._running and (self._ram_in_use + ram > self.ram_budget_mb or self._cpu_in_use + cores > self.cpu_budget):
+                self._cond.wait()
+            self._ram_in_use += ram
+            self._cpu_in_use += cores
+            self._running += 1
+
+        monitor = ResourceMonitor(stage, patient)
+        try:
+            with monitor:
+                yield monitor
+        finally:
+            with self._cond:
+                self._ram_in_use -= ram
+                self._cpu_in_use -= cores
+                self._running -= 1
+                self._cond.notify_all()
+            self.cost_model.update(monitor.usage)
+
+    def run(self, jobs, fn, workers=1):
+        # Runs fn(job) for every job on `workers` threads, stage admission is gated by stage()
+        if workers <= 1:
+            for job in jobs:
+                fn(job)
+            return
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for future in [pool.submit(fn, job) for job in jobs]:
+                future.result()
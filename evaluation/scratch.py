@@ -0,0 +1,158 @@
+import os
+import shutil
+import hashlib
+import logging
+import threading
+from contextlib import contextmanager
+
+from evaluation.checkpoint import MARKER, PARTIAL_SUFFIX, partial_path, is_committed
+
+logger = logging.getLogger(__name__)
+
+# Written into a cached copy: mtime_ns of the committed folder's marker it was taken from
+ORIGIN_FILENAME = ".origin"
+
+
+def folder_bytes(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def marker_key(final_dir):
+    try:
+        return str(os.stat(os.path.join(final_dir, MARKER)).st_mtime_ns)
+    except OSError:
+        return None
+
+
+class ScratchTier:
+    # Stage folders written on local disk (SSD/tmpfs) under root instead of next to the patient data. At commit only
+    # the folders named in `durable` are copied back to the patient folder; the others are committed there empty
+    # (marker only), so the stage still counts as done. Committed copies stay under root as a read cache, the least
+    # recently used ones evicted once the cache exceeds cap_mb; partials of running stages are never evicted.
+    def __init__(self, root, cap_mb, durable) -> None:
+        self.root = os.path.abspath(root)
+        self.cap = cap_mb * 1024 * 1024
+        self.durable = set(durable)
+        self._lock = threading.Lock()
+        self._pinned = {}
+        os.makedirs(self.root, exist_ok=True)
+
+    def local_dir(self, final_dir):
+        # <root>/<hash of the patient folder>/<eval dir>/<name>, so patients and variants never share an entry
+        final_dir = os.path.abspath(final_dir)
+        parent, name = os.path.split(final_dir)
+        key = hashlib.sha1(os.path.dirname(parent).encode()).hexdigest()[:12]
+        return os.path.join(self.root, key, os.path.basename(parent), name)
+
+    def partial_dir(self, final_dir):
+        return partial_path(self.local_dir(final_dir))
+
+    def is_durable(self, final_dir):
+        return os.path.basename(os.path.normpath(final_dir)) in self.durable
+
+    def copy_back(self, partial, final_dir):
+        # Copies the marked local partial back as <final_dir>.partial (durable content, or nothing) and returns it for
+        # checkpoint's swap; the local partial stays until cache(), so a crash before every swap loses nothing
+        shared = partial_path(final_dir)
+        if os.path.exists(shared):
+            shutil.rmtree(shared)
+        if self.is_durable(final_dir):
+            shutil.copytree(partial, shared, ignore=shutil.ignore_patterns(MARKER))
+        else:
+            os.makedirs(shared)
+        # The marker goes last, a copy cut short is never taken for a committed folder
+        shutil.copy2(os.path.join(partial, MARKER), os.path.join(shared, MARKER))
+        return shared
+
+    def cache(self, partial, final_dir):
+        # After the swap: the local partial becomes the cached copy of the committed folder
+        with open(os.path.join(partial, ORIGIN_FILENAME), "w") as f:
+            f.write(marker_key(final_dir))
+        cached = self.local_dir(final_dir)
+        with self._lock:
+            if os.path.exists(cached):
+                shutil.rmtree(cached, ignore_errors=True)
+            os.rename(partial, cached)
+        logger.debug("[SCRATCH] %s committed (%s), cached in %s", final_dir,
+                     "copied back" if self.is_durable(final_dir) else "not durable", cached)
+        self.evict()
+
+    def cached(self, final_dir):
+        # The cached copy of a committed folder, None when there is none or the folder was committed again since
+        cached = self.local_dir(final_dir)
+        try:
+            with open(os.path.join(cached, ORIGIN_FILENAME)) as f:
+                origin = f.read()
+        except OSError:
+            return None
+        return cached if is_committed(final_dir) and origin == marker_key(final_dir) else None
+
+    @contextmanager
+    def reading(self, final_dir):
+        # Yields the cached copy of a committed folder (touched for the LRU and kept from eviction while in use),
+        # or final_dir itself when there is no current one
+        with self._lock:
+            cached = self.cached(final_dir)
+            if cached is not None:
+                self._pinned[cached] = self._pinned.get(cached, 0) + 1
+                os.utime(cached)
+        if cached is None:
+            yield final_dir
+            return
+        try:
+            yield cached
+        finally:
+            with self._lock:
+                self._pinned[cached] -= 1
+                if not self._pinned[cached]:
+                    del self._pinned[cached]
+
+    def entries(self):
+        # Cached copies as (last use, bytes, path); partials are running stages and not listed
+        entries = []
+        for key in os.listdir(self.root):
+            for eval_dir in os.listdir(os.path.join(self.root, key)):
+                parent = os.path.join(self.root, key, eval_dir)
+                for name in os.listdir(parent) if os.path.isdir(parent) else []:
+                    path = os.path.join(parent, name)
+                    if os.path.isdir(path) and not name.endswith(PARTIAL_SUFFIX):
+                        entries.append((os.path.getmtime(path), folder_bytes(path), path))
+        return sorted(entries)
+
+    def evict(self):
+        with self._lock:
+            entries = self.entries()
+            total = sum(size for _, size, _ in entries) + sum(
+                folder_bytes(os.path.join(root, name)) for root, dirs, _ in os.walk(self.root)
+                for name in dirs if name.endswith(PARTIAL_SUFFIX))
+            for _, size, path in entries:
+                if total <= self.cap:
+                    break
+                if path in self._pinned:
+                    continue
+                shutil.rmtree(path, ignore_errors=True)
+                total -= size
+                logger.debug("[SCRATCH] evicted %s (%.1f MB)", path, size / 2**20)
+            if total > self.cap:
+                logger.warning("[SCRATCH] %.1f MB in use above the %.1f MB cap (running stages)", total / 2**20, self.cap / 2**20)
+
+
+if __name__=="__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="List or trim the cached stage folders of a scratch tier")
+    parser.add_argument("root", type=str, help="scratch folder (--scratch)")
+    parser.add_argument("--cap-mb", type=int, default=None, help="evict least recently used folders down to this size (MB)")
+
+    args = parser.parse_args()
+    tier = ScratchTier(args.root, args.cap_mb or 0, [])
+    if args.cap_mb is not None:
+        tier.evict()
+    for last_use, size, path in tier.entries():
+        print(f"{size / 2**20:10.1f} MB  {os.path.relpath(path, tier.root)}")
@@ -0,0 +1,100 @@
+import os
+import json
+import logging
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+from evaluation.stages import lazy_import
+
+np = lazy_import("numpy")
+sitk = lazy_import("SimpleITK")
+streaming = lazy_import("evaluation.streaming")
+
+logger = logging.getLogger(__name__)
+
+# Uncompressed NIfTI: TotalSegmentator takes it as is (no dcm2niix pass), plastimatch and ITK read it,
+# and ITK streams z-slabs out of it without decoding the whole file
+CACHE_EXTENSION = ".nii"
+
+
+def cache_path(patient_dir, series_dir, cache_dir):
+    return os.path.join(patient_dir, cache_dir, f"{series_dir}{CACHE_EXTENSION}")
+
+
+def series_key(series_dir) -> str:
+    # File list, sizes and mtimes: an added, removed or rewritten slice invalidates the cached volume
+    hasher = hashlib.sha1()
+    for name in sorted(os.listdir(series_dir)):
+        stat = os.stat(os.path.join(series_dir, name))
+        hasher.update(f"{name}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+    return hasher.hexdigest()
+
+
+def is_current(series_dir, volume_path) -> bool:
+    # Only reads the key file and stats the slices, so params and planning stay free of SimpleITK
+    key_path = f"{volume_path}.json"
+    if not os.path.exists(volume_path) or not os.path.exists(key_path):
+        return False
+    with open(key_path) as f:
+        return json.load(f).get("key") == series_key(series_dir)
+
+
+def decode_series(series_dir, threads=0, slab_slices=16) -> "sitk.Image":
+    # Slabs of slices decoded in parallel into one preallocated array; the geometry comes from the first and
+    # last slice, as for the streaming stages
+    reader = streaming.SlabReader(series_dir)
+    depth = reader.size[2]
+    array = np.empty((depth, reader.size[1], reader.size[0]), dtype=reader.dtype)
+
+    def read_slab(z0):
+        z1 = min(z0 + slab_slices, depth)
+        array[z0:z1] = reader.read(z0, z1)
+
+    with ThreadPoolExecutor(threads or os.cpu_count() or 1, thread_name_prefix="decode") as pool:
+        list(pool.map(read_slab, range(0, depth, slab_slices)))
+
+    image = sitk.GetImageFromArray(array)
+    image.SetSpacing(reader.spacing)
+    image.SetOrigin(reader.origin)
+    image.SetDirection(reader.direction)
+    return image
+
+
+def cache_series(series_dir, volume_path, threads=0):
+    # Decodes the series once per patient; every variant shares the volume until the series changes
+    if is_current(series_dir, volume_path):
+        logger.info("[CACHE] Reusing decoded series: %s", volume_path)
+        return volume_path
+
+    logger.info("[DECODE] %s -> %s", series_dir, volume_path)
+    os.makedirs(os.path.dirname(os.path.abspath(volume_path)), exist_ok=True)
+    key = series_key(series_dir)
+    tmp_path = os.path.join(os.path.dirname(volume_path), f".{os.getpid()}.{os.path.basename(volume_path)}")
+    sitk.WriteImage(decode_series(series_dir, threads), tmp_path, useCompression=False)
+    os.replace(tmp_path, volume_path)
+    with open(f"{volume_path}.json", "w") as f:
+        json.dump({"key": key, "input": series_dir}, f, indent=2)
+    return volume_path
+
+
+if __name__=="__main__":
+    import time
+    import argparse
+    parser = argparse.ArgumentParser(description="Decode a DICOM series into a cached volume, or compare it with a serial ITK series read")
+    parser.add_argument("series_dir", type=str, help="DICOM series folder")
+    parser.add_argument("volume", type=str, help="cached volume (.nii)")
+    parser.add_argument("--threads", type=int, default=0, help="decode threads (0 = all cores)")
+    parser.add_argument("--check", action="store_true", help="compare voxels and geometry with sitk.ImageSeriesReader")
+
+    args = parser.parse_args()
+    start = time.perf_counter()
+    cache_series(args.series_dir, args.volume, args.threads)
+    print(f"{args.volume}: {time.perf_counter() - start:.2f} s")
+    if args.check:
+        reader = sitk.ImageSeriesReader()
+        reader.SetFileNames(reader.GetGDCMSeriesFileNames(args.series_dir))
+        reference, cached = reader.Execute(), sitk.ReadImage(args.volume)
+        same = np.array_equal(sitk.GetArrayViewFromImage(reference), sitk.GetArrayViewFromImage(cached))
+        geometry = np.allclose(reference.GetSpacing() + reference.GetOrigin() + reference.GetDirection(),
+                               cached.GetSpacing() + cached.GetOrigin() + cached.GetDirection(), atol=1e-4)
+        print(f"voxels identical: {same}, geometry identical: {geometry}")
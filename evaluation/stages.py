@@ -0,0 +1,55 @@
+import time
+import logging
+import importlib
+
+logger = logging.getLogger(__name__)
+
+# Modules each stage needs beyond the light core (config, checkpoint, scheduler, plastimatch executor).
+# They are imported only when the stage is requested, so --help, --plan and score-only runs never load
+# torch/TotalSegmentator, and SimpleITK, scipy and pandas only come in with the stages that use them.
+STAGE_IMPORTS = {
+    "decode": ("SimpleITK", "evaluation.streaming", "evaluation.series_cache"),
+    "preview": ("SimpleITK", "evaluation.preview", "evaluation.mask_index"),
+    "pw_linear": ("SimpleITK", "evaluation.preprocess", "evaluation.streaming"),
+    "segmentation": ("totalsegmentator.python_api", "SimpleITK", "scipy.ndimage", "evaluation.streaming", "evaluation.labelmap", "evaluation.mask_index"),
+    "dmap": (),
+    "cxt": (),
+    "fcsv": (),
+    "params": (),
+    "register": ("evaluation.vf_store",),
+    "warp": ("SimpleITK", "evaluation.vf_store", "evaluation.vf_metrics"),
+    "metric": ("evaluation.evaluator",),
+    # Not a stage: score export and the results store at the end of every evaluate()
+    "results": ("pandas", "evaluation.evaluator", "evaluation.results_store"),
+}
+
+
+class LazyModule:
+    # Stands in for `import <name>`: the module is imported on first attribute access
+    def __init__(self, name) -> None:
+        self._name = name
+
+    def __getattr__(self, attr):
+        return getattr(importlib.import_module(self._name), attr)
+
+    def __repr__(self):
+        return f"<lazy module '{self._name}'>"
+
+
+def lazy_import(name):
+    return LazyModule(name)
+
+
+def load_stages(steps):
+    # Imports the modules of the requested stages up front, in the calling thread, so worker threads don't
+    # contend on the import lock and the first patient's stage timings don't include import time.
+    # Returns {stage: seconds}.
+    timings = {}
+    for stage, requested in steps.items():
+        if not requested:
+            continue
+        start = time.perf_counter()
+        for name in STAGE_IMPORTS.get(stage, ()):
+            importlib.import_module(name)
+        timings[stage] = time.perf_counter() - start
+    return timings
@@ -0,0 +1,292 @@
+import os
+import itertools
+import numpy as np
+import SimpleITK as sitk
+
+from evaluation.preprocess import apply_pw_linear
+
+NRRD_TYPES = {
+    np.dtype(np.uint8): "uchar", np.dtype(np.int8): "signed char",
+    np.dtype(np.uint16): "ushort", np.dtype(np.int16): "short",
+    np.dtype(np.uint32): "uint", np.dtype(np.int32): "int",
+    np.dtype(np.float32): "float", np.dtype(np.float64): "double",
+}
+
+
+class SlabReader:
+    # Reads z-slabs from a volume file or a DICOM series directory (one file per slice) without loading the whole volume.
+    # Streaming needs an uncompressed NRRD/MHA, compressed files are decoded by ITK before the slab is extracted.
+    def __init__(self, path) -> None:
+        self.path = path
+        if os.path.isdir(path):
+            self._files = sitk.ImageSeriesReader.GetGDCMSeriesFileNames(path)
+            first = self._read_files(self._files[:1])
+            last = self._read_files(self._files[-1:])
+            self.size = (first.GetSize()[0], first.GetSize()[1], len(self._files))
+            self.spacing = first.GetSpacing()[:2] + (self._slice_spacing(first, last),)
+            self.origin = first.GetOrigin()
+            self.direction = first.GetDirection()
+            self.components = 1
+            self.dtype = sitk.GetArrayViewFromImage(first).dtype
+            self._raw = None
+        else:
+            self._files = None
+            self._raw = None
+            self._reader = sitk.ImageFileReader()
+            self._reader.SetFileName(path)
+            self._reader.ReadImageInformation()
+            self.size = self._reader.GetSize()
+            self.spacing = self._reader.GetSpacing()
+            self.origin = self._reader.GetOrigin()
+            self.direction = self._reader.GetDirection()
+            self.components = self._reader.GetNumberOfComponents()
+            self.dtype = sitk.GetArrayFromImage(sitk.Image([1, 1, 1], self._reader.GetPixelID())).dtype
+            self._raw = self._raw_layout()
+
+    def _raw_layout(self):
+        # Uncompressed, attached NRRD/MHA data is read slab by slab straight from the file;
+        # ITK's NRRD reader decodes the whole file even for an extracted region. Vector images (VFs) are stored
+        # voxel-interleaved, so a z-slab is still one contiguous run
+        fields, big_endian, offset = {}, False, None
+        with open(self.path, "rb") as f:
+            magic = f.readline()
+            if magic.startswith(b"NRRD"):
+                for line in iter(f.readline, b""):
+                    if line.strip() == b"":
+                        offset = f.tell()
+                        break
+                    if b":" in line and not line.startswith(b"#"):
+                        key, value = line.decode("latin-1").split(":", 1)
+                        fields[key.strip().lower()] = value.strip().lstrip("=").strip().lower()
+                if fields.get("encoding") != "raw" or "data file" in fields or "datafile" in fields \
+                        or "byte skip" in fields or "line skip" in fields:
+                    return None
+                big_endian = fields.get("endian") == "big"
+            else:
+                f.seek(0)
+                for line in iter(f.readline, b""):
+                    key, _, value = line.decode("latin-1").partition("=")
+                    fields[key.strip().lower()] = value.strip().lower()
+                    if key.strip().lower() == "elementdatafile":
+                        offset = f.tell()
+                        break
+                if fields.get("elementdatafile") != "local" or fields.get("compresseddata", "false") == "true" \
+                        or fields.get("headersize", "0") != "0":
+                    return None
+                big_endian = fields.get("binarydatabyteordermsb", fields.get("elementbyteordermsb", "false")) == "true"
+        if offset is None:
+            return None
+        dtype = self.dtype.newbyteorder(">" if big_endian else "<")
+        shape = (self.size[2], self.size[1], self.size[0])
+        if os.path.getsize(self.path) < offset + int(np.prod(shape)) * self.components * dtype.itemsize:
+            return None
+        return offset, dtype
+
+    def _slice_spacing(self, first, last):
+        if len(self._files) < 2:
+            return first.GetSpacing()[2]
+        distance = np.linalg.norm(np.array(last.GetOrigin()) - np.array(first.GetOrigin()))
+        return float(distance / (len(self._files) - 1))
+
+    @staticmethod
+    def _read_files(files) -> sitk.Image:
+        reader = sitk.ImageSeriesReader()
+        reader.SetFileNames(list(files))
+        return reader.Execute()
+
+    def read_image(self, z0, z1) -> sitk.Image:
+        # Slab [z0, z1) with its physical geometry, so it can be resampled on its own
+        if self._files is not None:
+            image = self._read_files(self._files[z0:z1])
+            image.SetSpacing(self.spacing)
+            image.SetOrigin(self.index_to_point((0, 0, z0)))
+            image.SetDirection(self.direction)
+            return image
+        if self._raw is not None:
+            image = sitk.GetImageFromArray(self.read(z0, z1), isVector=self.components > 1)
+            image.SetSpacing(self.spacing)
+            image.SetOrigin(tuple(self.index_to_point((0, 0, z0))))
+            image.SetDirection(self.direction)
+            return image
+        self._reader.SetExtractIndex((0, 0, z0))
+        self._reader.SetExtractSize((self.size[0], self.size[1], z1 - z0))
+        return self._reader.Execute()
+
+    def read(self, z0, z1) -> np.ndarray:
+        if self._raw is not None:
+            offset, dtype = self._raw
+            slice_values = self.size[0] * self.size[1] * self.components
+            slab = np.fromfile(self.path, dtype=dtype, count=(z1 - z0) * slice_values, offset=offset + z0 * slice_values * dtype.itemsize)
+            shape = (z1 - z0, self.size[1], self.size[0]) + ((self.components,) if self.components > 1 else ())
+            return slab.reshape(shape).astype(self.dtype, copy=False)
+        return sitk.GetArrayFromImage(self.read_image(z0, z1))
+
+    def index_to_point(self, index) -> np.ndarray:
+        direction = np.array(self.direction).reshape(3, 3)
+        return np.array(self.origin) + direction @ (np.asarray(index, dtype=np.float64) * np.array(self.spacing))
+
+    def point_to_index(self, point) -> np.ndarray:
+        direction = np.array(self.direction).reshape(3, 3)
+        return np.linalg.solve(direction, np.asarray(point) - np.array(self.origin)) / np.array(self.spacing)
+
+    def slab_depth(self, memory_mb, bytes_per_voxel=None) -> int:
+        # Slices per slab so the working set of one slab stays under the memory ceiling;
+        # by default three slab-sized copies, each held both by SimpleITK and NumPy
+        bytes_per_voxel = bytes_per_voxel or self.dtype.itemsize * self.components * 6
+        return max(1, int(memory_mb * 1024 * 1024 // (self.size[0] * self.size[1] * bytes_per_voxel)))
+
+
+class SlabWriter:
+    # Appends z-slabs to an attached-raw NRRD, the file is renamed into place once every slice is written
+    def __init__(self, path, size, spacing, origin, direction, dtype) -> None:
+        self.path = path
+        self.size = size
+        self.dtype = np.dtype(dtype).newbyteorder("<")
+        self._written = 0
+        self._tmp_path = f"{path}.tmp{os.getpid()}.nrrd"
+        direction = np.array(direction).reshape(3, 3)
+        axes = " ".join("(" + ",".join(repr(float(v)) for v in direction[:, i] * spacing[i]) + ")" for i in range(3))
+        header = (
+            "NRRD0004\n"
+            f"type: {NRRD_TYPES[np.dtype(dtype)]}\n"
+            "dimension: 3\n"
+            "space: left-posterior-superior\n"
+            f"sizes: {size[0]} {size[1]} {size[2]}\n"
+            f"space directions: {axes}\n"
+            "kinds: domain domain domain\n"
+            "endian: little\n"
+            "encoding: raw\n"
+            f"space origin: ({','.join(repr(float(o)) for o in origin)})\n\n"
+        )
+        self._file = open(self._tmp_path, "wb")
+        self._file.write(header.encode("ascii"))
+
+    @classmethod
+    def like(cls, path, reader, dtype=None):
+        return cls(path, reader.size, reader.spacing, reader.origin, reader.direction, dtype or reader.dtype)
+
+    def write(self, slab):
+        self._file.write(np.ascontiguousarray(slab, dtype=self.dtype).tobytes())
+        self._written += slab.shape[0]
+
+    def close(self):
+        self._file.close()
+        if self._written != self.size[2]:
+            os.remove(self._tmp_path)
+            raise RuntimeError(f"SlabWriter wrote {self._written} of {self.size[2]} slices for {self.path}")
+        os.replace(self._tmp_path, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            self._file.close()
+            os.remove(self._tmp_path)
+
+
+def iter_slabs(reader, depth):
+    for z0 in range(0, reader.size[2], depth):
+        yield z0, reader.read(z0, min(z0 + depth, reader.size[2]))
+
+
+def iter_resampled_slabs(reader, reference, depth):
+    # Nearest-neighbour, identity-transform resampling of `reader` onto the `reference` grid, one output slab at a time.
+    # Each output slab only pulls the input slices its physical extent overlaps.
+    for z0 in range(0, reference.size[2], depth):
+        z1 = min(z0 + depth, reference.size[2])
+        corners = [
+            reader.point_to_index(reference.index_to_point(corner))
+            for corner in itertools.product((0, reference.size[0] - 1), (0, reference.size[1] - 1), (z0, z1 - 1))
+        ]
+        in_z = [c[2] for c in corners]
+        in0 = max(0, int(np.floor(min(in_z))) - 1)
+        in1 = min(reader.size[2], int(np.ceil(max(in_z))) + 2)
+
+        slab_shape = (z1 - z0, reference.size[1], reference.size[0])
+        if in0 >= in1:
+            yield z0, np.zeros(slab_shape, dtype=reader.dtype)
+            continue
+
+        resample = sitk.ResampleImageFilter()
+        resample.SetInterpolator(sitk.sitkNearestNeighbor)
+        resample.SetTransform(sitk.Transform(3, sitk.sitkIdentity))
+        resample.SetDefaultPixelValue(0)
+        resample.SetOutputSpacing(reference.spacing)
+        resample.SetOutputOrigin(tuple(reference.index_to_point((0, 0, z0))))
+        resample.SetOutputDirection(reference.direction)
+        resample.SetSize((reference.size[0], reference.size[1], z1 - z0))
+        yield z0, sitk.GetArrayFromImage(resample.Execute(reader.read_image(in0, in1)))
+
+
+def z_extent(slabs):
+    # (z_min, z_max) of the non-zero slices, or None for an empty mask
+    z_min, z_max = None, None
+    for z0, slab in slabs:
+        nz = np.where(np.any(slab, axis=(1, 2)))[0]
+        if len(nz):
+            z_min = z0 + nz[0] if z_min is None else z_min
+            z_max = z0 + nz[-1]
+    return None if z_min is None else (int(z_min), int(z_max))
+
+
+def bounding_box(slabs):
+    # (z_min, z_max, y_min, y_max, x_min, x_max) of the non-zero voxels, or None for an empty mask
+    box = None
+    for z0, slab in slabs:
+        nz = np.argwhere(slab)
+        if nz.size == 0:
+            continue
+        lo, hi = nz.min(axis=0) + (z0, 0, 0), nz.max(axis=0) + (z0, 0, 0)
+        box = (lo, hi) if box is None else (np.minimum(box[0], lo), np.maximum(box[1], hi))
+    if box is None:
+        return None
+    (zmin, ymin, xmin), (zmax, ymax, xmax) = box
+    return int(zmin), int(zmax), int(ymin), int(ymax), int(xmin), int(xmax)
+
+
+def stream_z_crop(input_path, output_path, z_min, z_max, memory_mb=512):
+    # Zeroes every slice outside [z_min, z_max], the streaming equivalent of arr[:z_min] = 0; arr[z_max+1:] = 0
+    reader = SlabReader(input_path)
+    with SlabWriter.like(output_path, reader) as writer:
+        for z0, slab in iter_slabs(reader, reader.slab_depth(memory_mb, reader.dtype.itemsize * 2)):
+            slab[:max(0, z_min - z0)] = 0
+            slab[max(0, z_max + 1 - z0):] = 0
+            writer.write(slab)
+    return output_path
+
+
+def stream_pw_linear(input_path, output_path, curve, memory_mb=512):
+    # Point-wise HU mapping (curve=None copies the intensities) from a volume or DICOM series to a float NRRD
+    reader = SlabReader(input_path)
+    with SlabWriter.like(output_path, reader, dtype=np.float32) as writer:
+        for _, slab in iter_slabs(reader, reader.slab_depth(memory_mb, 32)):
+            writer.write(apply_pw_linear(slab.astype(np.float32), curve) if curve else slab)
+    return output_path
+
+
+def stream_resample_mask(input_path, reference_path, output_path, memory_mb=512):
+    reader, reference = SlabReader(input_path), SlabReader(reference_path)
+    depth = reference.slab_depth(memory_mb)
+    with SlabWriter.like(output_path, reference, dtype=reader.dtype) as writer:
+        for _, slab in iter_resampled_slabs(reader, reference, depth):
+            writer.write(slab)
+    return output_path
+
+
+def stream_z_extent(path, memory_mb=512):
+    reader = SlabReader(path)
+    return z_extent(iter_slabs(reader, reader.slab_depth(memory_mb, reader.dtype.itemsize * 2)))
+
+
+def stream_resampled_bounding_box(input_path, reference_path, memory_mb=512):
+    # Bounding box (in reference voxels) of a mask resampled onto the reference grid, without materializing it
+    reader, reference = SlabReader(input_path), SlabReader(reference_path)
+    return bounding_box(iter_resampled_slabs(reader, reference, reference.slab_depth(memory_mb)))
+
+
+def stream_resampled_z_extent(input_path, reference_path, memory_mb=512):
+    reader, reference = SlabReader(input_path), SlabReader(reference_path)
+    return z_extent(iter_resampled_slabs(reader, reference, reference.slab_depth(memory_mb)))
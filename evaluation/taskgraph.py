@@ -0,0 +1,103 @@
+import time
+import logging
+import threading
+import contextvars
+from concurrent.futures import Future, wait
+
+from evaluation.resources import current_monitor
+
+logger = logging.getLogger(__name__)
+
+
+class DependencyFailed(RuntimeError):
+    pass
+
+
+class Task:
+    def __init__(self, fn, args, after, required) -> None:
+        self.fn = fn
+        self.args = args
+        self.after = after
+        self.required = required
+        self.dependents = []
+        self.future = Future()
+
+    @property
+    def name(self):
+        return getattr(self.fn, "__name__", repr(self.fn))
+
+    def result(self):
+        return self.future.result()
+
+
+class TaskGraph:
+    # Per-structure work of one stage, fanned out on a pool shared by every patient. A task is submitted
+    # once all tasks it depends on have finished; when one of them failed it is skipped instead.
+    # Tasks run in a copy of the caller's context, so plastimatch calls still report to the calling
+    # stage's ResourceMonitor and log records keep their patient tag. Not reentrant: a task must not
+    # run another graph on the same pool.
+    def __init__(self, pool) -> None:
+        self._pool = pool
+        self._context = contextvars.copy_context()
+        self._lock = threading.Lock()
+        self._tasks = []
+        self._waiting = {}
+
+    def add(self, fn, *args, after=(), required=True):
+        # required=False: a failure is logged and not raised by run()
+        task = Task(fn, args, [t for t in after if t is not None], required)
+        for dependency in task.after:
+            dependency.dependents.append(task)
+        self._tasks.append(task)
+        return task
+
+    def _submit(self, task):
+        failed = [d for d in task.after if d.future.exception() is not None]
+        if failed:
+            task.future.set_exception(DependencyFailed(f"{task.name} skipped, {failed[0].name} failed: {failed[0].future.exception()}"))
+            self._finished(task)
+            return
+        self._pool.submit(self._context.copy().run, self._execute, task)
+
+    def _execute(self, task):
+        monitor = current_monitor()
+        start = time.thread_time()
+        try:
+            task.future.set_result(task.fn(*task.args))
+        except Exception as e:
+            task.future.set_exception(e)
+        finally:
+            if monitor is not None:
+                monitor.record_cpu(time.thread_time() - start)
+        self._finished(task)
+
+    def _finished(self, task):
+        for dependent in task.dependents:
+            with self._lock:
+                self._waiting[dependent] -= 1
+                ready = self._waiting[dependent] == 0
+            if ready:
+                self._submit(dependent)
+
+    def run(self):
+        # Blocks until every task finished, then raises the first error of a required task.
+        # Returns the task results in insertion order, None for failed optional tasks.
+        self._waiting = {task: len(task.after) for task in self._tasks}
+        for task in self._tasks:
+            if not task.after:
+                self._submit(task)
+        wait([task.future for task in self._tasks])
+        error = None
+        for task in self._tasks:
+            e = task.future.exception()
+            if e is None:
+                continue
+            if not task.required:
+                logger.error("%s", e)
+            elif error is None:
+                error = e
+            else:
+                logger.error("%s failed: %s", task.name, e)
+        if error is not None:
+            raise error
+        return [None if task.future.exception() else task.result() for task in self._tasks]
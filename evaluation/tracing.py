@@ -0,0 +1,101 @@
+import os
+import json
+import argparse
+import threading
+from collections import defaultdict
+
+
+class Tracer:
+    # Writes one JSONL event per plastimatch command and per stage, tagged with patient, variant and stage
+    def __init__(self, path, variant) -> None:
+        self.path = path
+        self.variant = variant
+        self.events = []
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._file = open(path, "w")
+
+    def record(self, usage):
+        events = [
+            {
+                "event": "command",
+                "variant": self.variant,
+                "patient": usage.patient,
+                "stage": usage.stage,
+                "ts": command.start_time,
+                "wall_s": command.wall_s,
+                "cpu_s": command.cpu_s,
+                "peak_rss_mb": command.peak_rss_mb,
+                "read_bytes": command.read_bytes,
+                "write_bytes": command.write_bytes,
+                "command": command.command,
+                "returncode": command.returncode,
+            }
+            for command in usage.commands
+        ]
+        events.append({
+            "event": "stage",
+            "variant": self.variant,
+            "patient": usage.patient,
+            "stage": usage.stage,
+            "ts": usage.start_time,
+            "wall_s": usage.wall_s,
+            "cpu_s": usage.cpu_s,
+            "peak_rss_mb": usage.peak_rss_mb,
+            "read_bytes": usage.read_bytes,
+            "write_bytes": usage.write_bytes,
+            "commands": len(usage.commands),
+            "error": usage.error,
+        })
+        with self._lock:
+            for event in events:
+                self._file.write(json.dumps(event) + "\n")
+            self._file.flush()
+            self.events.extend(events)
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def load_events(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def summarize(events, top_n=10) -> str:
+    stages = [e for e in events if e["event"] == "stage"]
+    if not stages:
+        return "No stage events recorded."
+
+    per_patient = defaultdict(float)
+    per_stage = defaultdict(lambda: [0, 0.0, 0.0])
+    for e in stages:
+        per_patient[e["patient"]] += e["wall_s"]
+        totals = per_stage[e["stage"]]
+        totals[0] += 1
+        totals[1] += e["wall_s"]
+        totals[2] = max(totals[2], e["peak_rss_mb"])
+
+    lines = [f"Top {top_n} slowest stages:"]
+    lines.append(f"  {'stage':<14}{'patient':<10}{'wall (s)':>10}{'cpu (s)':>10}{'peak RSS (MB)':>15}")
+    for e in sorted(stages, key=lambda e: e["wall_s"], reverse=True)[:top_n]:
+        lines.append(f"  {e['stage']:<14}{e['patient']:<10}{e['wall_s']:>10.1f}{e['cpu_s']:>10.1f}{e['peak_rss_mb']:>15.0f}"
+                     + ("  [failed]" if e.get("error") else ""))
+
+    lines.append(f"Top {top_n} slowest patients:")
+    for patient, wall_s in sorted(per_patient.items(), key=lambda kv: kv[1], reverse=True)[:top_n]:
+        lines.append(f"  {patient:<10}{wall_s:>10.1f} s")
+
+    lines.append("Per stage totals:")
+    for stage, (count, wall_s, peak_rss_mb) in sorted(per_stage.items(), key=lambda kv: kv[1][1], reverse=True):
+        lines.append(f"  {stage:<14}{count:>4} runs{wall_s:>10.1f} s  max {peak_rss_mb:.0f} MB")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summarize a pipeline trace")
+    parser.add_argument("trace", type=str, help="trace_<variant>.jsonl written by evaluate()")
+    parser.add_argument("--top", type=int, default=10, help="number of stages/patients to list")
+    args = parser.parse_args()
+    print(summarize(load_events(args.trace), args.top))
@@ -2,10 +2,18 @@ import re
 import os
 import shutil
 import csv
-import numpy as np
-import SimpleITK as sitk
 import math
-import scipy.ndimage  # add at the top of your utils.py if not already there
+import logging
+from evaluation.stages import lazy_import
+
+# Imported on first use, the planner and the light stages only need the path helpers
+np = lazy_import("numpy")
+sitk = lazy_import("SimpleITK")
+ndimage = lazy_import("scipy.ndimage")
+streaming = lazy_import("evaluation.streaming")
+mask_index = lazy_import("evaluation.mask_index")
+
+logger = logging.getLogger(__name__)
 
 class Utils:
 
@@ -18,6 +26,16 @@ class Utils:
         resample.SetTransform(sitk.Transform(3, sitk.sitkIdentity))
         return resample.Execute(image)
 
+    def mask_stats(self, path):
+        # Bounding box, z-extent and voxel count of a mask from its folder's index; computed (in z-slabs with
+        # --streaming) and indexed when the entry is missing or stale
+        return mask_index.mask_stats(path, self.configs.stream_memory_mb if self.configs.streaming else None)
+
+    def indexed_empty(self, path):
+        # True only when the mask's index entry is current and says it is empty, nothing is decoded
+        stats = mask_index.lookup(path)
+        return stats is not None and stats.empty
+
     def get_class_name(self, path) -> str:
         name = os.path.basename(path).replace(".nii.gz", "").replace(".nrrd", "").replace(".mha", "").replace(".cxt", "")
         if name == self.configs.TS_PROSTATE_CLASS:
@@ -74,12 +92,21 @@ class Utils:
         if force and os.path.exists(dir):
             shutil.rmtree(dir)
         if os.path.exists(dir):
-            print("skipping result creation")
+            logger.info("skipping result creation")
             return True
         os.makedirs(dir, exist_ok=True)
         return False
 
-    def get_coordinates(self, path) -> np.ndarray:
+    def link_or_copy(self, src, dst):
+        # Hard links keep shared artifacts single-copy on disk, copies cover cross-device targets
+        if os.path.exists(dst):
+            os.remove(dst)
+        try:
+            os.link(src, dst)
+        except OSError:
+            shutil.copyfile(src, dst)
+
+    def get_coordinates(self, path) -> "np.ndarray":
         with open(path,'r') as csvfile:
             data = csv.reader(filter(lambda row: row[0]!='#', csvfile))
             coord = None
@@ -93,306 +120,403 @@ class Utils:
         try:
             nifti_image = sitk.ReadImage(nifti_file_path)
             nrrd_file_path = os.path.join(os.path.dirname(nifti_file_path), f"{os.path.basename(nifti_file_path).removesuffix('.nii.gz')}.nrrd")
-            sitk.WriteImage(nifti_image, nrrd_file_path)
-            print(f"Saved .nrrd: {nrrd_file_path}")
+            mask_index.write_mask(nifti_image, nrrd_file_path)
+            logger.debug("Saved .nrrd: %s", nrrd_file_path)
             os.remove(nifti_file_path)
-            print(f"Removed nifti: {nifti_file_path}")
+            logger.debug("Removed nifti: %s", nifti_file_path)
         except Exception as e:
-            print("Nifti to .nrrd conversion failed")
+            logger.error("Nifti to .nrrd conversion failed")
     def crop_colon_by_femurs(self, femur_left_path, femur_right_path, colon_path):
         try:
             if not os.path.exists(colon_path):
-                print(f"Colon file missing: {colon_path}")
+                logger.warning("Colon file missing: %s", colon_path)
                 return
-            colon = sitk.ReadImage(colon_path)
-            colon_array = sitk.GetArrayFromImage(colon)
-     
+            # Femur extents come from the mask index, the femurs themselves are not decoded
             max_zs = []
-     
             for femur_path in [femur_left_path, femur_right_path]:
                 if os.path.exists(femur_path):
-                    femur = sitk.ReadImage(femur_path)
-                    femur_array = sitk.GetArrayFromImage(femur)
-                    z_indices = np.any(femur_array, axis=(1, 2))
-                    if np.any(z_indices):
-                        max_zs.append(np.where(z_indices)[0].max())
-     
+                    extent = self.mask_stats(femur_path).z_extent
+                    if extent:
+                        max_zs.append(extent[1])
             if not max_zs:
-                print("No femur found for cropping")
+                logger.warning("No femur found for cropping")
+                return
+            if self.configs.streaming:
+                streaming.stream_z_crop(colon_path, colon_path, 0, max(max_zs) - 1, self.configs.stream_memory_mb)
+                self.mask_stats(colon_path)
+                logger.info("Cropped colon at z > %s", max(max_zs))
                 return
-     
-            max_z = max(max_zs)
-            colon_array[max_z:] = 0
-     
-            cropped = sitk.GetImageFromArray(colon_array)
-            cropped.CopyInformation(colon)
-            sitk.WriteImage(cropped, colon_path)
-            print(f"Cropped colon at z > {max_z}")
+
+            mask_index.write_mask(self.crop_colon_by_femurs_image(sitk.ReadImage(colon_path), max(max_zs)), colon_path)
         except Exception as e:
-            print(f"Cropping colon failed: {e}")
+            logger.error("Cropping colon failed: %s", e)
+
+    def crop_colon_by_femurs_image(self, colon, max_z):
+        # In-memory core of crop_colon_by_femurs: the colon zeroed from max_z, the top femur slice, upwards
+        colon_array = sitk.GetArrayFromImage(colon)
+        colon_array[max_z:] = 0
+ 
+        cropped = sitk.GetImageFromArray(colon_array)
+        cropped.CopyInformation(colon)
+        logger.info("Cropped colon at z > %s", max_z)
+        return cropped
     def crop_ct_colon_by_cbct_sac(self, ct_colon_path, cbct_colon_path):
         try:
             # Load both images
             ct_img = sitk.ReadImage(ct_colon_path)
-            cbct_img = sitk.ReadImage(cbct_colon_path)
-    
-            # Resample CBCT colon to CT geometry
-            resample = sitk.ResampleImageFilter()
-            resample.SetReferenceImage(ct_img)
-            resample.SetInterpolator(sitk.sitkNearestNeighbor)
-            resample.SetTransform(sitk.Transform(3, sitk.sitkIdentity))
-            resample.SetDefaultPixelValue(0)
-            resample.SetOutputSpacing(ct_img.GetSpacing())
-            resample.SetOutputOrigin(ct_img.GetOrigin())
-            resample.SetOutputDirection(ct_img.GetDirection())
-            resample.SetSize(ct_img.GetSize())
-    
-            cbct_resampled = resample.Execute(cbct_img)
-            cbct_array = sitk.GetArrayFromImage(cbct_resampled)
-    
-            nonzero_slices = np.where(np.any(cbct_array, axis=(1, 2)))[0]
-            if len(nonzero_slices) == 0:
-                print("[SKIP] Resampled CBCT colon is empty.")
-                return
-    
-            z_min = nonzero_slices.min()
-            z_max = nonzero_slices.max()
-            print(f"[INFO] Cropping CT colon using CBCT Z range: {z_min}–{z_max}")
-    
-            # Load CT colon and crop it
-            ct_array = sitk.GetArrayFromImage(ct_img)
-            ct_array[:z_min] = 0
-            ct_array[z_max + 1:] = 0
-    
-            # Keep largest component
-            labeled_array, num_labels = scipy.ndimage.label(ct_array)
-            if num_labels == 0:
-                print("[WARNING] CT colon empty after cropping.")
-                return
-    
-            sizes = scipy.ndimage.sum(ct_array, labeled_array, range(1, num_labels + 1))
-            largest_idx = int(np.argmax(sizes)) + 1
-            cleaned_array = np.where(labeled_array == largest_idx, ct_array, 0)
-    
-            cleaned_img = sitk.GetImageFromArray(cleaned_array)
-            cleaned_img.CopyInformation(ct_img)
-            sitk.WriteImage(cleaned_img, ct_colon_path)
-            print(f"[CROPPED] CT colon saved with Z ∈ [{z_min}, {z_max}]")
+            if self.configs.streaming:
+                # Z-extent of the CBCT colon on the CT grid, resampled slab by slab
+                extent = streaming.stream_resampled_z_extent(cbct_colon_path, ct_colon_path, self.configs.stream_memory_mb)
+                nonzero_slices = np.array(extent if extent else [], dtype=int)
+            elif self.indexed_empty(cbct_colon_path):
+                nonzero_slices = np.array([], dtype=int)
+            else:
+                nonzero_slices = self.resampled_z_slices(sitk.ReadImage(cbct_colon_path), ct_img)
+            cleaned_img = self.crop_colon_to_slices(ct_img, nonzero_slices)
+            if cleaned_img is not None:
+                mask_index.write_mask(cleaned_img, ct_colon_path)
     
         except Exception as e:
-            print(f"[ERROR] crop_ct_colon_by_cbct_sac failed: {e}")
+            logger.error("crop_ct_colon_by_cbct_sac failed: %s", e)
             import traceback
             traceback.print_exc()
 
+    def resampled_z_slices(self, image, reference):
+        # Non-empty z-slices of `image` resampled onto the reference grid
+        resampled = sitk.GetArrayFromImage(self.resample_to_reference(image, reference))
+        return np.where(np.any(resampled, axis=(1, 2)))[0]
+
+    def crop_ct_colon_by_cbct_sac_image(self, ct_img, cbct_img):
+        # In-memory core of crop_ct_colon_by_cbct_sac
+        return self.crop_colon_to_slices(ct_img, self.resampled_z_slices(cbct_img, ct_img))
+
+    def crop_colon_to_slices(self, ct_img, nonzero_slices):
+        # Zeroes the CT colon outside the z-range of nonzero_slices and keeps its largest component, None if nothing is left
+        if len(nonzero_slices) == 0:
+            logger.info("[SKIP] Resampled CBCT colon is empty.")
+            return None
+
+        z_min = nonzero_slices.min()
+        z_max = nonzero_slices.max()
+        logger.debug("Cropping CT colon using CBCT Z range: %s–%s", z_min, z_max)
+
+        ct_array = sitk.GetArrayFromImage(ct_img)
+        ct_array[:z_min] = 0
+        ct_array[z_max + 1:] = 0
+
+        # Keep largest component
+        labeled_array, num_labels = ndimage.label(ct_array)
+        if num_labels == 0:
+            logger.warning("CT colon empty after cropping.")
+            return None
+
+        sizes = ndimage.sum(ct_array, labeled_array, range(1, num_labels + 1))
+        largest_idx = int(np.argmax(sizes)) + 1
+        cleaned_array = np.where(labeled_array == largest_idx, ct_array, 0)
+
+        cleaned_img = sitk.GetImageFromArray(cleaned_array)
+        cleaned_img.CopyInformation(ct_img)
+        logger.info("[CROPPED] CT colon cropped to Z ∈ [%s, %s]", z_min, z_max)
+        return cleaned_img
+
 
     def crop_colon_to_lower_sac(self, colon_path, keep_ratio=0.3):
         try:
             if not os.path.exists(colon_path):
-                print(f"[SKIP] Missing colon file: {colon_path}")
+                logger.info("[SKIP] Missing colon file: %s", colon_path)
                 return
     
-            colon_img = sitk.ReadImage(colon_path)
-            colon_array = sitk.GetArrayFromImage(colon_img)
-    
-            # Label connected components
-            labeled_array, num_labels = scipy.ndimage.label(colon_array)
-            if num_labels == 0:
-                print(f"[WARNING] No colon components found in {colon_path}")
+            if self.indexed_empty(colon_path):
+                logger.warning("No colon components found in %s", colon_path)
                 return
-    
-            # Get lowest Z centroid component
-            centroids = scipy.ndimage.center_of_mass(colon_array, labeled_array, range(1, num_labels + 1))
-            lowest_idx = int(np.argmin([c[0] for c in centroids])) + 1
-            component_mask = (labeled_array == lowest_idx)
-    
-            z_voxels = np.where(np.any(component_mask, axis=(1, 2)))[0]
-            if len(z_voxels) == 0:
-                print("[WARNING] No voxels in lowest colon component.")
-                return
-    
-            z_min = z_voxels.min()
-            z_max = z_voxels.max()
-            z_len = z_max - z_min
-            new_z_max = z_min + int(z_len * keep_ratio)
-    
-            print(f"[INFO] Trimming to bottom {keep_ratio*100:.1f}% of Z ∈ [{z_min}, {new_z_max}]")
-    
-            cropped_array = np.where(component_mask, colon_array, 0)
-            cropped_array[:z_min] = 0
-            cropped_array[new_z_max + 1:] = 0
-    
-            cropped_img = sitk.GetImageFromArray(cropped_array)
-            cropped_img.CopyInformation(colon_img)
-            sitk.WriteImage(cropped_img, colon_path)
-            print(f"[CROPPED] Saved cropped CBCT colon to: {colon_path}")
+            cropped_img = self.crop_colon_to_lower_sac_image(sitk.ReadImage(colon_path), keep_ratio)
+            if cropped_img is not None:
+                mask_index.write_mask(cropped_img, colon_path)
+                logger.info("[CROPPED] Saved cropped CBCT colon to: %s", colon_path)
     
         except Exception as e:
-            print(f"[ERROR] crop_colon_to_lower_sac failed: {e}")
+            logger.error("crop_colon_to_lower_sac failed: %s", e)
             import traceback
             traceback.print_exc()
+
+    def crop_colon_to_lower_sac_image(self, colon_img, keep_ratio=0.3):
+        # In-memory core of crop_colon_to_lower_sac, None when there is no colon component
+        colon_array = sitk.GetArrayFromImage(colon_img)
+
+        # Label connected components
+        labeled_array, num_labels = ndimage.label(colon_array)
+        if num_labels == 0:
+            logger.warning("No colon components found")
+            return None
+
+        # Get lowest Z centroid component
+        centroids = ndimage.center_of_mass(colon_array, labeled_array, range(1, num_labels + 1))
+        lowest_idx = int(np.argmin([c[0] for c in centroids])) + 1
+        component_mask = (labeled_array == lowest_idx)
+
+        z_voxels = np.where(np.any(component_mask, axis=(1, 2)))[0]
+        if len(z_voxels) == 0:
+            logger.warning("No voxels in lowest colon component.")
+            return None
+
+        z_min = z_voxels.min()
+        z_max = z_voxels.max()
+        z_len = z_max - z_min
+        new_z_max = z_min + int(z_len * keep_ratio)
+
+        logger.debug("Trimming to bottom %.1f%% of Z ∈ [%s, %s]", keep_ratio*100, z_min, new_z_max)
+
+        cropped_array = np.where(component_mask, colon_array, 0)
+        cropped_array[:z_min] = 0
+        cropped_array[new_z_max + 1:] = 0
+
+        cropped_img = sitk.GetImageFromArray(cropped_array)
+        cropped_img.CopyInformation(colon_img)
+        return cropped_img
     def crop_larger_bladder_to_smaller_extent_by_zmm(self, bladder_path1, bladder_path2):
+        if self.configs.streaming:
+            return self.crop_larger_bladder_to_smaller_extent_streaming(bladder_path1, bladder_path2)
         try:
+            if self.indexed_empty(bladder_path1) or self.indexed_empty(bladder_path2):
+                logger.info("[SKIP] One of the bladder masks is empty.")
+                return
             img1 = sitk.ReadImage(bladder_path1)
             img2 = sitk.ReadImage(bladder_path2)
-            arr1 = sitk.GetArrayFromImage(img1)
-            arr2 = sitk.GetArrayFromImage(img2)
+            result = self.crop_larger_bladder_image(img1, img2)
+            if result is not None:
+                larger, out_img = result
+                larger_path = (bladder_path1, bladder_path2)[larger]
+                mask_index.write_mask(out_img, larger_path)
+                logger.info("[CROPPED] Final bladder saved to: %s", larger_path)
     
-            z_indices1 = np.where(np.any(arr1, axis=(1, 2)))[0]
-            z_indices2 = np.where(np.any(arr2, axis=(1, 2)))[0]
-    
-            if len(z_indices1) == 0 or len(z_indices2) == 0:
-                print("[SKIP] One of the bladder masks is empty.")
+        except Exception as e:
+            logger.error("crop_larger_bladder_to_smaller_extent_by_zmm failed: %s", e)
+            import traceback
+            traceback.print_exc()
+
+    def crop_larger_bladder_image(self, img1, img2):
+        # In-memory core of crop_larger_bladder_to_smaller_extent_by_zmm: (index of the cropped mask, its cropped image),
+        # None when nothing was cropped
+        arr1 = sitk.GetArrayFromImage(img1)
+        arr2 = sitk.GetArrayFromImage(img2)
+
+        z_indices1 = np.where(np.any(arr1, axis=(1, 2)))[0]
+        z_indices2 = np.where(np.any(arr2, axis=(1, 2)))[0]
+
+        if len(z_indices1) == 0 or len(z_indices2) == 0:
+            logger.info("[SKIP] One of the bladder masks is empty.")
+            return None
+
+        # Compute physical Z ranges (in mm)
+        spacing1, origin1 = img1.GetSpacing(), img1.GetOrigin()
+        spacing2, origin2 = img2.GetSpacing(), img2.GetOrigin()
+
+        z_start1_mm = origin1[2] + z_indices1[0] * spacing1[2]
+        z_end1_mm   = origin1[2] + z_indices1[-1] * spacing1[2]
+        z_range1_mm = z_end1_mm - z_start1_mm
+
+        z_start2_mm = origin2[2] + z_indices2[0] * spacing2[2]
+        z_end2_mm   = origin2[2] + z_indices2[-1] * spacing2[2]
+        z_range2_mm = z_end2_mm - z_start2_mm
+
+        logger.debug("CT bladder Z range (mm): %.2f", z_range1_mm)
+        logger.debug("CBCT bladder Z range (mm): %.2f", z_range2_mm)
+
+        # Determine which to crop
+        if z_range1_mm <= z_range2_mm:
+            smaller_img, larger, larger_img, larger_arr = img1, 1, img2, arr2
+        else:
+            smaller_img, larger, larger_img, larger_arr = img2, 0, img1, arr1
+
+        # Resample smaller to larger's space
+        smaller_arr = sitk.GetArrayFromImage(self.resample_to_reference(smaller_img, larger_img))
+
+        # Get 3D bounding box of the resampled smaller mask
+        nz = np.argwhere(smaller_arr > 0)
+        if nz.size == 0:
+            logger.warning("Resampled smaller bladder is empty.")
+            return None
+
+        zmin, ymin, xmin = nz.min(axis=0)
+        zmax, ymax, xmax = nz.max(axis=0)
+
+        logger.debug("Cropping larger mask to Z[%s:%s], Y[%s:%s], X[%s:%s]", zmin, zmax, ymin, ymax, xmin, xmax)
+
+        cropped = np.copy(larger_arr)
+        cropped[:zmin] = 0
+        cropped[zmax+1:] = 0
+        cropped[:, :ymin, :] = 0
+        cropped[:, ymax+1:, :] = 0
+        cropped[:, :, :xmin] = 0
+        cropped[:, :, xmax+1:] = 0
+
+        # Keep only largest component
+        labeled_array, num_labels = ndimage.label(cropped)
+        if num_labels == 0:
+            logger.warning("Cropped bladder is empty.")
+            return None
+
+        sizes = ndimage.sum(cropped, labeled_array, range(1, num_labels + 1))
+        largest_idx = int(np.argmax(sizes)) + 1
+        final_arr = np.where(labeled_array == largest_idx, cropped, 0)
+
+        out_img = sitk.GetImageFromArray(final_arr)
+        out_img.CopyInformation(larger_img)
+        return larger, out_img
+
+    def crop_larger_bladder_to_smaller_extent_streaming(self, bladder_path1, bladder_path2):
+        # Same cropping as crop_larger_bladder_to_smaller_extent_by_zmm, but the extent scans and the resampling
+        # of the smaller mask run slab by slab, only the larger mask is decoded whole for the component filter
+        try:
+            memory_mb = self.configs.stream_memory_mb
+            extent1 = self.mask_stats(bladder_path1).z_extent
+            extent2 = self.mask_stats(bladder_path2).z_extent
+            if extent1 is None or extent2 is None:
+                logger.info("[SKIP] One of the bladder masks is empty.")
                 return
-    
-            # Compute physical Z ranges (in mm)
-            spacing1, origin1 = img1.GetSpacing(), img1.GetOrigin()
-            spacing2, origin2 = img2.GetSpacing(), img2.GetOrigin()
-    
-            z_start1_mm = origin1[2] + z_indices1[0] * spacing1[2]
-            z_end1_mm   = origin1[2] + z_indices1[-1] * spacing1[2]
-            z_range1_mm = z_end1_mm - z_start1_mm
-    
-            z_start2_mm = origin2[2] + z_indices2[0] * spacing2[2]
-            z_end2_mm   = origin2[2] + z_indices2[-1] * spacing2[2]
-            z_range2_mm = z_end2_mm - z_start2_mm
-    
-            print(f"[INFO] CT bladder Z range (mm): {z_range1_mm:.2f}")
-            print(f"[INFO] CBCT bladder Z range (mm): {z_range2_mm:.2f}")
-    
-            # Determine which to crop
+
+            reader1, reader2 = streaming.SlabReader(bladder_path1), streaming.SlabReader(bladder_path2)
+            z_range1_mm = (extent1[1] - extent1[0]) * reader1.spacing[2]
+            z_range2_mm = (extent2[1] - extent2[0]) * reader2.spacing[2]
+            logger.debug("CT bladder Z range (mm): %.2f", z_range1_mm)
+            logger.debug("CBCT bladder Z range (mm): %.2f", z_range2_mm)
+
             if z_range1_mm <= z_range2_mm:
-                smaller_img, smaller_path = img1, bladder_path1
-                larger_img, larger_arr, larger_path = img2, arr2, bladder_path2
+                smaller_path, larger_path = bladder_path1, bladder_path2
             else:
-                smaller_img, smaller_path = img2, bladder_path2
-                larger_img, larger_arr, larger_path = img1, arr1, bladder_path1
-    
-            # Resample smaller to larger's space
-            resample = sitk.ResampleImageFilter()
-            resample.SetReferenceImage(larger_img)
-            resample.SetInterpolator(sitk.sitkNearestNeighbor)
-            resample.SetTransform(sitk.Transform(3, sitk.sitkIdentity))
-            resample.SetDefaultPixelValue(0)
-            resample.SetOutputSpacing(larger_img.GetSpacing())
-            resample.SetOutputOrigin(larger_img.GetOrigin())
-            resample.SetOutputDirection(larger_img.GetDirection())
-            resample.SetSize(larger_img.GetSize())
-    
-            smaller_resampled = resample.Execute(smaller_img)
-            smaller_arr = sitk.GetArrayFromImage(smaller_resampled)
-    
-            # Get 3D bounding box of the resampled smaller mask
-            nz = np.argwhere(smaller_arr > 0)
-            if nz.size == 0:
-                print("[WARNING] Resampled smaller bladder is empty.")
+                smaller_path, larger_path = bladder_path2, bladder_path1
+
+            box = streaming.stream_resampled_bounding_box(smaller_path, larger_path, memory_mb)
+            if box is None:
+                logger.warning("Resampled smaller bladder is empty.")
                 return
-    
-            zmin, ymin, xmin = nz.min(axis=0)
-            zmax, ymax, xmax = nz.max(axis=0)
-    
-            print(f"[INFO] Cropping larger mask to Z[{zmin}:{zmax}], Y[{ymin}:{ymax}], X[{xmin}:{xmax}]")
-    
-            cropped = np.copy(larger_arr)
+            zmin, zmax, ymin, ymax, xmin, xmax = box
+            logger.debug("Cropping larger mask to Z[%s:%s], Y[%s:%s], X[%s:%s]", zmin, zmax, ymin, ymax, xmin, xmax)
+
+            larger_img = sitk.ReadImage(larger_path)
+            cropped = sitk.GetArrayFromImage(larger_img)
             cropped[:zmin] = 0
             cropped[zmax+1:] = 0
             cropped[:, :ymin, :] = 0
             cropped[:, ymax+1:, :] = 0
             cropped[:, :, :xmin] = 0
             cropped[:, :, xmax+1:] = 0
-    
-            # Keep only largest component
-            labeled_array, num_labels = scipy.ndimage.label(cropped)
+
+            labeled_array, num_labels = ndimage.label(cropped)
             if num_labels == 0:
-                print("[WARNING] Cropped bladder is empty.")
+                logger.warning("Cropped bladder is empty.")
                 return
-    
-            sizes = scipy.ndimage.sum(cropped, labeled_array, range(1, num_labels + 1))
+
+            sizes = ndimage.sum(cropped, labeled_array, range(1, num_labels + 1))
             largest_idx = int(np.argmax(sizes)) + 1
-            final_arr = np.where(labeled_array == largest_idx, cropped, 0)
-    
-            # Save result
-            out_img = sitk.GetImageFromArray(final_arr)
+            cropped[labeled_array != largest_idx] = 0
+            del labeled_array
+
+            out_img = sitk.GetImageFromArray(cropped)
             out_img.CopyInformation(larger_img)
-            sitk.WriteImage(out_img, larger_path)
-            print(f"[CROPPED] Final bladder saved to: {larger_path}")
-    
+            mask_index.write_mask(out_img, larger_path)
+            logger.info("[CROPPED] Final bladder saved to: %s", larger_path)
+
         except Exception as e:
-            print(f"[ERROR] crop_larger_bladder_to_smaller_extent_by_zmm failed: {e}")
+            logger.error("crop_larger_bladder_to_smaller_extent_streaming failed: %s", e)
             import traceback
             traceback.print_exc()
 
     def crop_hip_by_femurs(self, hip_reference_path, hip_segment_path):
         try:
-            print(f"\n[START] Cropping CT hip based on CBCT hip reference.")
-            print(f"  Reference (CBCT) path: {hip_reference_path}")
-            print(f"  Segment (CT) path: {hip_segment_path}")
-    
-            hip_ref = sitk.ReadImage(hip_reference_path)
-            spacing_cbct = hip_ref.GetSpacing()
-            origin_cbct = hip_ref.GetOrigin()
-            z_spacing_cbct = spacing_cbct[2]
-    
-            hip_ref_array = sitk.GetArrayFromImage(hip_ref)
-            z_indices_ref = np.any(hip_ref_array, axis=(1, 2))
-            if not np.any(z_indices_ref):
-                print(f"  [WARNING] No non-zero slices found in CBCT hip!")
+            logger.debug("[START] Cropping CT hip based on CBCT hip reference.")
+            logger.debug("Reference (CBCT) path: %s", hip_reference_path)
+            logger.debug("Segment (CT) path: %s", hip_segment_path)
+
+            if self.configs.streaming:
+                memory_mb = self.configs.stream_memory_mb
+                ref_extent = self.mask_stats(hip_reference_path).z_extent
+                if ref_extent is None:
+                    logger.warning("No non-zero slices found in CBCT hip!")
+                    return
+                ref, seg = streaming.SlabReader(hip_reference_path), streaming.SlabReader(hip_segment_path)
+                top_cbct_mm_z = ref.origin[2] + ref_extent[1] * ref.spacing[2]
+                if self.mask_stats(hip_segment_path).empty:
+                    logger.warning("No non-zero slices found in CT hip!")
+                    return
+                z_dim_ct = seg.size[2]
+                crop_z_clipped = np.clip(int(np.floor((top_cbct_mm_z - seg.origin[2]) / seg.spacing[2])), 0, z_dim_ct)
+                logger.debug("Cropping CT hip above slice %s (CT shape = %s)", crop_z_clipped, z_dim_ct)
+                if crop_z_clipped < z_dim_ct:
+                    streaming.stream_z_crop(hip_segment_path, hip_segment_path, 0, crop_z_clipped - 1, memory_mb)
+                    self.mask_stats(hip_segment_path)
+                    logger.info("[SUCCESS] Cropped CT hip saved to: %s", hip_segment_path)
+                else:
+                    logger.debug("crop_z (%s) >= CT volume depth (%s), skipping crop.", crop_z_clipped, z_dim_ct)
                 return
-            top_z_cbct_slice = int(np.max(np.argwhere(z_indices_ref)))
-            print(f"  Top Z slice of CBCT hip: {top_z_cbct_slice}, spacing: {z_spacing_cbct}")
-    
-            # Compute top Z position in physical mm
-            top_cbct_mm_z = origin_cbct[2] + top_z_cbct_slice * z_spacing_cbct
-    
-            # --- Load CT segmentation ---
-            hip_seg = sitk.ReadImage(hip_segment_path)
-            spacing_ct = hip_seg.GetSpacing()
-            origin_ct = hip_seg.GetOrigin()
-            z_spacing_ct = spacing_ct[2]
-    
-            hip_seg_array = sitk.GetArrayFromImage(hip_seg)
-            z_dim_ct = hip_seg_array.shape[0]
     
-            z_indices_ct = np.any(hip_seg_array, axis=(1, 2))
-            if not np.any(z_indices_ct):
-                print(f"  [WARNING] No non-zero slices found in CT hip!")
+            if self.indexed_empty(hip_reference_path):
+                logger.warning("No non-zero slices found in CBCT hip!")
                 return
-    
-            # Convert CBCT physical z to CT slice index
-            crop_z_ct = int(np.floor((top_cbct_mm_z - origin_ct[2]) / z_spacing_ct))
-            crop_z_clipped = np.clip(crop_z_ct, 0, z_dim_ct)
-    
-            print(f"  Cropping CT hip above slice {crop_z_clipped} (CT shape = {z_dim_ct})")
-            is_femur = "femur" in hip_reference_path
-            # if is_femur:
-            #     if crop_z_clipped < z_dim_ct:
-            #         hip_seg_array[:crop_z_clipped] = 0
-            #     else:
-            #         print(f"  [INFO] crop_z ({crop_z_clipped}) >= CT volume depth ({z_dim_ct}), skipping crop.")
-            # else:
-            if crop_z_clipped < z_dim_ct:
-                hip_seg_array[crop_z_clipped:] = 0
-            else:
-                print(f"  [INFO] crop_z ({crop_z_clipped}) >= CT volume depth ({z_dim_ct}), skipping crop.")
-    
-            # Save the cropped image
-            cropped = sitk.GetImageFromArray(hip_seg_array)
-            cropped.CopyInformation(hip_seg)
-            sitk.WriteImage(cropped, hip_segment_path)
-            print(f"  [SUCCESS] Cropped CT hip saved to: {hip_segment_path}\n")
+            cropped = self.crop_hip_by_femurs_image(sitk.ReadImage(hip_reference_path), sitk.ReadImage(hip_segment_path))
+            if cropped is not None:
+                mask_index.write_mask(cropped, hip_segment_path)
+                logger.info("[SUCCESS] Cropped CT hip saved to: %s", hip_segment_path)
     
         except Exception as e:
-            print(f"[ERROR] Cropping CT hip failed: {e}")
+            logger.error("Cropping CT hip failed: %s", e)
             import traceback
             traceback.print_exc()
+
+    def crop_hip_by_femurs_image(self, hip_ref, hip_seg):
+        # In-memory core of crop_hip_by_femurs: the CT hip zeroed above the top of the CBCT reference, None if either is empty
+        spacing_cbct = hip_ref.GetSpacing()
+        origin_cbct = hip_ref.GetOrigin()
+        z_spacing_cbct = spacing_cbct[2]
+
+        hip_ref_array = sitk.GetArrayFromImage(hip_ref)
+        z_indices_ref = np.any(hip_ref_array, axis=(1, 2))
+        if not np.any(z_indices_ref):
+            logger.warning("No non-zero slices found in CBCT hip!")
+            return None
+        top_z_cbct_slice = int(np.max(np.argwhere(z_indices_ref)))
+        logger.debug("Top Z slice of CBCT hip: %s, spacing: %s", top_z_cbct_slice, z_spacing_cbct)
+
+        # Compute top Z position in physical mm
+        top_cbct_mm_z = origin_cbct[2] + top_z_cbct_slice * z_spacing_cbct
+
+        spacing_ct = hip_seg.GetSpacing()
+        origin_ct = hip_seg.GetOrigin()
+        z_spacing_ct = spacing_ct[2]
+
+        hip_seg_array = sitk.GetArrayFromImage(hip_seg)
+        z_dim_ct = hip_seg_array.shape[0]
+
+        z_indices_ct = np.any(hip_seg_array, axis=(1, 2))
+        if not np.any(z_indices_ct):
+            logger.warning("No non-zero slices found in CT hip!")
+            return None
+
+        # Convert CBCT physical z to CT slice index
+        crop_z_ct = int(np.floor((top_cbct_mm_z - origin_ct[2]) / z_spacing_ct))
+        crop_z_clipped = np.clip(crop_z_ct, 0, z_dim_ct)
+
+        logger.debug("Cropping CT hip above slice %s (CT shape = %s)", crop_z_clipped, z_dim_ct)
+        # if is_femur:
+        #     if crop_z_clipped < z_dim_ct:
+        #         hip_seg_array[:crop_z_clipped] = 0
+        #     else:
+        #         print(f"  [INFO] crop_z ({crop_z_clipped}) >= CT volume depth ({z_dim_ct}), skipping crop.")
+        # else:
+        if crop_z_clipped < z_dim_ct:
+            hip_seg_array[crop_z_clipped:] = 0
+        else:
+            logger.debug("crop_z (%s) >= CT volume depth (%s), skipping crop.", crop_z_clipped, z_dim_ct)
+
+        cropped = sitk.GetImageFromArray(hip_seg_array)
+        cropped.CopyInformation(hip_seg)
+        return cropped
+
     def get_colon_z_extent(self, colon_path):
-        colon = sitk.ReadImage(colon_path)
-        colon_array = sitk.GetArrayFromImage(colon)
-        z_indices = np.any(colon_array, axis=(1, 2))
-        if not np.any(z_indices):
+        extent = self.mask_stats(colon_path).z_extent
+        if extent is None:
             return None
-        z_min = np.min(np.argwhere(z_indices))
-        z_max = np.max(np.argwhere(z_indices))
-        return z_min, z_max, colon
+        return extent[0], extent[1], sitk.ReadImage(colon_path)
     
     def apply_z_crop_to_colon(self, colon_img, z_min, z_max, save_path):
         colon_array = sitk.GetArrayFromImage(colon_img)
@@ -400,57 +524,81 @@ class Utils:
         colon_array[z_max+1:] = 0
         cropped = sitk.GetImageFromArray(colon_array)
         cropped.CopyInformation(colon_img)
-        sitk.WriteImage(cropped, save_path)
+        mask_index.write_mask(cropped, save_path)
                 
     def crop_ct_femur_using_cbct(self, cbct_femur_path, ct_femur_path):
         try:
-            print(f"\n[START] Cropping CT femur using CBCT femur reference.")
-            print(f"  CBCT femur: {cbct_femur_path}")
-            print(f"  CT femur:   {ct_femur_path}")
-    
-            # Load CBCT femur segmentation
-            cbct_seg = sitk.ReadImage(cbct_femur_path)
-            cbct_array = sitk.GetArrayFromImage(cbct_seg)
-            z_spacing_cbct = cbct_seg.GetSpacing()[2]
-            origin_cbct_z = cbct_seg.GetOrigin()[2]
-    
-            z_indices_cbct = np.any(cbct_array, axis=(1, 2))
-            if not np.any(z_indices_cbct):
-                print("  [WARNING] CBCT femur segment is empty.")
+            logger.debug("[START] Cropping CT femur using CBCT femur reference.")
+            logger.debug("CBCT femur: %s", cbct_femur_path)
+            logger.debug("CT femur:   %s", ct_femur_path)
+
+            if self.configs.streaming:
+                memory_mb = self.configs.stream_memory_mb
+                cbct_extent = self.mask_stats(cbct_femur_path).z_extent
+                if cbct_extent is None:
+                    logger.warning("CBCT femur segment is empty.")
+                    return
+                cbct, ct = streaming.SlabReader(cbct_femur_path), streaming.SlabReader(ct_femur_path)
+                bottom_cbct_mm = cbct.origin[2] + cbct_extent[0] * cbct.spacing[2]
+                logger.debug("Bottom CBCT femur slice: %s, mm: %.2f", cbct_extent[0], bottom_cbct_mm)
+                z_dim_ct = ct.size[2]
+                crop_z_clipped = np.clip(int(np.floor((bottom_cbct_mm - ct.origin[2]) / ct.spacing[2])), 0, z_dim_ct)
+                logger.debug("Crop below CT slice index: %s", crop_z_clipped)
+                if crop_z_clipped < z_dim_ct:
+                    streaming.stream_z_crop(ct_femur_path, ct_femur_path, crop_z_clipped, z_dim_ct - 1, memory_mb)
+                    self.mask_stats(ct_femur_path)
+                    logger.info("[DONE] Cropped CT femur below slice %s: %s", crop_z_clipped, ct_femur_path)
+                else:
+                    logger.debug("crop_z exceeds CT bounds, skipping crop.")
                 return
     
-            # Use BOTTOM slice of CBCT femur as reference
-            bottom_cbct_slice = int(np.min(np.argwhere(z_indices_cbct)))
-            bottom_cbct_mm = origin_cbct_z + bottom_cbct_slice * z_spacing_cbct
-            print(f"  Bottom CBCT femur slice: {bottom_cbct_slice}, mm: {bottom_cbct_mm:.2f}")
-    
-            # Load CT femur segmentation
-            ct_seg = sitk.ReadImage(ct_femur_path)
-            ct_array = sitk.GetArrayFromImage(ct_seg)
-            z_spacing_ct = ct_seg.GetSpacing()[2]
-            origin_ct_z = ct_seg.GetOrigin()[2]
-            z_dim_ct = ct_array.shape[0]
-    
-            # Convert CBCT femur bottom Z (mm) → CT slice index
-            crop_z_ct = int(np.floor((bottom_cbct_mm - origin_ct_z) / z_spacing_ct))
-            crop_z_clipped = np.clip(crop_z_ct, 0, z_dim_ct)
-            print(f"  Crop below CT slice index: {crop_z_clipped}")
-    
-            # Remove everything BELOW the bottom of CBCT femur in CT
-            if crop_z_clipped < z_dim_ct:
-                ct_array[:crop_z_clipped] = 0
-                print(f"  Cropped CT femur below slice {crop_z_clipped}")
-            else:
-                print("  [INFO] crop_z exceeds CT bounds, skipping crop.")
-    
-            # Save
-            cropped = sitk.GetImageFromArray(ct_array)
-            cropped.CopyInformation(ct_seg)
-            sitk.WriteImage(cropped, ct_femur_path)
-            print(f"  [DONE] Cropped CT femur saved to: {ct_femur_path}\n")
+            if self.indexed_empty(cbct_femur_path):
+                logger.warning("CBCT femur segment is empty.")
+                return
+            cropped = self.crop_ct_femur_using_cbct_image(sitk.ReadImage(cbct_femur_path), sitk.ReadImage(ct_femur_path))
+            if cropped is not None:
+                mask_index.write_mask(cropped, ct_femur_path)
+                logger.info("[DONE] Cropped CT femur saved to: %s", ct_femur_path)
     
         except Exception as e:
-            print(f"[ERROR] Cropping femur failed: {e}")
+            logger.error("Cropping femur failed: %s", e)
             import traceback
             traceback.print_exc()
 
+    def crop_ct_femur_using_cbct_image(self, cbct_seg, ct_seg):
+        # In-memory core of crop_ct_femur_using_cbct: the CT femur zeroed below the bottom of the CBCT femur, None if that is empty
+        cbct_array = sitk.GetArrayFromImage(cbct_seg)
+        z_spacing_cbct = cbct_seg.GetSpacing()[2]
+        origin_cbct_z = cbct_seg.GetOrigin()[2]
+
+        z_indices_cbct = np.any(cbct_array, axis=(1, 2))
+        if not np.any(z_indices_cbct):
+            logger.warning("CBCT femur segment is empty.")
+            return None
+
+        # Use BOTTOM slice of CBCT femur as reference
+        bottom_cbct_slice = int(np.min(np.argwhere(z_indices_cbct)))
+        bottom_cbct_mm = origin_cbct_z + bottom_cbct_slice * z_spacing_cbct
+        logger.debug("Bottom CBCT femur slice: %s, mm: %.2f", bottom_cbct_slice, bottom_cbct_mm)
+
+        ct_array = sitk.GetArrayFromImage(ct_seg)
+        z_spacing_ct = ct_seg.GetSpacing()[2]
+        origin_ct_z = ct_seg.GetOrigin()[2]
+        z_dim_ct = ct_array.shape[0]
+
+        # Convert CBCT femur bottom Z (mm) → CT slice index
+        crop_z_ct = int(np.floor((bottom_cbct_mm - origin_ct_z) / z_spacing_ct))
+        crop_z_clipped = np.clip(crop_z_ct, 0, z_dim_ct)
+        logger.debug("Crop below CT slice index: %s", crop_z_clipped)
+
+        # Remove everything BELOW the bottom of CBCT femur in CT
+        if crop_z_clipped < z_dim_ct:
+            ct_array[:crop_z_clipped] = 0
+            logger.debug("Cropped CT femur below slice %s", crop_z_clipped)
+        else:
+            logger.debug("crop_z exceeds CT bounds, skipping crop.")
+
+        cropped = sitk.GetImageFromArray(ct_array)
+        cropped.CopyInformation(ct_seg)
+        return cropped
+
@@ -0,0 +1,85 @@
+import numpy as np
+import SimpleITK as sitk
+
+# Magnitude histogram used by the chunked mode, percentiles are exact to within one bin
+MAGNITUDE_BIN_MM = 0.01
+MAGNITUDE_MAX_MM = 500.0
+PERCENTILES = (50, 95, 99)
+
+
+def jacobian_determinant(disp, spacing, direction=None) -> np.ndarray:
+    # disp: (z, y, x, 3) physical displacements, spacing in sitk (x, y, z) order
+    # J = I + du/dp, with du/dp = (du/da) D^T where a are the (physical) image axes
+    grads = np.stack(
+        [np.stack(np.gradient(disp[..., c], spacing[2], spacing[1], spacing[0])[::-1], axis=-1) for c in range(3)],
+        axis=-2,
+    )
+    if direction is not None:
+        grads = grads @ np.array(direction, dtype=np.float64).reshape(3, 3).T
+    grads[..., 0, 0] += 1
+    grads[..., 1, 1] += 1
+    grads[..., 2, 2] += 1
+    return np.linalg.det(grads).astype(np.float32)
+
+
+def _summary(jac_min, jac_max, jac_sum, folding, total, magnitude_percentiles, magnitude_max):
+    summary = {
+        "jac_min": float(jac_min),
+        "jac_max": float(jac_max),
+        "jac_mean": float(jac_sum / total) if total else float("nan"),
+        "folding_fraction": float(folding / total) if total else float("nan"),
+        "folding_voxels": int(folding),
+    }
+    for p, value in zip(PERCENTILES, magnitude_percentiles):
+        summary[f"disp_p{p}_mm"] = float(value)
+    summary["disp_max_mm"] = float(magnitude_max)
+    return summary
+
+
+def vf_quality(disp, spacing, direction=None):
+    # Whole-volume metrics, returns the summary and the Jacobian determinant map
+    jac = jacobian_determinant(disp, spacing, direction)
+    magnitude = np.sqrt(np.square(disp).sum(axis=-1))
+    summary = _summary(
+        jac.min(), jac.max(), jac.sum(dtype=np.float64), np.count_nonzero(jac <= 0), jac.size,
+        np.percentile(magnitude, PERCENTILES), magnitude.max(),
+    )
+    return summary, jac
+
+
+def vf_quality_chunked(read_slab, z_dim, spacing, direction=None, chunk_slices=16, jac_slab_callback=None):
+    # Bounded-memory metrics: slabs carry a one-slice halo so the central differences
+    # match the whole-volume result, magnitude percentiles come from a fixed histogram.
+    bins = np.zeros(int(MAGNITUDE_MAX_MM / MAGNITUDE_BIN_MM) + 1, dtype=np.int64)
+    jac_min, jac_max, jac_sum, folding, total, magnitude_max = np.inf, -np.inf, 0.0, 0, 0, 0.0
+    for z0 in range(0, z_dim, chunk_slices):
+        z1 = min(z0 + chunk_slices, z_dim)
+        h0, h1 = max(0, z0 - 1), min(z_dim, z1 + 1)
+        disp = read_slab(h0, h1)
+        jac = jacobian_determinant(disp, spacing, direction)[z0 - h0:z0 - h0 + (z1 - z0)]
+        magnitude = np.sqrt(np.square(disp[z0 - h0:z0 - h0 + (z1 - z0)]).sum(axis=-1))
+
+        jac_min, jac_max = min(jac_min, jac.min()), max(jac_max, jac.max())
+        jac_sum += jac.sum(dtype=np.float64)
+        folding += np.count_nonzero(jac <= 0)
+        total += jac.size
+        magnitude_max = max(magnitude_max, float(magnitude.max()))
+        idx = np.minimum((magnitude / MAGNITUDE_BIN_MM).astype(np.int64), len(bins) - 1)
+        bins += np.bincount(idx.ravel(), minlength=len(bins))
+        if jac_slab_callback is not None:
+            jac_slab_callback(z0, jac)
+
+    cumulative = np.cumsum(bins)
+    percentiles = [
+        min((np.searchsorted(cumulative, total * p / 100.0) + 0.5) * MAGNITUDE_BIN_MM, magnitude_max)
+        for p in PERCENTILES
+    ]
+    return _summary(jac_min, jac_max, jac_sum, folding, total, percentiles, magnitude_max)
+
+
+def jacobian_image(jac, spacing, origin, direction) -> sitk.Image:
+    image = sitk.GetImageFromArray(jac)
+    image.SetSpacing(spacing)
+    image.SetOrigin(origin)
+    image.SetDirection(direction)
+    return image
@@ -0,0 +1,141 @@
+import os
+import json
+import numpy as np
+import SimpleITK as sitk
+
+VFZ_SUFFIX = ".vfz"
+VF_STORAGE_DTYPES = ("float16", "int16")
+
+
+def compressed_vf_path(nrrd_path) -> str:
+    return f"{nrrd_path.removesuffix('.nrrd')}{VFZ_SUFFIX}"
+
+
+def compress_vf(nrrd_path, out_path=None, dtype="float16", chunk_slices=16):
+    # Store the float32 VF as z-slab chunks so readers only decode the slabs they touch.
+    # int16 chunks are quantized with a per-chunk scale, float16 chunks are a plain cast.
+    if dtype not in VF_STORAGE_DTYPES:
+        raise ValueError(f"Unsupported VF storage dtype: {dtype}")
+    out_path = out_path or compressed_vf_path(nrrd_path)
+
+    vf_img = sitk.ReadImage(nrrd_path)
+    vf_array = sitk.GetArrayViewFromImage(vf_img)
+    z_dim = vf_array.shape[0]
+
+    chunks, scales, max_error = {}, [], 0.0
+    for i, z0 in enumerate(range(0, z_dim, chunk_slices)):
+        slab = np.asarray(vf_array[z0:z0 + chunk_slices], dtype=np.float32)
+        if dtype == "int16":
+            scale = float(np.abs(slab).max()) / 32767.0 or 1.0
+            encoded = np.round(slab / scale).astype(np.int16)
+            decoded = encoded.astype(np.float32) * scale
+        else:
+            scale = 1.0
+            encoded = slab.astype(np.float16)
+            decoded = encoded.astype(np.float32)
+        scales.append(scale)
+        chunks[f"chunk_{i:05d}"] = encoded
+        # Maximum Euclidean displacement error introduced by the lossy encoding
+        if slab.size:
+            max_error = max(max_error, float(np.sqrt(np.square(decoded - slab).sum(axis=-1)).max()))
+
+    header = {
+        "size": list(vf_img.GetSize()),
+        "spacing": list(vf_img.GetSpacing()),
+        "origin": list(vf_img.GetOrigin()),
+        "direction": list(vf_img.GetDirection()),
+        "components": vf_img.GetNumberOfComponentsPerPixel(),
+        "dtype": dtype,
+        "chunk_slices": chunk_slices,
+        "scales": scales,
+        "max_error_mm": max_error,
+    }
+    # np.savez_compressed appends .npz to names without it, so write through a file handle
+    with open(out_path, "wb") as f:
+        np.savez_compressed(f, header=np.array(json.dumps(header)), **chunks)
+    return out_path, max_error
+
+
+class VectorFieldStore:
+    def __init__(self, path) -> None:
+        self.path = path
+        self._npz = np.load(path)
+        self.header = json.loads(str(self._npz["header"]))
+        self.size = tuple(self.header["size"])
+        self.spacing = tuple(self.header["spacing"])
+        self.origin = tuple(self.header["origin"])
+        self.direction = tuple(self.header["direction"])
+        self.chunk_slices = self.header["chunk_slices"]
+        self.max_error_mm = self.header["max_error_mm"]
+
+    def close(self):
+        self._npz.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _decode_chunk(self, i) -> np.ndarray:
+        chunk = self._npz[f"chunk_{i:05d}"].astype(np.float32)
+        if self.header["dtype"] == "int16":
+            chunk *= self.header["scales"][i]
+        return chunk
+
+    def read_slab(self, z0, z1) -> np.ndarray:
+        # Returns displacements for slices [z0, z1) with shape (z, y, x, 3), decoding only overlapping chunks;
+        # the range is clipped to the field, a range outside it gives an empty slab
+        z0, z1 = max(0, z0), min(self.size[2], z1)
+        if z0 >= z1:
+            return np.zeros((0, self.size[1], self.size[0], self.header["components"]), dtype=np.float32)
+        first, last = z0 // self.chunk_slices, (z1 - 1) // self.chunk_slices
+        slab = np.concatenate([self._decode_chunk(i) for i in range(first, last + 1)], axis=0)
+        offset = first * self.chunk_slices
+        return slab[z0 - offset:z1 - offset]
+
+    def to_image(self) -> sitk.Image:
+        image = sitk.GetImageFromArray(self.read_slab(0, self.size[2]), isVector=True)
+        image.SetSpacing(self.spacing)
+        image.SetOrigin(self.origin)
+        image.SetDirection(self.direction)
+        return image
+
+    def materialize(self, nrrd_path) -> str:
+        # plastimatch only reads complete VF files, so external tools get a float32 copy
+        os.makedirs(os.path.dirname(nrrd_path), exist_ok=True)
+        sitk.WriteImage(self.to_image(), nrrd_path)
+        return nrrd_path
+
+
+def max_displacement_error(reference_nrrd, vfz_path) -> float:
+    # Lossless-enough check: recompute the worst-case error against the original float32 field
+    reference_img = sitk.ReadImage(reference_nrrd)
+    reference = sitk.GetArrayViewFromImage(reference_img)
+    max_error = 0.0
+    with VectorFieldStore(vfz_path) as store:
+        for z0 in range(0, store.size[2], store.chunk_slices):
+            decoded = store.read_slab(z0, z0 + store.chunk_slices)
+            diff = decoded - reference[z0:z0 + store.chunk_slices]
+            max_error = max(max_error, float(np.sqrt(np.square(diff).sum(axis=-1)).max()))
+    return max_error
+
+
+if __name__=="__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--vf", type=str, help="float32 VF .nrrd filepath")
+    parser.add_argument("--dtype", type=str, default="float16", choices=VF_STORAGE_DTYPES, help="storage dtype")
+    parser.add_argument("--chunk-slices", type=int, default=16, help="z-slices per compressed chunk")
+
+    args = parser.parse_args()
+    vfz_path, _ = compress_vf(args.vf, dtype=args.dtype, chunk_slices=args.chunk_slices)
+    print(f"{vfz_path}: {os.path.getsize(args.vf)} -> {os.path.getsize(vfz_path)} bytes")
+    print(f"max displacement error: {max_displacement_error(args.vf, vfz_path):.6f} mm")
+    # Slab reads clipped at both ends of the field
+    with VectorFieldStore(vfz_path) as store:
+        z_dim = store.size[2]
+        for z0, z1, expected in [(-5, 2, min(2, z_dim)), (z_dim - 1, z_dim + 5, 1), (z_dim, z_dim + 5, 0), (-5, 0, 0)]:
+            slab = store.read_slab(z0, z1)
+            assert slab.shape == (expected, store.size[1], store.size[0], 3), (z0, z1, slab.shape)
+    print("slab bounds: ok")
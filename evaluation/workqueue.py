@@ -0,0 +1,198 @@
+import os
+import json
+import time
+import glob
+import socket
+import logging
+import threading
+from contextlib import contextmanager
+from evaluation.stages import lazy_import
+from evaluation.ledger import Ledger
+from evaluation.scheduler import CostModel
+
+# Only --merge needs the results store (and pandas with it)
+results_store = lazy_import("evaluation.results_store")
+
+logger = logging.getLogger(__name__)
+
+PENDING, CLAIMED, DONE, FAILED = "pending", "claimed", "done", "failed"
+
+
+def patient_name(patient_dir):
+    return os.path.basename(os.path.normpath(patient_dir))
+
+
+def job_name(variant, patient):
+    return f"{variant}__{patient}"
+
+
+def parse_shard(text):
+    # "i/N" with 1 <= i <= N, same 1-based numbering as --nums
+    index, count = (int(v) for v in text.split("/"))
+    if not 1 <= index <= count:
+        raise ValueError(f"Invalid shard '{text}', expected i/N with 1 <= i <= N")
+    return index, count
+
+
+def shard(patient_dirs, index, count):
+    # Sorted first, glob order differs between nodes
+    return sorted(patient_dirs, key=patient_name)[index - 1::count]
+
+
+class WorkQueue:
+    # (patient, variant) jobs as one JSON file each under <root>/{pending,claimed,done,failed}.
+    # Every state change is a rename within the shared filesystem, so exactly one node wins a claim;
+    # the claimer touches its file every heartbeat_s and any node moves claims older than stale_s back to pending.
+    def __init__(self, root, stale_s=900, heartbeat_s=60, poll_s=30, max_attempts=3, worker_id=None) -> None:
+        self.root = root
+        self.stale_s = stale_s
+        self.heartbeat_s = heartbeat_s
+        self.poll_s = poll_s
+        self.max_attempts = max_attempts
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+        for state in (PENDING, CLAIMED, DONE, FAILED, "tmp"):
+            os.makedirs(os.path.join(root, state), exist_ok=True)
+
+    def _path(self, state, name):
+        return os.path.join(self.root, state, f"{name}.json")
+
+    def _names(self, state):
+        return sorted(f[:-len(".json")] for f in os.listdir(os.path.join(self.root, state)) if f.endswith(".json"))
+
+    def _write(self, path, job):
+        tmp = os.path.join(self.root, "tmp", f"{self.worker_id}-{os.path.basename(path)}")
+        with open(tmp, "w") as f:
+            json.dump(job, f)
+        return tmp
+
+    def state(self, name):
+        for state in (PENDING, CLAIMED, DONE, FAILED):
+            if os.path.exists(self._path(state, name)):
+                return state
+        return None
+
+    def enqueue(self, variant, patient_dir, after=None):
+        # Idempotent, every node may enqueue the whole cohort; `after` is the variant whose job must finish first
+        patient = patient_name(patient_dir)
+        name = job_name(variant, patient)
+        if self.state(name) is not None:
+            return False
+        job = {"name": name, "variant": variant, "patient": patient, "patient_dir": os.path.abspath(patient_dir),
+               "after": job_name(after, patient) if after else None, "attempts": 0}
+        tmp = self._write(self._path(PENDING, name), job)
+        try:
+            # link() fails if another node enqueued the same job meanwhile
+            os.link(tmp, self._path(PENDING, name))
+            return True
+        except FileExistsError:
+            return False
+        finally:
+            os.remove(tmp)
+
+    def requeue_stale(self):
+        now = time.time()
+        for name in self._names(CLAIMED):
+            path = self._path(CLAIMED, name)
+            try:
+                if now - os.path.getmtime(path) < self.stale_s:
+                    continue
+                os.rename(path, self._path(PENDING, name))
+                logger.warning("[QUEUE] Requeued %s, no heartbeat for %s s", name, self.stale_s)
+            except FileNotFoundError:
+                # Finished or requeued by another node in the meantime
+                continue
+
+    def claim(self):
+        self.requeue_stale()
+        for name in self._names(PENDING):
+            pending = self._path(PENDING, name)
+            try:
+                with open(pending) as f:
+                    job = json.load(f)
+                if job["after"] and self.state(job["after"]) not in (DONE, FAILED):
+                    continue
+                # Fresh mtime before the rename, so no node sees the claim as stale
+                os.utime(pending)
+                os.rename(pending, self._path(CLAIMED, name))
+            except (FileNotFoundError, json.JSONDecodeError):
+                continue
+            job["attempts"] += 1
+            job["worker"] = self.worker_id
+            claimed = self._path(CLAIMED, name)
+            os.replace(self._write(claimed, job), claimed)
+            if job["attempts"] > self.max_attempts:
+                logger.error("[QUEUE] %s failed, claimed %s times without finishing", name, job["attempts"] - 1)
+                self._move(name, CLAIMED, FAILED)
+                continue
+            return job
+        return None
+
+    def jobs(self):
+        # Claims jobs until none is pending or claimed; waits while other nodes hold jobs that may be requeued
+        while True:
+            job = self.claim()
+            if job is not None:
+                yield job
+            elif self._names(PENDING) or self._names(CLAIMED):
+                time.sleep(self.poll_s)
+            else:
+                return
+
+    def _move(self, name, src, dst):
+        try:
+            os.rename(self._path(src, name), self._path(dst, name))
+            return True
+        except FileNotFoundError:
+            logger.warning("[QUEUE] Lost the claim on %s, it was requeued after a missed heartbeat", name)
+            return False
+
+    @contextmanager
+    def running(self, job):
+        # Heartbeats while the block runs, then commits the job to done (or failed when the block raised)
+        stop = threading.Event()
+        path = self._path(CLAIMED, job["name"])
+
+        def heartbeat():
+            while not stop.wait(self.heartbeat_s):
+                try:
+                    os.utime(path)
+                except FileNotFoundError:
+                    return
+
+        thread = threading.Thread(target=heartbeat, name=f"heartbeat-{job['name']}", daemon=True)
+        thread.start()
+        try:
+            yield job
+        except BaseException:
+            stop.set()
+            thread.join()
+            self._move(job["name"], CLAIMED, FAILED)
+            raise
+        stop.set()
+        thread.join()
+        self._move(job["name"], CLAIMED, DONE)
+
+    def counts(self):
+        return {state: len(self._names(state)) for state in (PENDING, CLAIMED, DONE, FAILED)}
+
+
+def merge_partitions(configs):
+    # Folds the results store, ledger and cost model of every partition (PARTITIONS_DIR/<partition>/) into the shared
+    # ones, then rewrites the tables of merged_all from the combined store, so each table stays keyed by its variant.
+    # Merging again after more jobs finished is safe. Returns the written tables.
+    store_paths = sorted(glob.glob(os.path.join(configs.PARTITIONS_DIR, "*", os.path.basename(configs.RESULTS_STORE_PATH))))
+    tables = set()
+    with results_store.ResultsStore(configs.RESULTS_STORE_PATH) as store:
+        for path in store_paths:
+            tables |= store.merge(path)
+        written = store.publish(os.path.join(configs.RESULTS_DIR, "merged_all"), tables, configs.PATIENT_NUM_KEY,
+                                configs.REGISTRATION_KEY, configs.VF_QUALITY_CSV_FILENAME)
+    ledger_paths = sorted(glob.glob(os.path.join(configs.PARTITIONS_DIR, "*", os.path.basename(configs.LEDGER_PATH))))
+    with Ledger(configs.LEDGER_PATH) as shared:
+        runs = sum(shared.merge(path) for path in ledger_paths)
+    cost_model = CostModel(configs.COST_MODEL_PATH)
+    for path in sorted(glob.glob(os.path.join(configs.PARTITIONS_DIR, "*", os.path.basename(configs.COST_MODEL_PATH)))):
+        cost_model.merge(path)
+    cost_model.save()
+    logger.info("[MERGE] %s partition store(s), %s new run(s) in the ledger", len(store_paths), runs)
+    return written
@@ -3,10 +3,127 @@ from glob import glob
 from evaluation.config import EvaluationConfig
 from evaluation.pipeline import EvaluationPipeline
 import traceback
+from evaluation.workqueue import WorkQueue, parse_shard, shard, merge_partitions
+from evaluation.planner import format_plan
+from evaluation.manifest import Manifest
+
+flag_combinations = {
+    "baseline": (False, False, False),
+    "extorgans": (False, False, True),
+    "genctseg": (False, True, False),
+    "genctseg_extorgans": (False, True, True),
+    "genctall": (True, False, False),
+    "genctall_extorgans": (True, False, True),
+}
+
+shared_from = {
+    "baseline": None,
+    "extorgans": "baseline",
+    "genctseg": "baseline",
+    "genctseg_extorgans": "baseline",
+    "genctall": None,
+    "genctall_extorgans": None,
+}
+
+
+def build_configs(variant, args):
+    gen_ct_all, gen_ct_seg, ext_ts_organs = flag_combinations[variant]
+    configs = EvaluationConfig()
+    configs.use_generated_ct_everywhere = gen_ct_all
+    configs.use_generated_ct_for_segmentation = gen_ct_seg
+    configs.use_extended_ts_organs = ext_ts_organs
+    # Preview runs are their own variant: eval_<variant>_preview, structures_tables_<variant>_preview, ledger and score rows
+    configs.VARIANT_TAG = f"{variant}_preview" if args.preview else variant
+    configs.preview = args.preview
+    configs.preview_factor = args.preview_factor
+    configs.vf_storage = args.vf_storage
+    configs.fused_preprocessing = args.fused_preprocess
+    configs.cbct_fov_threshold = args.fov_threshold
+    configs.cache_series = args.cache_series
+    configs.series_decode_threads = args.decode_threads
+    configs.streaming = args.streaming
+    configs.compact_segments = args.compact_segments
+    configs.stream_memory_mb = args.memory_mb
+    configs.vf_quality_chunk_slices = args.vf_quality_chunk
+    configs.workers = args.workers
+    configs.ram_budget_mb = args.ram_budget_mb
+    configs.cpu_budget = args.cpu_budget
+    configs.structure_workers = args.structure_workers
+    configs.prefetch_patients = args.prefetch
+    configs.prefetch_budget_mb = args.prefetch_mb
+    configs.profile_top = args.profile
+    configs.scratch_dir = args.scratch
+    configs.scratch_cap_mb = args.scratch_mb
+    configs.scratch_durable = args.scratch_durable
+    configs.use_manifest = args.manifest
+    configs.preflight = args.preflight
+    configs.adopt_legacy = args.adopt_legacy
+    configs.plastimatch_concurrency = args.pm_concurrency
+    configs.plastimatch_timeout_s = args.pm_timeout
+    configs.register_timeout_s = args.register_timeout
+    configs.plastimatch_retries = args.pm_retries
+    configs.log_level = args.log_level
+    configs.console_log_level = args.console_level
+    return configs
+
+
+def run_variant(configs, data, args, shared_variant):
+    pipeline = EvaluationPipeline(configs=configs)
+    pipeline.evaluate(
+        data,
+        args.force,
+        [],
+        args.all,
+        args.seg,
+        args.pw_linear,
+        args.dmap,
+        args.cxt,
+        args.fcsv,
+        args.params,
+        args.register,
+        args.warp,
+        args.metric,
+        args.fiducial_sep,
+        shared_variant=shared_variant
+    )
+    return pipeline
+
+
+def plan_variant(configs, data, args):
+    pipeline = EvaluationPipeline(configs=configs)
+    plans = pipeline.plan(data, args.force, [], args.all, args.seg, args.pw_linear, args.dmap, args.cxt,
+                          args.fcsv, args.params, args.register, args.warp, args.metric)
+    print(format_plan(plans, configs.VARIANT_TAG, configs.workers, configs.cpu_budget))
+
+
+def run_worker(args, data, variants):
+    # Every node enqueues the same cohort (idempotent), then drains the queue together with the others
+    queue = WorkQueue(args.worker, stale_s=args.stale_after, heartbeat_s=args.heartbeat)
+    # A patient's variants run in order, as on one machine: they share the patient folder (LT_CBCT, segments)
+    # and the shared-GT variants reuse baseline results. Different patients run in parallel.
+    for patient_dir in data:
+        for after, variant in zip([None] + variants, variants):
+            queue.enqueue(variant, patient_dir, after)
+    print(f"Worker {queue.worker_id} on {args.worker}: {queue.counts()}")
+
+    for job in queue.jobs():
+        print(f"\nRunning variant: {job['variant']} for {job['patient']} (attempt {job['attempts']})")
+        try:
+            with queue.running(job):
+                configs = build_configs(job["variant"], args)
+                # One partition per job; the scores of a requeued job are newer than the stale attempt's and win in --merge
+                configs.partition = job["patient"]
+                pipeline = run_variant(configs, [job["patient_dir"]], args, shared_from.get(job["variant"]))
+                if pipeline.failed_patients:
+                    raise RuntimeError(f"{job['patient']} failed, see the variant's patient log")
+        except Exception as e:
+            print(f"[ERROR] Job '{job['name']}' failed with error: {e}")
+            traceback.print_exc()
+    print(f"Worker {queue.worker_id} finished: {queue.counts()}")
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("-d", "--data", type=str, nargs="+", help="List of patient directories")
+    parser.add_argument("-d", "--data", type=str, nargs="+", default=[], help="List of patient directories")
     parser.add_argument("-n", "--nums", type=str, help="patient numbers to process (in csv format)")
     parser.add_argument("-f", "--force", action='store_true', help="force run, deletes previous results and creates a new one. Otherwise skips the step if results already present")
     parser.add_argument("-a", "--all", action='store_true', help="run all the steps")
@@ -21,75 +138,90 @@ if __name__ == "__main__":
     parser.add_argument("-m", "--metric", action='store_true', help="run calculate scores only")
     parser.add_argument("-fs", "--fiducial-sep", action='store_true', help="run calculate fiducial distance only")
     parser.add_argument("-v", "--variant", type=str, help="Run only the specified variant (e.g., genctall_extorgans)")
+    parser.add_argument("-fp", "--fused-preprocess", action='store_true', help="build LT_CBCT from CBCT_raw with the Slicer affine and HU curve in one resample (cached per patient)")
+    parser.add_argument("--fov-threshold", type=float, default=None, help="crop the preprocessed CBCT to voxels above this HU after mapping")
+    parser.add_argument("-sc", "--cache-series", action='store_true', help="decode the CT/CBCT/generated CT DICOM series once per patient into a cached volume that all later steps read")
+    parser.add_argument("--decode-threads", type=int, default=0, help="threads decoding a DICOM series (0 = all cores)")
+    parser.add_argument("-cs", "--compact-segments", action='store_true', help="store segmentations as one uint8 label map per folder with a label table, exporting per-structure masks only when needed")
+    parser.add_argument("-st", "--streaming", action='store_true', help="process HU mapping, z-crops, bounding-box scans and mask resampling in z-slabs")
+    parser.add_argument("--memory-mb", type=int, default=512, help="memory ceiling per streamed operation (MB)")
+    parser.add_argument("-j", "--workers", type=int, default=1, help="patients processed concurrently under the RAM/CPU budgets")
+    parser.add_argument("--ram-budget-mb", type=int, default=0, help="RAM budget for concurrently admitted stages (MB, 0 = 80%% of system RAM)")
+    parser.add_argument("--cpu-budget", type=int, default=0, help="CPU cores for concurrently admitted stages (0 = all cores)")
+    parser.add_argument("--structure-workers", type=int, default=0, help="threads for per-structure work within a stage, shared by all patients (0 = all cores)")
+    parser.add_argument("--prefetch", type=int, default=0, help="read the inputs of the next N patients ahead into the page cache while the current ones compute (0 = off)")
+    parser.add_argument("--prefetch-mb", type=int, default=2048, help="bytes read ahead of patients not started yet (MB)")
+    parser.add_argument("--scratch", type=str, default="", metavar="DIR", help="write the registration and warp stage folders on local scratch (SSD/tmpfs), copying only the durable ones back at commit")
+    parser.add_argument("--scratch-mb", type=int, default=20480, help="size cap of the scratch folder (MB), least recently used committed copies are evicted above it")
+    parser.add_argument("--scratch-durable", type=str, nargs="+", default=["VFs", "warps"], help="stage folders copied back from scratch to eval_<variant> at commit, the others are committed empty")
+    parser.add_argument("--profile", type=int, nargs="?", const=10, default=0, help="summarize the N slowest stages and patients (default 10) from the run's trace")
+    parser.add_argument("--pm-concurrency", type=int, default=0, help="plastimatch commands run at once (0 = all cores)")
+    parser.add_argument("--pm-timeout", type=int, default=3600, help="timeout per plastimatch command (s)")
+    parser.add_argument("--register-timeout", type=int, default=6 * 3600, help="timeout per plastimatch registration (s)")
+    parser.add_argument("--pm-retries", type=int, default=2, help="retries for plastimatch commands killed by a signal")
+    parser.add_argument("--log-level", type=str, default="INFO", choices=["DEBUG", "INFO", "WARNING", "ERROR"], help="level of the variant and per-patient log files")
+    parser.add_argument("--console-level", type=str, default="WARNING", choices=["DEBUG", "INFO", "WARNING", "ERROR"], help="level shown on the console besides per-stage progress")
+    parser.add_argument("-vq", "--vf-quality-chunk", type=int, default=0, help="z-slices per chunk for VF quality metrics (0 = whole VF)")
+    parser.add_argument("-vfs", "--vf-storage", type=str, default="nrrd", choices=["nrrd", "float16", "int16"], help="VF storage format, float16/int16 store chunked compressed .vfz files")
+    parser.add_argument("--worker", type=str, default=None, metavar="QUEUE_DIR", help="claim (patient, variant) jobs from a queue directory on a shared filesystem until it is drained")
+    parser.add_argument("--heartbeat", type=int, default=60, help="worker heartbeat interval (s)")
+    parser.add_argument("--stale-after", type=int, default=900, help="requeue claimed jobs without a heartbeat for this long (s)")
+    parser.add_argument("--shard", type=str, default=None, metavar="i/N", help="process only the i-th of N static partitions of the patients")
+    parser.add_argument("--preview", action='store_true', help="fast QA pass: series and GT contours downsampled in-plane, TotalSegmentator's fast model, one coarse registration stage; outputs go to <variant>_preview")
+    parser.add_argument("--preview-factor", type=int, default=4, help="in-plane downsampling factor of --preview")
+    parser.add_argument("--preflight", action='store_true', help="check the inputs of the pending stages from headers first, skipping patients and registration tags that would fail (report: preflight_<variant>.json)")
+    parser.add_argument("--adopt-legacy", action='store_true', help="once, after upgrading: take stage folders written before the .complete markers as committed instead of recomputing them")
+    parser.add_argument("--manifest", action='store_true', help="select patients and detect GT from the cohort manifest (results/manifest.json), rescanning only changed patients")
+    parser.add_argument("--plan", action='store_true', help="dry run: list the stages each patient would run and the estimated wall time, then exit")
+    parser.add_argument("--merge", action='store_true', help="fold the per-worker/shard results stores, ledgers and cost models into the shared ones and rewrite results/merged_all")
 
     args = parser.parse_args()
     data = [item for path in args.data for item in glob(path)]
     print(args)
+    if args.manifest:
+        # Sorted by patient number, so -n and --shard select the same patients on every node
+        entries = Manifest(EvaluationConfig.MANIFEST_PATH, EvaluationConfig()).refresh(data)
+        data = [entry.patient_dir for entry in entries]
+        print(f"Manifest: {len(data)} patient(s), {sum(entry.has_gt for entry in entries)} with GT")
 
     if args.nums:
-        args.nums = [int(x.strip()) - 1 for x in args.nums.split(",") if x.strip()]
-    else:
-        args.nums = []
-
-    flag_combinations = {
-        "baseline": (False, False, False),
-        "extorgans": (False, False, True),
-        "genctseg": (False, True, False),
-        "genctseg_extorgans": (False, True, True),
-        "genctall": (True, False, False),
-        "genctall_extorgans": (True, False, True),
-    }
-    
-    shared_from = {
-        "baseline": None,
-        "extorgans": "baseline",
-        "genctseg": "baseline",
-        "genctseg_extorgans": "baseline",
-        "genctall": None,
-        "genctall_extorgans": None,
-    }
-
-
-
-    
-    variants_to_run = [args.variant] if args.variant else flag_combinations.keys()
+        data = [data[int(x.strip()) - 1] for x in args.nums.split(",") if x.strip()]
+    if args.shard:
+        shard_index, shard_count = parse_shard(args.shard)
+        data = shard(data, shard_index, shard_count)
+        print(f"Shard {args.shard}: {len(data)} patient(s)")
+
+    variants_to_run = [args.variant] if args.variant else list(flag_combinations.keys())
+
+    if args.plan:
+        for variant in variants_to_run:
+            if variant in flag_combinations:
+                plan_variant(build_configs(variant, args), data, args)
+        variants_to_run = []
+    elif args.worker:
+        run_worker(args, data, [v for v in variants_to_run if v in flag_combinations])
+        variants_to_run = []
+    elif not data:
+        variants_to_run = []
 
     for variant in variants_to_run:
         if variant not in flag_combinations:
             print(f"Variant '{variant}' not recognized. Skipping.")
             continue
 
-        gen_ct_all, gen_ct_seg, ext_ts_organs = flag_combinations[variant]
         print(f"\nRunning variant: {variant}")
-        configs = EvaluationConfig()
-        configs.use_generated_ct_everywhere = gen_ct_all
-        configs.use_generated_ct_for_segmentation = gen_ct_seg
-        configs.use_extended_ts_organs = ext_ts_organs
-        configs.VARIANT_TAG = variant
+        configs = build_configs(variant, args)
+        if args.shard:
+            configs.partition = f"shard-{shard_index}of{shard_count}"
         print(configs)
 
-        pipeline = EvaluationPipeline(configs=configs)
-        shared_variant = shared_from.get(variant)
-
         try:
-            pipeline.evaluate(
-                data,
-                args.force,
-                args.nums,
-                args.all,
-                args.seg,
-                args.pw_linear,
-                args.dmap,
-                args.cxt,
-                args.fcsv,
-                args.params,
-                args.register,
-                args.warp,
-                args.metric,
-                args.fiducial_sep,
-                shared_variant=shared_variant
-            )
+            run_variant(configs, data, args, shared_from.get(variant))
         except Exception as e:
             print(f"[ERROR] Variant '{variant}' failed with error: {e}")
             traceback.print_exc()
             continue
+
+    if args.merge:
+        for path in merge_partitions(EvaluationConfig()):
+            print(f"[MERGED] {path}")